@@ -0,0 +1,118 @@
+"""
+Microbenchmark of the per-job overhead of the persistence middleware's
+job_results writes (RUNNING upsert + COMPLETED update for every job).
+
+Compares the previous implementation, which rendered every statement to literal
+SQL with SQLAlchemy (`literal_binds=True`), with the current one: constant
+statements whose values are bound server side, so postgres can reuse a prepared
+plan. It measures the client-side cost alone, then the full round trips against
+the database configured in .env (use --no-db to skip them).
+"""
+import asyncio
+import datetime
+import json
+import random
+import time
+import typer
+
+from papp.main import app
+from papp.results import encode_result
+from papp.utils import QUERY_START, QUERY_SUCCESS
+
+app_cli = typer.Typer()
+
+# job ids used by the benchmark, far away from the ones procrastinate hands out
+FIRST_JOB_ID = 2_000_000_000
+
+LEGACY_QUERY_START = (
+    "INSERT INTO job_results (job_id, task_name, status, updated_at) "
+    "VALUES (:job_id, :task_name, 'RUNNING', NOW()) "
+    "ON CONFLICT (job_id) DO UPDATE SET status = 'RUNNING', updated_at = NOW()"
+)
+LEGACY_QUERY_SUCCESS = (
+    "UPDATE job_results SET status = 'COMPLETED', result = :result, "
+    "error_message = NULL, updated_at = NOW() WHERE job_id = :job_id"
+)
+
+
+def legacy_render_query(query_template, **params):
+    """The previous `papp.utils.render_query`"""
+    from sqlalchemy import text
+    from sqlalchemy.dialects import postgresql
+
+    query = text(query_template).bindparams(**params)
+    compiled_query = query.compile(
+        dialect=postgresql.dialect(),
+        compile_kwargs={"literal_binds": True}
+    )
+    return str(compiled_query)
+
+
+def make_result(job_id: int) -> dict:
+    """Same shape as asum_with_persistence's results"""
+    return {"result": job_id * 2,
+            "job_id": job_id,
+            "long_string": "x"*random.randint(100, 2500)}
+
+
+def legacy_queries(job_id: int, result: dict) -> list[tuple[str, dict]]:
+    return [
+        (legacy_render_query(LEGACY_QUERY_START, job_id=job_id, task_name="bench"), {}),
+        (legacy_render_query(LEGACY_QUERY_SUCCESS, result=json.dumps(result), job_id=job_id), {}),
+    ]
+
+
+def bound_queries(job_id: int, result: dict) -> list[tuple[str, dict]]:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    run = {"job_id": job_id, "task_name": "bench", "worker_name": "bench", "attempt": 1, "started_at": now}
+    return [
+        (QUERY_START, run),
+        (QUERY_SUCCESS, {**run, **encode_result(result), "finished_at": now, "duration_ms": 0.0, "execution_ms": 0.0}),
+    ]
+
+
+def report(label: str, jobs: int, elapsed: float):
+    print(f"{label:<40} {elapsed / jobs * 1e6:10.1f} us/job  ({jobs / elapsed:8.0f} jobs/s)")
+
+
+async def run_against_db(jobs: int, results: list[dict]):
+    async with app.open_async():
+        connector = app.connector
+        for label, build in (("legacy: literal SQL (SQLAlchemy)", legacy_queries),
+                             ("current: bound parameters", bound_queries)):
+            await connector.execute_query_async(
+                "DELETE FROM job_results WHERE job_id >= %(first)s", first=FIRST_JOB_ID
+            )
+            start = time.perf_counter()
+            for n in range(jobs):
+                job_id = FIRST_JOB_ID + n
+                for query, params in build(job_id, results[n]):
+                    await connector.execute_query_async(query, **params)
+            report(f"{label}, with DB", jobs, time.perf_counter() - start)
+        await connector.execute_query_async(
+            "DELETE FROM job_results WHERE job_id >= %(first)s", first=FIRST_JOB_ID
+        )
+        await connector.execute_query_async("DELETE FROM job_results_rollup WHERE task_name = 'bench'")
+
+
+@app_cli.command()
+def main(
+    jobs: int = typer.Option(2000, help="Number of simulated jobs"),
+    db: bool = typer.Option(True, help="Also measure the round trips against the database"),
+):
+    results = [make_result(n) for n in range(jobs)]
+
+    print(f"Per-job middleware overhead over {jobs} jobs (2 statements per job)")
+    for label, build in (("legacy: literal SQL (SQLAlchemy)", legacy_queries),
+                         ("current: bound parameters", bound_queries)):
+        start = time.perf_counter()
+        for n in range(jobs):
+            build(FIRST_JOB_ID + n, results[n])
+        report(f"{label}, client side", jobs, time.perf_counter() - start)
+
+    if db:
+        asyncio.run(run_against_db(jobs, results))
+
+
+if __name__ == "__main__":
+    app_cli()
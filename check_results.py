@@ -1,12 +1,21 @@
 import os
+import sys
+import contextlib
+import csv
 import json
+from pathlib import Path
 import psycopg
 from psycopg import sql
 from dotenv import load_dotenv
 from tabulate import tabulate
 import datetime
+import time
 import typer
 
+from papp.metrics import merge_rows
+from papp.shards import shard_index, shard_pgconfigs
+from papp.store import results_pgconfig
+
 app_cli = typer.Typer()
 
 # Load environment variables from .env file
@@ -20,6 +29,12 @@ pgconfig = {
     "password": os.environ.get("DB_PASSWORD", "postgres"),
     "dbname": os.environ.get("DB_NAME", None),
 }
+# with DB_SHARDS, the detailed reports are the ones of shard SHARD; the totals cover every shard
+shard_configs = shard_pgconfigs(pgconfig)
+shard = shard_index(len(shard_configs))
+pgconfig = shard_configs[shard]
+# job_results and its rollups/histograms live in the result store's database (see papp/store.py)
+results_config = results_pgconfig(pgconfig)
 
 def run_and_print_query(conn, title, query_sql, params=None):
     """Executes a query and prints the results in a formatted table."""
@@ -44,62 +59,352 @@ def run_and_print_query(conn, title, query_sql, params=None):
         except psycopg.Error as e:
             print(f"An error occurred: {e}")
 
+# --- Reports from the per-minute rollups (job_results_rollup, see papp/rollup.py) ---
+# They cost the same whatever the number of jobs. Rollups count runs: a retried
+# job counts one FAILED run per failed attempt.
+ROLLUP_SUMMARY_SQL = """
+    SELECT
+        SUM(jobs) AS total_runs,
+        status,
+        MIN(minute) AS first_minute,
+        MAX(minute) + INTERVAL '1 minute' AS last_minute,
+        SUM(duration_ms_sum) / NULLIF(SUM(jobs), 0) AS avg_duration_ms,
+        MAX(duration_ms_max) AS max_duration_ms
+    FROM job_results_rollup
+    WHERE worker_name LIKE %s
+    GROUP BY status;
+"""
+
+ROLLUP_PER_WORKER_SQL = """
+    SELECT
+        worker_name,
+        SUM(jobs) FILTER (WHERE status = 'COMPLETED') AS jobs_completed,
+        SUM(jobs) FILTER (WHERE status = 'FAILED') AS runs_failed,
+        -- over the minutes between the worker's first and last run (both included)
+        SUM(jobs) FILTER (WHERE status = 'COMPLETED')
+            / (EXTRACT(EPOCH FROM (MAX(minute) - MIN(minute))) / 60.0 + 1) AS jobs_per_minute,
+        SUM(duration_ms_sum) / NULLIF(SUM(jobs), 0) AS avg_duration_ms,
+        MAX(duration_ms_max) AS max_duration_ms
+    FROM job_results_rollup
+    WHERE worker_name LIKE %s
+    GROUP BY worker_name
+    ORDER BY jobs_completed DESC NULLS LAST;
+"""
+
+ROLLUP_PER_MINUTE_SQL = """
+    SELECT
+        minute,
+        SUM(jobs) FILTER (WHERE status = 'COMPLETED') AS jobs_completed,
+        SUM(jobs) FILTER (WHERE status = 'FAILED') AS runs_failed,
+        COUNT(DISTINCT worker_name) AS workers,
+        SUM(duration_ms_sum) / NULLIF(SUM(jobs), 0) AS avg_duration_ms,
+        MAX(duration_ms_max) AS max_duration_ms
+    FROM job_results_rollup
+    WHERE worker_name LIKE %s AND minute >= LOCALTIMESTAMP - %s * INTERVAL '1 minute'
+    GROUP BY minute
+    ORDER BY minute DESC;
+"""
+
+
+# --- Run time percentiles from the workers' histograms (worker_metrics, see papp/metrics.py) ---
+# A few rows per worker every few seconds, whatever the number of jobs.
+HISTOGRAMS_SQL = """
+    SELECT task_name, metric, count, sum_ms, max_ms, buckets
+    FROM worker_metrics WHERE worker_name LIKE %s
+"""
+HISTOGRAM_PERCENTILES = (50, 90, 99, 99.9)
+
+
+def print_histogram_report(conn, like_prefix: str):
+    """Prints the percentiles of the merged worker histograms, per task and metric"""
+    with conn.cursor() as cur:
+        cur.execute(HISTOGRAMS_SQL, (like_prefix,))
+        print_histograms(cur.fetchall(), "Run time percentiles (ms) from worker histograms")
+
+
+def print_histograms(histogram_rows, title: str):
+    print("\n" + "="*80)
+    print(f"Executing Query: {title}")
+    print("="*80)
+    merged = merge_rows(histogram_rows)
+    if not merged:
+        print("Query returned no results.")
+        return
+    rows = [
+        [task_name, metric, histogram.count, histogram.sum_ms / histogram.count,
+         *(histogram.percentile(p) for p in HISTOGRAM_PERCENTILES), histogram.max_ms]
+        for (task_name, metric), histogram in sorted(merged.items())
+    ]
+    headers = ["task_name", "metric", "runs", "avg", *(f"p{p:g}" for p in HISTOGRAM_PERCENTILES), "max"]
+    print(tabulate(rows, headers=headers, tablefmt="psql", floatfmt=".1f"))
+
+
+# --- Totals over every shard (DB_SHARDS, see papp/shards.py) ---
+# The same rollups and histograms, read from each shard and added up here.
+SHARD_RUNS_SQL = """
+    SELECT status, SUM(jobs)::bigint, SUM(duration_ms_sum), MAX(duration_ms_max),
+           MIN(minute), MAX(minute) + INTERVAL '1 minute'
+    FROM job_results_rollup
+    WHERE worker_name LIKE %s
+    GROUP BY status
+    ORDER BY status
+"""
+SHARD_JOBS_SQL = "SELECT status, COUNT(*) FROM procrastinate_jobs GROUP BY status ORDER BY status"
+
+
+def print_shard_reports(like_prefix: str):
+    """Runs and jobs by shard and status with their totals, and the worker histograms merged over the shards"""
+    runs, jobs, histogram_rows = [], [], []
+    total_runs: dict[str, list] = {}
+    total_jobs: dict[str, int] = {}
+    read_results = []
+    for index, config in enumerate(shard_configs):
+        try:
+            with psycopg.connect(**config, autocommit=True) as conn:
+                for status, count in conn.execute(SHARD_JOBS_SQL).fetchall():
+                    jobs.append([index, status, count])
+                    total_jobs[status] = total_jobs.get(status, 0) + count
+            shard_results = results_pgconfig(config)
+            if shard_results in read_results:
+                continue # shards sharing a result store (RESULTS_DB_*): counted once
+            read_results.append(shard_results)
+            with psycopg.connect(**shard_results, autocommit=True) as conn:
+                for status, count, duration_ms_sum, max_ms, first, last in conn.execute(SHARD_RUNS_SQL, (like_prefix,)):
+                    runs.append([index, status, count, duration_ms_sum / count, max_ms, first, last])
+                    total = total_runs.setdefault(status, [0, 0.0, max_ms, first, last])
+                    total[0] += count
+                    total[1] += duration_ms_sum
+                    total[2], total[3], total[4] = max(total[2], max_ms), min(total[3], first), max(total[4], last)
+                histogram_rows.extend(conn.execute(HISTOGRAMS_SQL, (like_prefix,)).fetchall())
+        except psycopg.Error as e:
+            print(f"⚠️ Shard {index} ({config['host']}:{config['port']}) skipped: {e}")
+
+    print("\n" + "="*80)
+    print(f"Executing Query: Runs per shard, {len(shard_configs)} shards (rollups)")
+    print("="*80)
+    runs += [["all", status, count, duration_ms_sum / count, max_ms, first, last]
+             for status, (count, duration_ms_sum, max_ms, first, last) in sorted(total_runs.items())]
+    print(tabulate(runs, headers=["shard", "status", "total_runs", "avg_duration_ms", "max_duration_ms",
+                                  "first_minute", "last_minute"], tablefmt="psql"))
+    print("\n" + "="*80)
+    print(f"Executing Query: Jobs per shard, {len(shard_configs)} shards (procrastinate_jobs)")
+    print("="*80)
+    jobs += [["all", status, count] for status, count in sorted(total_jobs.items())]
+    print(tabulate(jobs, headers=["shard", "status", "jobs"], tablefmt="psql"))
+    print_histograms(histogram_rows, f"Run time percentiles (ms) from worker histograms, {len(shard_configs)} shards")
+    print(f"\nThe reports below are the ones of shard {shard} ({pgconfig['host']}:{pgconfig['port']}).")
+
+
+# --- Per-job latency decomposition (raw rows + procrastinate's events; needs --delete-jobs never) ---
+# For the last run of every finished job:
+#   queue_wait_ms  deferral (or retry schedule) -> fetch by a worker (procrastinate events)
+#   setup_ms       fetch -> task call, mostly the RUNNING write (middleware timings)
+#   execution_ms   the task itself (middleware timings)
+#   finish_ms      task end -> job marked succeeded/failed: result write and acknowledgement
+#   total_ms       first deferral -> end, retries included
+# finish_ms mixes the worker's clock and the database's: it assumes they are in sync.
+LATENCY_RUNS_SQL = """
+    WITH runs AS (
+        SELECT
+            r.task_name,
+            r.worker_name,
+            r.finished_at,
+            1000 * EXTRACT(EPOCH FROM ev.fetched_at - GREATEST(ev.enqueued_at, j.scheduled_at)) AS queue_wait_ms,
+            r.duration_ms - r.execution_ms AS setup_ms,
+            r.execution_ms,
+            1000 * EXTRACT(EPOCH FROM ev.ended_at - r.finished_at::timestamptz) AS finish_ms,
+            1000 * EXTRACT(EPOCH FROM ev.ended_at - ev.deferred_at) AS total_ms
+        FROM job_results r
+        JOIN procrastinate_jobs j ON j.id = r.job_id
+        CROSS JOIN LATERAL (
+            SELECT
+                MIN(at) FILTER (WHERE type = 'deferred') AS deferred_at,
+                MAX(at) FILTER (WHERE type IN ('deferred', 'deferred_for_retry')) AS enqueued_at,
+                MAX(at) FILTER (WHERE type = 'started') AS fetched_at,
+                MAX(at) FILTER (WHERE type IN ('succeeded', 'failed', 'cancelled', 'aborted')) AS ended_at
+            FROM procrastinate_events e WHERE e.job_id = r.job_id
+        ) ev
+        WHERE r.worker_name LIKE %(prefix)s AND r.status IN ('COMPLETED', 'FAILED') AND ev.ended_at IS NOT NULL
+    )
+"""
+LATENCY_COMPONENTS = ("queue_wait_ms", "setup_ms", "execution_ms", "finish_ms", "total_ms")
+
+
+def latency_percentiles_sql(group_by: str) -> str:
+    """p50/p90/p99/max of every latency component, per `group_by` column of the runs"""
+    columns = ",\n".join(
+        f"""        percentile_cont(0.5) WITHIN GROUP (ORDER BY {c}) AS {c}_p50,
+        percentile_cont(0.9) WITHIN GROUP (ORDER BY {c}) AS {c}_p90,
+        percentile_cont(0.99) WITHIN GROUP (ORDER BY {c}) AS {c}_p99,
+        MAX({c}) AS {c}_max"""
+        for c in LATENCY_COMPONENTS
+    )
+    return f"""{LATENCY_RUNS_SQL}
+    SELECT {group_by}, COUNT(1) AS jobs,
+{columns}
+    FROM runs GROUP BY {group_by} ORDER BY {group_by};
+"""
+
+
+LATENCY_OVER_TIME_SQL = f"""{LATENCY_RUNS_SQL}
+    SELECT
+        date_trunc('minute', finished_at) AS minute,
+        COUNT(1) AS jobs,
+        percentile_cont(0.5) WITHIN GROUP (ORDER BY queue_wait_ms) AS queue_wait_ms_p50,
+        percentile_cont(0.99) WITHIN GROUP (ORDER BY queue_wait_ms) AS queue_wait_ms_p99,
+        percentile_cont(0.5) WITHIN GROUP (ORDER BY execution_ms) AS execution_ms_p50,
+        percentile_cont(0.99) WITHIN GROUP (ORDER BY execution_ms) AS execution_ms_p99,
+        percentile_cont(0.5) WITHIN GROUP (ORDER BY finish_ms) AS finish_ms_p50,
+        percentile_cont(0.99) WITHIN GROUP (ORDER BY finish_ms) AS finish_ms_p99,
+        percentile_cont(0.5) WITHIN GROUP (ORDER BY total_ms) AS total_ms_p50,
+        percentile_cont(0.99) WITHIN GROUP (ORDER BY total_ms) AS total_ms_p99
+    FROM runs GROUP BY 1 ORDER BY 1;
+"""
+
+
+def latency_reports(conn, like_prefix: str, export_dir: Path | None):
+    """Prints the latency percentiles (per task, per worker, per minute) and exports them to `export_dir`"""
+    reports = {
+        "latency_by_task": ("Latency percentiles (ms) per task", latency_percentiles_sql("task_name")),
+        "latency_by_worker": ("Latency percentiles (ms) per worker", latency_percentiles_sql("worker_name")),
+        "latency_over_time": ("Latency percentiles (ms) per minute", LATENCY_OVER_TIME_SQL),
+    }
+    exported = {}
+    for name, (title, query_sql) in reports.items():
+        with conn.cursor() as cur:
+            cur.execute(query_sql, {"prefix": like_prefix})
+            headers = [desc[0] for desc in cur.description]
+            rows = cur.fetchall()
+        print("\n" + "="*80)
+        print(f"Executing Query: {title}")
+        print("="*80)
+        if not rows:
+            print("Query returned no results.")
+        elif name == "latency_over_time":
+            print(tabulate(rows, headers=headers, tablefmt="psql", floatfmt=".1f"))
+        else:
+            # one table per component, the wide rows do not fit a terminal
+            key = headers[0]
+            for component in LATENCY_COMPONENTS:
+                indexes = [headers.index(f"{component}_{stat}") for stat in ("p50", "p90", "p99", "max")]
+                print(f"\n{component}")
+                print(tabulate([[row[0], row[1], *(row[i] for i in indexes)] for row in rows],
+                               headers=[key, "jobs", "p50", "p90", "p99", "max"], tablefmt="psql", floatfmt=".1f"))
+        exported[name] = [dict(zip(headers, row)) for row in rows]
+        if export_dir is not None:
+            with open(export_dir / f"{name}.csv", "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(headers)
+                writer.writerows(rows)
+
+    if export_dir is not None:
+        with open(export_dir / "latency.json", "w") as f:
+            json.dump(exported, f, indent=2, default=str)
+        print(f"📁 Latency reports exported to {export_dir}")
+
+
+def print_raw_reports(conn, prefix, query_params):
+    """The reports computed from the raw job_results rows (slower as history grows)"""
+    # --- Query 1: Aggregation Query (with duration) ---
+    query1_sql = """
+        SELECT
+            COUNT(1) AS total_jobs,
+            status,
+            MIN(started_at) AS first_job_at,
+            MAX(finished_at) AS last_job_at,
+            MAX(finished_at) - MIN(started_at) AS duration,
+            AVG(duration_ms) AS avg_duration_ms
+        FROM job_results
+        WHERE worker_name LIKE %s
+        GROUP BY status;
+    """
+    run_and_print_query(conn, "Job Summary Aggregation", query1_sql, params=query_params)
+
+    # --- Query 3: Group by worker name to get completed job counts ---
+    query3_sql = """
+        SELECT
+            worker_name,
+            COUNT(1) AS jobs_completed,
+            -- Calculate jobs per minute, handling cases with zero duration to avoid division-by-zero errors.
+            COUNT(1) / NULLIF((EXTRACT(EPOCH FROM (MAX(finished_at) - MIN(started_at))) / 60.0), 0) AS jobs_per_minute,
+            AVG(duration_ms) AS avg_duration_ms
+        FROM job_results
+        WHERE worker_name LIKE %s
+        GROUP BY worker_name
+        ORDER BY jobs_completed DESC;
+    """
+    run_and_print_query(
+        conn,
+        f"Completed Jobs per Worker (prefix: '{prefix}')",
+        query3_sql,
+        params=query_params
+    )
+
+
 @app_cli.command()
 def main(
     prefix: str = typer.Option(
         "worker-", help="The prefix of the worker name to filter results by."
-    )
+    ),
+    raw: bool = typer.Option(False, help="Compute the reports from the raw job_results rows instead of the rollups"),
+    watch: float = typer.Option(0, help="Refresh the per-minute throughput every N seconds (Ctrl-C to stop)"),
+    minutes: int = typer.Option(15, help="Minutes of per-minute throughput to show"),
+    latency: bool = typer.Option(False, help="Also report latency percentiles (queue wait, execution, result write)"),
+    export_dir: Path = typer.Option(None, help="Export the latency reports as CSV/JSON to this directory (e.g. perf/<test_id>)"),
 ):
     """Main function to connect and query the database."""
     try:
-        with psycopg.connect(**pgconfig) as conn:
+        with (psycopg.connect(**pgconfig, autocommit=True) as conn,
+              contextlib.nullcontext(conn) if results_config == pgconfig
+              else psycopg.connect(**results_config, autocommit=True) as results_conn):
             print("Successfully connected to the database.")
-            query_params = (prefix,)
-
-            # --- Query 1: Aggregation Query (with duration) ---
-            query1_sql = """
-                SELECT
-                    COUNT(1) AS total_jobs,
-                    status,
-                    MIN(created_at) AS first_job_at,
-                    MAX(updated_at) AS last_job_at,
-                    MAX(updated_at) - MIN(created_at) AS duration
-                FROM job_results
-                WHERE STARTS_WITH(result ->> 'worker_name', %s)
-                GROUP BY status;
-            """
-            run_and_print_query(conn, "Job Summary Aggregation", query1_sql, params=query_params)
-
-            
-            # --- Query 3: Group by worker name to get completed job counts ---
-            query3_sql = """
-                SELECT
-                    result ->> 'worker_name' AS worker_name,
-                    COUNT(job_id) AS jobs_completed
-                FROM job_results
-                WHERE STARTS_WITH(result ->> 'worker_name', %s)
-                GROUP BY worker_name
-                ORDER BY jobs_completed DESC;
-            """
+            # worker_name LIKE 'prefix%' uses idx_job_results_worker_name (wildcards in the prefix are escaped)
+            like_prefix = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            query_params = (like_prefix,)
+            if len(shard_configs) > 1 and watch <= 0:
+                print_shard_reports(like_prefix)
+
+            if watch > 0:
+                try:
+                    while True:
+                        print("\033[2J\033[H", end="") # clear the terminal
+                        print(f"⏱️  {datetime.datetime.now():%H:%M:%S} - refreshing every {watch}s (Ctrl-C to stop)")
+                        run_and_print_query(results_conn, f"Runs per minute, last {minutes} minutes (prefix: '{prefix}')",
+                                            ROLLUP_PER_MINUTE_SQL, params=(like_prefix, minutes))
+                        run_and_print_query(results_conn, f"Runs per Worker (prefix: '{prefix}')",
+                                            ROLLUP_PER_WORKER_SQL, params=query_params)
+                        sys.stdout.flush()
+                        time.sleep(watch)
+                except KeyboardInterrupt:
+                    print("Stopped watching.")
+                return
 
-            query3_sql = """
-                SELECT
-                    result ->> 'worker_name' AS worker_name,
-                    COUNT(job_id) AS jobs_completed,
-                    -- Calculate jobs per minute, handling cases with zero duration to avoid division-by-zero errors.
-                    COUNT(job_id) / NULLIF((EXTRACT(EPOCH FROM (MAX(updated_at) - MIN(created_at))) / 60.0), 0) AS jobs_per_minute
-                FROM job_results
-                WHERE STARTS_WITH(result ->> 'worker_name', %s)
-                GROUP BY worker_name
-                ORDER BY jobs_completed DESC;
+            if raw:
+                print_raw_reports(results_conn, prefix, query_params)
+            else:
+                run_and_print_query(results_conn, "Run Summary Aggregation (rollups)", ROLLUP_SUMMARY_SQL,
+                                    params=query_params)
+                run_and_print_query(results_conn, f"Runs per Worker (prefix: '{prefix}')", ROLLUP_PER_WORKER_SQL,
+                                    params=query_params)
+                run_and_print_query(results_conn, f"Runs per minute, last {minutes} minutes (prefix: '{prefix}')",
+                                    ROLLUP_PER_MINUTE_SQL, params=(like_prefix, minutes))
+            print_histogram_report(results_conn, like_prefix)
+
+            if (latency or export_dir is not None) and results_conn is not conn:
+                # the decomposition joins job_results with procrastinate's tables
+                print("\nLatency report skipped: job_results is not in the queue's database.")
+            elif latency or export_dir is not None:
+                if export_dir is not None:
+                    export_dir.mkdir(parents=True, exist_ok=True)
+                latency_reports(conn, like_prefix, export_dir)
+
+            # In "completion" persistence mode job_results has no RUNNING rows:
+            # running jobs are the ones procrastinate marks as 'doing'
+            query_running_sql = """
+            SELECT task_name, count(1) AS running_jobs FROM public.procrastinate_jobs
+            WHERE status = 'doing' GROUP BY task_name
             """
-                        
-            run_and_print_query(
-                conn,
-                f"Completed Jobs per Worker (prefix: '{prefix}')",
-                query3_sql,
-                params=query_params
-            )
+            run_and_print_query(conn, "Jobs running right now", query_running_sql)
 
             query4_sql = """
             SELECT status, count(1) FROM public.procrastinate_jobs
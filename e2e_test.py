@@ -4,6 +4,8 @@ import sys
 import time
 from pathlib import Path
 
+from papp.connections import CONNECTION_HEADROOM
+
 
 # ANSI color codes for prettier terminal output
 class BColors:
@@ -21,13 +23,33 @@ DB_CONNECTION_STRING = os.getenv("DB_CONNECTION_STRING", "")
 # Prefix for worker names and result tracking. A timestamp is added for uniqueness.
 PREFIX = f"w_{int(time.time())}_"
 
-# Parameters for the job orchestrator. TODO: Orchestrator velociy a bottleneck ATM :) 
+# Parameters for the job orchestrator
 MAX_JOBS = 100_000
 AVG_DURATION = 0.25
+BATCH_SIZE = 5_000 # jobs inserted per round trip (1 = one by one, the old and slow way)
+PRODUCERS = 4 # concurrent pipelined producers (0 = synchronous deferral)
+COALESCE_NOTIFY = False # one job notification per inserted chunk instead of two per job (see papp/notify.py)
+ENQUEUE_WHILE_RUNNING = False # generate most jobs while the workers run: job notifications then wake them up
 
 # Parameters for the workers
 NUM_WORKERS = 8
 CONCURRENCY = 5
+AUTOSCALE = False # scale between 1 and NUM_WORKERS workers on the backlog (see papp/autoscale.py)
+WAKEUP_JITTER_MS = 0 # workers look for new jobs a random 0..N ms after a job notification (0: at once)
+# Result persistence (see papp/tasks.py): "running" writes a RUNNING row then the outcome,
+# "completion" only the outcome, together with procrastinate's job completion
+PERSIST_MODE = "completion"
+RESULT_SINK = False # buffer job_results writes (papp/sink.py)
+RESULTS_PARTITION = "none" # partition job_results by job id ranges: "none" or "jobs"
+
+# Connections (see papp/connections.py)
+POOL_MAX_SIZE = 2 # pool size of every worker (supervisor.py lowers it to fit max_connections)
+PGBOUNCER = False # workers connect through a PgBouncer container, in transaction pooling mode
+PGBOUNCER_POOL_SIZE = 20 # postgres connections PgBouncer opens (shared by all the workers)
+
+# Sharding (see papp/shards.py): SHARDS postgres containers, on ports 5434, 5435...
+SHARDS = 1 # jobs are routed by orchestrator.py (round robin), NUM_WORKERS are split between one supervisor per shard
+STEAL = True # with SHARDS > 1: idle workers take jobs from the other shards
 
 # Postgres settings for the test
 POSTGRES_MAX_CONN = 50
@@ -38,12 +60,16 @@ pg_ram = ram_mb = int(POSTGRES_RAM.rstrip("g")) * 1024 # back of the envelope ca
 calculated_max_conn = ram_mb // 10 - 10  # 10 MB per connection, 10 conn always free
 
 print(f"{BColors.BOLD}Diagnostics (back-of-the-envelope): {BColors.ENDC}")
-if NUM_WORKERS * CONCURRENCY > POSTGRES_MAX_CONN:
+# C_total = N_w · (p_size + 1 LISTEN), or PgBouncer's pool and the supervisor's single LISTEN connection
+budget = POSTGRES_MAX_CONN - 3 - CONNECTION_HEADROOM # 3 superuser_reserved_connections
+# (per postgres instance: each shard has its share of the workers)
+required = PGBOUNCER_POOL_SIZE + 1 if PGBOUNCER else -(-NUM_WORKERS // SHARDS) * (POOL_MAX_SIZE + 1)
+if required > budget:
     print(
-        f"{BColors.WARNING}⚠️ You may experience issues with max_connections. "
-        f"Required={NUM_WORKERS * CONCURRENCY}, "
-        f"Configured={POSTGRES_MAX_CONN}. "
-        f"Reduce workers/concurrency or increase max_connections.{BColors.ENDC}"
+        f"{BColors.WARNING}⚠️ The workers may need more connections than the budget. "
+        f"Required={required}, "
+        f"Budget={budget} (max_connections={POSTGRES_MAX_CONN}). "
+        f"supervisor.py will lower the pool size, or refuse to start: use PgBouncer or increase max_connections.{BColors.ENDC}"
     )
 
 if calculated_max_conn < POSTGRES_MAX_CONN:
@@ -77,7 +103,8 @@ def start_monitoring(test_dir: Path, duration: int = 300) -> subprocess.Popen:
         monitor_script_path,
         "--output-dir", str(test_dir),
         "--duration", str(duration),
-        "--interval", "1"
+        "--interval", "1",
+        "--db-stats" # statements.csv, tables.csv, indexes.csv, db_stats.png
     ]
 
     print(f"{BColors.OKCYAN}▶️ Starting background monitoring... | Logging to {log_path}{BColors.ENDC}")
@@ -129,7 +156,7 @@ def print_header(message):
     print(f"{BColors.HEADER} {message}{BColors.ENDC}")
     print(f"{BColors.HEADER}--------------------------------------------------{BColors.ENDC}")
 
-def run_command(command, step_name, test_dir):
+def run_command(command, step_name, test_dir, env=None):
     """Runs a shell command, logs stdout/stderr to file."""
     log_path = os.path.join(test_dir, f"{step_name.replace(' ', '_')}.log")
     print(f"{BColors.OKCYAN}▶️ Executing: {' '.join(command)} | Logging to {log_path}{BColors.ENDC}")
@@ -140,7 +167,8 @@ def run_command(command, step_name, test_dir):
                 check=True,
                 text=True,
                 stdout=log_file,
-                stderr=subprocess.STDOUT
+                stderr=subprocess.STDOUT,
+                env=env,
             )
         if result.stdout:
             print(result.stdout)
@@ -152,68 +180,155 @@ def run_command(command, step_name, test_dir):
         sys.exit(1)
 
 
+def run_commands(commands, test_dir):
+    """Runs (command, step_name, env) tuples at the same time, like run_command"""
+    if len(commands) == 1:
+        return run_command(*commands[0][:2], test_dir=test_dir, env=commands[0][2])
+    processes = []
+    for command, step_name, env in commands:
+        log_path = os.path.join(test_dir, f"{step_name.replace(' ', '_')}.log")
+        print(f"{BColors.OKCYAN}▶️ Executing: {' '.join(command)} | Logging to {log_path}{BColors.ENDC}")
+        with open(log_path, "w") as log_file:
+            processes.append((step_name, log_path, subprocess.Popen(
+                command, text=True, stdout=log_file, stderr=subprocess.STDOUT, env=env,
+            )))
+    failed = [(step_name, log_path) for step_name, log_path, process in processes if process.wait() != 0]
+    for step_name, log_path in failed:
+        print(f"{BColors.FAIL}❌ Error during '{step_name}'. See {log_path}{BColors.ENDC}")
+    if failed:
+        sys.exit(1)
+
 
 def main():
     """Main function to orchestrate the end-to-end test."""
     
     
     test_id = f"jobs{MAX_JOBS}_dur{AVG_DURATION}_w{NUM_WORKERS}_c{CONCURRENCY}_conn{POSTGRES_MAX_CONN}"
+    if PGBOUNCER:
+        test_id += "_pgbouncer"
+    if SHARDS > 1:
+        if PGBOUNCER:
+            print(f"{BColors.FAIL}❌ SHARDS and PGBOUNCER don't combine: the workers of every shard would share one PgBouncer.{BColors.ENDC}")
+            sys.exit(1)
+        test_id += f"_shards{SHARDS}"
+    if ENQUEUE_WHILE_RUNNING:
+        test_id += "_live"
+    if COALESCE_NOTIFY:
+        test_id += "_coalesced"
     test_dir = os.path.join("perf", test_id)
     os.makedirs(test_dir, exist_ok=True)
     print(f"{BColors.BOLD}🚀 Starting End-to-End Test. Assigned id {test_id}, outputs to {test_dir=}...{BColors.ENDC}")
 
 
     print(f"Worker Prefix for this run: {BColors.OKBLUE}{PREFIX}{BColors.ENDC}")
+    # read by papp/tasks.py in every worker
+    os.environ["PERSIST_MODE"] = PERSIST_MODE
+    os.environ["RESULT_SINK"] = "1" if RESULT_SINK else "0"
+    os.environ["DB_POOL_MAX_SIZE"] = str(POOL_MAX_SIZE)
     # 2. Generate Jobs
     print_header("- Step 0: Init db")
-    run_command(
-        [
-            "docker", "rm", "-f", "pg-procrastinate"
-        ], 
-        "Remove old postgres",
-        test_dir=test_dir
-    )
+    run_command(["docker", "rm", "-f", "pgbouncer-procrastinate"], "Remove old pgbouncer", test_dir=test_dir)
+    # shard i is the pg-procrastinate[-i] container, on port 5434+i (DB_HOST for all)
+    containers = ["pg-procrastinate", *(f"pg-procrastinate-{i}" for i in range(1, SHARDS))]
+    for container in containers:
+        run_command(["docker", "rm", "-f", container], f"Remove old {container}", test_dir=test_dir)
     time.sleep(2)
-    run_command(
-        [
-            "docker", "run", "--name", "pg-procrastinate", "--detach", "--rm",
-            f"--cpus={POSTGRES_CPUS}", f"--memory={POSTGRES_RAM}",
-            "-p", "5434:5432",
-            "-e", "POSTGRES_PASSWORD=password", # TODO: read from .env
-            "postgres",
-            "postgres", "-c", f"max_connections={POSTGRES_MAX_CONN}"
-        ],
-        "Start postgres",
-        test_dir=test_dir
-    )
+    for i, container in enumerate(containers):
+        run_command(
+            [
+                "docker", "run", "--name", container, "--detach", "--rm",
+                f"--cpus={POSTGRES_CPUS}", f"--memory={POSTGRES_RAM}",
+                "-p", f"{5434 + i}:5432",
+                *(["-p", "6432:6432"] if i == 0 else []), # PgBouncer, which shares this container's network
+                "-e", "POSTGRES_PASSWORD=password", # TODO: read from .env
+                "postgres",
+                "postgres", "-c", f"max_connections={POSTGRES_MAX_CONN}",
+                "-c", "shared_preload_libraries=pg_stat_statements", # monitor.py --db-stats
+            ],
+            f"Start {container}",
+            test_dir=test_dir
+        )
+    if SHARDS > 1:
+        # read by every script below (monitor.py follows shard 0)
+        os.environ["DB_SHARDS"] = ",".join(f":{5434 + i}" for i in range(SHARDS))
     time.sleep(3) # wait for postgres to be ready
-    run_command(["python", "init_db.py"], "Create tracking table and init db", test_dir=test_dir)
-    # TODO: don't fail if already initialized
-    run_command(["procrastinate", "-vv", "--app=papp.main.app", "schema", "--apply"], "Init App", test_dir=test_dir)
+    if PGBOUNCER:
+        run_command(
+            [
+                "docker", "run", "--name", "pgbouncer-procrastinate", "--detach", "--rm",
+                "--network", "container:pg-procrastinate",
+                "-e", "DB_HOST=127.0.0.1", "-e", "DB_PORT=5432",
+                "-e", "DB_USER=postgres", "-e", "DB_PASSWORD=password",
+                "-e", "AUTH_TYPE=scram-sha-256", "-e", "LISTEN_PORT=6432",
+                "-e", "POOL_MODE=transaction",
+                "-e", f"DEFAULT_POOL_SIZE={PGBOUNCER_POOL_SIZE}", "-e", "MAX_CLIENT_CONN=10000",
+                "edoburu/pgbouncer",
+            ],
+            "Start pgbouncer",
+            test_dir=test_dir
+        )
+        time.sleep(2)
+    for i in range(SHARDS):
+        shard_env = {**os.environ, "SHARD": str(i)}
+        suffix = f" shard {i}" if SHARDS > 1 else ""
+        run_command(["python", "init_db.py", "--partition", RESULTS_PARTITION], f"Create tracking table and init db{suffix}",
+                    test_dir=test_dir, env=shard_env)
+        # TODO: don't fail if already initialized
+        run_command(["procrastinate", "-vv", "--app=papp.main.app", "schema", "--apply"], f"Init App{suffix}",
+                    test_dir=test_dir, env=shard_env)
+        if COALESCE_NOTIFY:
+            run_command(["python", "init_db.py", "--coalesce-notify"], f"Install coalesced notifications{suffix}",
+                        test_dir=test_dir, env=shard_env)
+    # read by monitor.py --db-stats, in the database it follows (shard 0)
+    run_command(["docker", "exec", "pg-procrastinate", "psql", "-U", "postgres", "-d", os.environ.get("DB_NAME", "postgres"),
+                 "-c", "CREATE EXTENSION IF NOT EXISTS pg_stat_statements"], "Create pg_stat_statements", test_dir=test_dir)
 
 
     # 2. Generate Jobs
     print_header("📊 Step 1: Generating Jobs")
-    orchestrator_cmd = [
-        "python", "orchestrator.py",
-        "--max-jobs", str(MAX_JOBS),
-        "--avg-duration", str(AVG_DURATION)
-    ]
-    # TODO: this step is slow with 100k jobs. Consider inserting them in batch
-    run_command(orchestrator_cmd, "Job Generation", test_dir=test_dir)
-    print(f"{BColors.OKGREEN}✅ Job generation complete.{BColors.ENDC}")
+    def orchestrator_cmd(max_jobs):
+        return [
+            "python", "orchestrator.py",
+            "--max-jobs", str(max_jobs),
+            "--avg-duration", str(AVG_DURATION),
+            "--batch-size", str(BATCH_SIZE),
+            "--producers", str(PRODUCERS),
+            *(["--coalesce-notify"] if COALESCE_NOTIFY else []),
+        ]
+    # with ENQUEUE_WHILE_RUNNING, a head start only: workers without --wait stop on an empty queue
+    head_jobs = min(MAX_JOBS, BATCH_SIZE * max(1, PRODUCERS)) if ENQUEUE_WHILE_RUNNING else MAX_JOBS
+    run_command(orchestrator_cmd(head_jobs), "Job Generation", test_dir=test_dir)
+    print(f"{BColors.OKGREEN}✅ Job generation complete{f' ({head_jobs} jobs before the workers)' if ENQUEUE_WHILE_RUNNING else ''}.{BColors.ENDC}")
 
     # 3. Run Workers
     print_header("⚙️ Step 2: Monitoring & Consuming Jobs with Workers")
     monitor_proc = start_monitoring(test_dir, duration=600)
 
-    workers_cmd = [
-        "./run_workers.sh",
-        str(NUM_WORKERS),
-        PREFIX,
-        str(CONCURRENCY)
-    ]
-    run_command(workers_cmd, "Worker Execution", test_dir=test_dir)
+    # forked from a single process that imported the app once (see supervisor.py), one per shard
+    supervisors = []
+    for i in range(SHARDS):
+        shard_workers = len(range(i, NUM_WORKERS, SHARDS))
+        workers_cmd = [
+            "python", "supervisor.py",
+            "--workers", str(shard_workers),
+            "--prefix", PREFIX if SHARDS == 1 else f"{PREFIX}s{i}_",
+            "--concurrency", str(CONCURRENCY)
+        ]
+        if AUTOSCALE:
+            workers_cmd += ["--autoscale", "--min-workers", "1", "--max-workers", str(shard_workers)]
+        if SHARDS > 1 and STEAL:
+            workers_cmd.append("--steal")
+        if WAKEUP_JITTER_MS:
+            workers_cmd += ["--wakeup-jitter-ms", str(WAKEUP_JITTER_MS)]
+        workers_env = {**os.environ, "SHARD": str(i)}
+        if PGBOUNCER:
+            # the pools go through PgBouncer, the supervisor's LISTEN connection straight to postgres
+            workers_env.update({"DB_PORT": "6432", "DB_PGBOUNCER": "1", "DB_LISTEN_PORT": "5434"})
+        supervisors.append((workers_cmd, f"Worker Execution{f' shard {i}' if SHARDS > 1 else ''}", workers_env))
+    if head_jobs < MAX_JOBS:
+        # the rest is inserted while the workers run (orchestrator.py routes it over the shards)
+        supervisors.append((orchestrator_cmd(MAX_JOBS - head_jobs), "Job Generation while running", None))
+    run_commands(supervisors, test_dir=test_dir)
     print(f"{BColors.OKGREEN}✅ Job consumption complete.{BColors.ENDC}")
     if monitor_proc:
         stop_monitoring(monitor_proc)
@@ -222,11 +337,12 @@ def main():
     print_header("🔍 Step 3: Checking Test Results")
     results_cmd = [
         "python", "check_results.py",
-        "--prefix", PREFIX
+        "--prefix", PREFIX,
+        "--export-dir", test_dir # latency percentiles as CSV/JSON
     ]
     run_command(results_cmd, "Result Check", test_dir=test_dir)
     
-    print_header(f"{BColors.OKGREEN}Test Settings: {MAX_JOBS=}, {AVG_DURATION=}, {NUM_WORKERS=},  {CONCURRENCY=}, {POSTGRES_MAX_CONN=}!{BColors.ENDC}")
+    print_header(f"{BColors.OKGREEN}Test Settings: {MAX_JOBS=}, {AVG_DURATION=}, {NUM_WORKERS=},  {CONCURRENCY=}, {POSTGRES_MAX_CONN=}, {PGBOUNCER=}, {SHARDS=}, {COALESCE_NOTIFY=}, {ENQUEUE_WHILE_RUNNING=}, {PERSIST_MODE=}, {RESULT_SINK=}!{BColors.ENDC}")
     print_header(f"{BColors.OKGREEN}🎉 Test Run Finished Successfully!{BColors.ENDC}")
 
 
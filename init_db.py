@@ -2,36 +2,156 @@
 import os
 from dotenv import load_dotenv
 import psycopg
+import typer
+
+from papp import notify, partitions
+from papp.shards import shard_index, shard_pgconfigs
+from papp.store import results_pgconfig
+
+app_cli = typer.Typer()
 
 load_dotenv()
 
 # Database configuration
 pgconfig = {"host": os.environ["DB_HOST"], "port": os.environ["DB_PORT"], "user": os.environ["DB_USER"], "password": os.environ["DB_PASSWORD"], "dbname": os.environ.get("DB_NAME", "postgres")}
-pg_config_default = pgconfig.copy()
-pg_config_default["dbname"] = "postgres"
+# with DB_SHARDS, the shard SHARD (run it once per shard, see papp/shards.py)
+shard_configs = shard_pgconfigs(pgconfig)
+pgconfig = shard_configs[shard_index(len(shard_configs))]
+# the result tables go to the result store's database (RESULTS_DB_*, the queue's by default, see papp/store.py)
+queue_pgconfig, pgconfig = pgconfig, results_pgconfig(pgconfig)
 
 # SQL for creating the results table
-CREATE_RESULTS_TABLE = """
+DROP_RESULTS_TABLES = """
 DROP TABLE IF EXISTS job_results;
+DROP TABLE IF EXISTS job_result_blobs;
+DROP TABLE IF EXISTS job_results_rollup;
+DROP TABLE IF EXISTS worker_metrics;
+"""
+
+CREATE_RESULTS_TABLE = """
 CREATE TABLE IF NOT EXISTS job_results (
-    job_id INTEGER PRIMARY KEY,
+    job_id BIGINT NOT NULL,
     task_name VARCHAR(255) NOT NULL,
     status VARCHAR(50) NOT NULL,
     result JSONB,
     error_message TEXT,
-    created_at TIMESTAMP DEFAULT NOW(),
-    updated_at TIMESTAMP DEFAULT NOW()
-);
+    worker_name VARCHAR(255),
+    attempt INTEGER,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    duration_ms DOUBLE PRECISION,
+    execution_ms DOUBLE PRECISION,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (job_id)
+){partition_by};
 CREATE INDEX IF NOT EXISTS idx_job_results_task_name ON job_results(task_name);
 CREATE INDEX IF NOT EXISTS idx_job_results_status ON job_results(status);
+-- worker name prefix filters (LIKE 'prefix%'); the per-worker reports of check_results.py
+-- read the included columns only, so they run as index-only scans
+CREATE INDEX IF NOT EXISTS idx_job_results_worker_name ON job_results(worker_name text_pattern_ops)
+    INCLUDE (status, started_at, finished_at, duration_ms);
+
+-- large results, compressed by the workers (see papp/results.py); append-only
+CREATE TABLE IF NOT EXISTS job_result_blobs (
+    job_id BIGINT NOT NULL,
+    codec VARCHAR(16) NOT NULL,
+    raw_size INTEGER NOT NULL,
+    data BYTEA NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (job_id, created_at)
+){partition_by};
+-- already compressed: store out of line without trying pglz again
+ALTER TABLE job_result_blobs ALTER COLUMN data SET STORAGE EXTERNAL;
+
+-- runs per minute, maintained by the workers along with job_results (see papp/rollup.py)
+CREATE TABLE IF NOT EXISTS job_results_rollup (
+    minute TIMESTAMP NOT NULL,
+    task_name VARCHAR(255) NOT NULL,
+    worker_name VARCHAR(255) NOT NULL,
+    status VARCHAR(50) NOT NULL,
+    jobs BIGINT NOT NULL,
+    duration_ms_sum DOUBLE PRECISION NOT NULL,
+    duration_ms_max DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (minute, task_name, worker_name, status)
+);
+
+-- latency histograms flushed by each worker every few seconds (see papp/metrics.py)
+CREATE TABLE IF NOT EXISTS worker_metrics (
+    id BIGSERIAL PRIMARY KEY,
+    worker_name VARCHAR(255) NOT NULL,
+    task_name VARCHAR(255) NOT NULL,
+    metric VARCHAR(50) NOT NULL,
+    period_start TIMESTAMPTZ NOT NULL,
+    period_end TIMESTAMPTZ NOT NULL,
+    count BIGINT NOT NULL,
+    sum_ms DOUBLE PRECISION NOT NULL,
+    max_ms DOUBLE PRECISION NOT NULL,
+    buckets JSONB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_worker_metrics_period_end ON worker_metrics(period_end);
+"""
+
+# Partitioned schema (see papp/partitions.py): rows beyond the partitions land in the default ones
+CREATE_DEFAULT_PARTITIONS = """
+CREATE TABLE IF NOT EXISTS job_results_default PARTITION OF job_results DEFAULT;
+CREATE TABLE IF NOT EXISTS job_result_blobs_default PARTITION OF job_result_blobs DEFAULT;
 """
 
+# Coalesced job notifications (see papp/notify.py): procrastinate_notify_queue_job_inserted_v1,
+# muted by notify.COALESCE_SETTING, and the defer function that mutes it. Needs procrastinate's schema.
+CREATE_COALESCED_NOTIFY = f"""
+CREATE OR REPLACE FUNCTION procrastinate_notify_queue_job_inserted_v1()
+    RETURNS trigger
+    LANGUAGE plpgsql
+AS $$
+DECLARE
+    payload TEXT;
+BEGIN
+    IF current_setting('{notify.COALESCE_SETTING}', true) = 'on' THEN
+        RETURN NEW;
+    END IF;
+    SELECT json_build_object('type', 'job_inserted', 'job_id', NEW.id)::text INTO payload;
+    PERFORM pg_notify('procrastinate_queue_v1#' || NEW.queue_name, payload);
+    PERFORM pg_notify('procrastinate_any_queue_v1', payload);
+    RETURN NEW;
+END;
+$$;
 
-def create_database_if_not_exists():
+CREATE OR REPLACE FUNCTION papp_defer_jobs_coalesced(jobs procrastinate_job_to_defer_v1[])
+    RETURNS bigint[]
+    LANGUAGE plpgsql
+AS $$
+DECLARE
+    job_ids bigint[];
+    queue varchar;
+BEGIN
+    PERFORM set_config('{notify.COALESCE_SETTING}', 'on', true);
+    job_ids := procrastinate_defer_jobs_v1(jobs);
+    PERFORM set_config('{notify.COALESCE_SETTING}', 'off', true);
+    FOR queue IN SELECT DISTINCT job.queue_name FROM unnest(jobs) AS job LOOP
+        PERFORM pg_notify('procrastinate_queue_v1#' || queue,
+                          json_build_object('type', 'job_inserted', 'job_id', job_ids[1])::text);
+    END LOOP;
+    PERFORM pg_notify('procrastinate_any_queue_v1', json_build_object('type', 'job_inserted', 'job_id', job_ids[1])::text);
+    RETURN job_ids;
+END;
+$$;
+"""
+
+# the last job id procrastinate handed out, if its schema is already applied
+QUERY_LAST_JOB_ID = """
+SELECT CASE WHEN to_regclass('procrastinate_jobs_id_seq') IS NOT NULL
+            THEN (SELECT last_value FROM procrastinate_jobs_id_seq) ELSE 0 END
+"""
+
+
+def create_database_if_not_exists(pgconfig: dict):
     """Ensure database exists, creating it if necessary"""
     db_name = pgconfig['dbname']
     if pgconfig['dbname'] == 'postgres':
         return  # Don't try to create the default db
+    pg_config_default = {**pgconfig, "dbname": "postgres"}
     with psycopg.connect(**pg_config_default, autocommit=True) as conn:
         with conn.cursor() as cur:
             cur.execute("SELECT 1 FROM pg_database WHERE datname = %s;", (db_name,))
@@ -46,13 +166,28 @@ def create_database_if_not_exists():
             else:
                 print(f"Database {db_name} already exists.")
 
-def setup_database():
+def last_job_id() -> int:
+    """The queue's last job id, where the first job_results partition starts"""
+    with psycopg.connect(**queue_pgconfig) as conn:
+        return conn.execute(QUERY_LAST_JOB_ID).fetchone()[0]
+
+def setup_database(partition: str = "none", partition_size: int = partitions.DEFAULT_SIZE):
     """Initialize the database schema and show max connections."""
-    print("Setting up database schema for job persistence...")
+    print(f"Setting up database schema for job persistence (partitioning: {partition})...")
+    first_job_id = last_job_id() if partition != "none" else 0
     with psycopg.connect(**pgconfig) as conn:
         with conn.cursor() as cur:
             # Setup the table
-            cur.execute(CREATE_RESULTS_TABLE)
+            cur.execute(DROP_RESULTS_TABLES)
+            if partition == "none":
+                cur.execute(CREATE_RESULTS_TABLE.format(partition_by=""))
+            else:
+                cur.execute(CREATE_RESULTS_TABLE.format(partition_by=" PARTITION BY RANGE (job_id)"))
+                cur.execute(CREATE_DEFAULT_PARTITIONS)
+                statements = partitions.create_statements(partition_size, first_job_id)
+                for statement in statements:
+                    cur.execute(statement)
+                print(f"Created {len(statements)} partitions of {partition_size} job ids 🗂️")
             
             
             # Query the server for the max_connections setting
@@ -67,6 +202,31 @@ def setup_database():
             print("Database schema setup complete.")
             conn.commit()
 
+def setup_coalesced_notify():
+    """Install the coalesced job notifications in the queue's database."""
+    with psycopg.connect(**queue_pgconfig, autocommit=True) as conn:
+        if conn.execute("SELECT to_regtype('procrastinate_job_to_defer_v1')").fetchone()[0] is None:
+            raise typer.BadParameter("apply procrastinate's schema first", param_hint="--coalesce-notify")
+        conn.execute(CREATE_COALESCED_NOTIFY)
+    print("Coalesced job notifications installed 📣")
+
+@app_cli.command()
+def main(
+    partition: str = typer.Option("none", help="Partition job_results by job id ranges: none or jobs"),
+    partition_size: int = typer.Option(partitions.DEFAULT_SIZE, help="Job ids per partition (with --partition jobs)"),
+    coalesce_notify: bool = typer.Option(False, help="Only install the coalesced job notifications of orchestrator.py --coalesce-notify (after procrastinate schema --apply)"),
+):
+    if coalesce_notify:
+        setup_coalesced_notify()
+        return
+    if partition not in ("none", "jobs"):
+        raise typer.BadParameter(f"partition must be none or jobs, got {partition!r}")
+    if partition_size <= 0:
+        raise typer.BadParameter(f"partition-size must be > 0, got {partition_size}")
+    create_database_if_not_exists(queue_pgconfig)
+    if pgconfig != queue_pgconfig:
+        create_database_if_not_exists(pgconfig)
+    setup_database(partition, partition_size)
+
 if __name__ == "__main__":
-    create_database_if_not_exists()
-    setup_database()
\ No newline at end of file
+    app_cli()
@@ -1,6 +1,10 @@
 import os
 import time
 import csv
+import math
+import asyncio
+import threading
+import collections
 from pathlib import Path
 from datetime import datetime
 import signal
@@ -12,6 +16,9 @@ import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from dotenv import load_dotenv
 
+from papp.metrics import merge_rows
+from papp.store import results_pgconfig
+
 load_dotenv()
 # --- Database Connection Details ---
 # Loaded from environment variables.
@@ -35,27 +42,105 @@ SELECT
 FROM pg_stat_activity;
 """
 
-app = typer.Typer()
+# --- Run time histograms flushed by the workers (see papp/metrics.py) ---
+# Merged over a sliding window: workers flush every few seconds, more rarely than we poll.
+HISTOGRAMS_QUERY = """
+SELECT task_name, metric, count, sum_ms, max_ms, buckets
+FROM worker_metrics WHERE period_end > NOW() - make_interval(secs => %s);
+"""
+HISTOGRAM_FIELDS = ["runs_per_s", "duration_p50_ms", "duration_p99_ms", "execution_p99_ms"]
+
+# --- Queue depth and drain rate (procrastinate tables) ---
+# Cheap at 1s sampling on a large table: the depth query counts at most `depth_cap`
+# todo/doing jobs (through the partial index procrastinate uses to fetch them), never
+# the succeeded/failed history, and flags the sample when it reached the cap; the
+# oldest todo job is the first entry of procrastinate's fetch index; transitions since
+# the last sample are a primary key range of procrastinate_events.
+QUEUE_DEPTH_QUERY = """
+SELECT queue_name,
+       COUNT(*) FILTER (WHERE status = 'todo') AS todo,
+       COUNT(*) FILTER (WHERE status = 'doing') AS doing
+FROM (SELECT queue_name, status FROM procrastinate_jobs WHERE status IN ('todo', 'doing') LIMIT %s) AS jobs
+GROUP BY queue_name;
+"""
+# the next job the workers fetch, waiting since its latest (re)queue or its scheduled time
+OLDEST_TODO_QUERY = """
+SELECT EXTRACT(EPOCH FROM NOW() - GREATEST(jobs.scheduled_at, (
+    SELECT MAX(at) FROM procrastinate_events
+    WHERE job_id = jobs.id AND type IN ('deferred', 'deferred_for_retry', 'retried')
+)))
+FROM procrastinate_jobs AS jobs
+WHERE status = 'todo' AND (scheduled_at IS NULL OR scheduled_at <= NOW())
+ORDER BY priority DESC, id LIMIT 1;
+"""
+# Event ids are taken at insert time, but become visible at commit: ids skipped by
+# a sample (a transaction still in flight, e.g. a bulk defer) are read again at the
+# following ones, for LATE_EVENTS_SECONDS (then given up on: rolled back).
+EVENTS_SINCE_QUERY = """
+SELECT id, type FROM procrastinate_events WHERE id > %(last)s OR id = ANY(%(gaps)s);
+"""
+LATE_EVENTS_SECONDS = 30.0
+LAST_EVENT_QUERY = "SELECT COALESCE(MAX(id), 0) FROM procrastinate_events;"
+# once, at startup; the totals then follow the events
+JOB_STATUS_QUERY = "SELECT status, COUNT(*) FROM procrastinate_jobs GROUP BY status;"
+
+QUEUE_FIELDS = [
+    "jobs_todo", "jobs_doing", "depth_capped", "jobs_succeeded", "jobs_failed", "oldest_todo_s",
+    "deferred_interval", "completed_interval", "failed_interval", "retried_interval", "completed_per_s",
+]
+
+# --- Where the database time goes (`--db-stats`) ---
+# Cumulative counters, snapshotted at every sample; the CSVs hold the deltas.
+# pg_stat_statements needs `shared_preload_libraries=pg_stat_statements` and the
+# extension created in the database (see README).
+STATEMENTS_INSTALLED_QUERY = "SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements';"
+STATEMENTS_QUERY = """
+SELECT queryid, MIN(LEFT(regexp_replace(query, '\\s+', ' ', 'g'), 120)) AS query,
+       SUM(calls)::bigint AS calls, SUM(total_exec_time) AS total_ms, SUM(rows)::bigint AS rows
+FROM pg_stat_statements
+WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+GROUP BY queryid;
+"""
+TABLES_QUERY = """
+SELECT relname, n_tup_ins, n_tup_upd, n_tup_hot_upd, n_tup_del, autovacuum_count, autoanalyze_count,
+       n_live_tup, n_dead_tup
+FROM pg_stat_user_tables;
+"""
+INDEXES_QUERY = "SELECT indexrelname, relname, idx_scan, idx_tup_read, idx_tup_fetch FROM pg_stat_user_indexes;"
+
+STATEMENT_FIELDS = ["timestamp", "queryid", "query", "calls", "total_ms", "mean_ms", "rows"]
+TABLE_FIELDS = ["timestamp", "table", "inserts", "updates", "hot_updates", "hot_ratio", "deletes",
+                "autovacuums", "autoanalyzes", "live_tuples", "dead_tuples"]
+INDEX_FIELDS = ["timestamp", "index", "table", "scans", "tuples_read", "tuples_fetched"]
 
+# High-frequency sampling of pg_stat_activity, between the --interval samples
+HF_FIELDS = ["timestamp", "total_connections", "active_connections", "idle_connections",
+             "lock_waits", "waiting_connections"]
+#: maxima over each interval, from the high-frequency samples
+HF_MAX_FIELDS = ["active_connections_max", "lock_waits_max", "waiting_connections_max"]
+#: plots average (and take the maximum of `*_max` columns) over buckets beyond this many points
+MAX_PLOT_POINTS = 2000
+
+app = typer.Typer()
 
-def get_docker_stats(container):
-    """Fetches and calculates CPU and Memory usage for a Docker container."""
-    stats = container.stats(stream=False)
 
+def get_docker_stats(stats: dict):
+    """Calculates CPU and Memory usage from a frame of Docker's container stats."""
     # --- Memory Calculation ---
     mem_usage = stats.get("memory_stats", {}).get("usage", 0)
     mem_limit = stats.get("memory_stats", {}).get("limit", 1)
     mem_percent = (mem_usage / mem_limit) * 100 if mem_limit > 0 else 0
 
     # --- CPU Calculation (mimics `docker stats` command) ---
-    cpu_delta = stats["cpu_stats"]["cpu_usage"]["total_usage"] - stats["precpu_stats"]["cpu_usage"]["total_usage"]
-    system_cpu_delta = stats["cpu_stats"]["system_cpu_usage"] - stats["precpu_stats"]["system_cpu_usage"]
+    # the first frame of a stream has no previous sample (precpu_stats) yet
+    cpu_delta = stats["cpu_stats"]["cpu_usage"]["total_usage"] - stats["precpu_stats"].get("cpu_usage", {}).get("total_usage", 0)
+    system_cpu_delta = stats["cpu_stats"].get("system_cpu_usage", 0) - stats["precpu_stats"].get("system_cpu_usage", 0)
 
     percpu_usage_list = stats["cpu_stats"]["cpu_usage"].get("percpu_usage", [])
     num_cpus = stats["cpu_stats"].get("online_cpus", len(percpu_usage_list) or 1)
 
     cpu_percent = 0.0
-    if system_cpu_delta > 0.0 and cpu_delta > 0.0:
+    if stats["precpu_stats"].get("system_cpu_usage") and system_cpu_delta > 0.0 and cpu_delta > 0.0:
         cpu_percent = (cpu_delta / system_cpu_delta) * num_cpus * 100.0
 
     return {
@@ -65,15 +150,366 @@ def get_docker_stats(container):
     }
 
 
-def generate_plots(df: pd.DataFrame, output_dir: Path):
+class DockerStatsStream:
+    """
+    Latest CPU/memory usage of the container, from Docker's streaming stats
+    (one frame per second). A blocking `stats(stream=True)` call used to take
+    1-2s per sample: here a daemon thread consumes the stream instead.
+    """
+
+    def __init__(self, container):
+        self.container = container
+        self.latest = {"cpu_percent": None, "memory_percent": None, "memory_usage_mb": None}
+        self.stopped = False
+        self.thread = threading.Thread(target=self._consume, name="docker stats", daemon=True)
+        self.thread.start()
+
+    def _consume(self):
+        for frame in self.container.stats(stream=True, decode=True):
+            if self.stopped:
+                return
+            self.latest = get_docker_stats(frame)
+
+
+class SampleRing:
+    """
+    Ring buffer of the high-frequency samples: the last `size` ones stay in
+    memory (for the per-interval maxima), and `drain` returns the ones not
+    written yet. Samples overwritten before being drained are counted in `dropped`.
+    """
+
+    def __init__(self, size: int):
+        self.samples = collections.deque(maxlen=size)
+        self.appended = 0
+        self.drained = 0
+        self.dropped = 0
+
+    def append(self, sample: dict):
+        self.samples.append(sample)
+        self.appended += 1
+
+    def since(self, moment: float) -> list[dict]:
+        """The samples taken after `moment` (epoch seconds)"""
+        recent = []
+        for sample in reversed(self.samples):
+            if sample["t"] <= moment:
+                break
+            recent.append(sample)
+        return recent[::-1]
+
+    def drain(self) -> list[dict]:
+        pending = self.appended - self.drained
+        if pending > len(self.samples):
+            self.dropped += pending - len(self.samples)
+            pending = len(self.samples)
+        self.drained = self.appended
+        return list(self.samples)[len(self.samples) - pending:]
+
+
+async def ticks(period: float, stop: asyncio.Event):
+    """
+    Yields every `period` seconds, on a fixed schedule (no drift from the time
+    spent sampling), until `stop` is set. Ticks missed by a slow sample are skipped.
+    """
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time()
+    while not stop.is_set():
+        yield
+        next_tick += period
+        now = loop.time()
+        if next_tick < now:
+            next_tick = now + period - (now - next_tick) % period
+        try:
+            await asyncio.wait_for(stop.wait(), next_tick - now)
+        except asyncio.TimeoutError:
+            pass
+
+
+def timed_query(cursor, query: str) -> tuple[float, dict]:
+    """The first row of `query`, and the time it was taken (middle of the round trip, epoch seconds)"""
+    before = time.time()
+    cursor.execute(query)
+    row = dict(zip([desc[0] for desc in cursor.description], cursor.fetchone()))
+    return (before + time.time()) / 2, row
+
+
+def get_histogram_stats(cursor, window: float):
+    """Throughput and run time percentiles (all tasks) over the last `window` seconds"""
+    try:
+        cursor.execute(HISTOGRAMS_QUERY, (window,))
+        merged = merge_rows(cursor.fetchall())
+    except psycopg2.Error:
+        return dict.fromkeys(HISTOGRAM_FIELDS) # no worker_metrics table in this database
+    totals = {}
+    for (_, metric), histogram in merged.items():
+        if metric in totals:
+            totals[metric].merge(histogram)
+        else:
+            totals[metric] = histogram
+    duration, execution = totals.get("duration_ms"), totals.get("execution_ms")
+    return {
+        "runs_per_s": round(duration.count / window, 2) if duration else 0,
+        "duration_p50_ms": duration and duration.percentile(50),
+        "duration_p99_ms": duration and duration.percentile(99),
+        "execution_p99_ms": execution and execution.percentile(99),
+    }
+
+
+class QueueSampler:
+    """
+    Samples the queue depth (counting at most `depth_cap` jobs), and the job
+    transitions since the previous sample
+    """
+
+    def __init__(self, cursor, depth_cap: int):
+        self.cursor = cursor
+        self.depth_cap = depth_cap
+        cursor.execute(JOB_STATUS_QUERY)
+        self.totals = {status: count for status, count in cursor.fetchall()}
+        cursor.execute(LAST_EVENT_QUERY)
+        self.last_event_id = cursor.fetchone()[0]
+        #: event ids skipped so far, and when they were first missed
+        self.gaps: dict[int, float] = {}
+        self.last_sample = time.time()
+
+    def sample(self) -> tuple[dict, list[dict]]:
+        """The QUEUE_FIELDS, and the depth of every queue"""
+        self.cursor.execute(QUEUE_DEPTH_QUERY, (self.depth_cap,))
+        queues = [{"queue_name": name, "todo": todo, "doing": doing} for name, todo, doing in self.cursor.fetchall()]
+        self.cursor.execute(OLDEST_TODO_QUERY)
+        oldest_todo = (self.cursor.fetchone() or (None,))[0]
+
+        self.cursor.execute(EVENTS_SINCE_QUERY, {"last": self.last_event_id, "gaps": list(self.gaps)})
+        events = collections.Counter()
+        new_ids = set()
+        for event_id, event_type in self.cursor.fetchall():
+            events[event_type] += 1
+            if event_id > self.last_event_id:
+                new_ids.add(event_id)
+            else:
+                del self.gaps[event_id] # committed late
+        now = time.time()
+        if new_ids:
+            top = max(new_ids)
+            self.gaps.update((event_id, now) for event_id in range(self.last_event_id + 1, top) if event_id not in new_ids)
+            self.last_event_id = top
+        self.gaps = {event_id: missed for event_id, missed in self.gaps.items() if now - missed < LATE_EVENTS_SECONDS}
+        elapsed, self.last_sample = now - self.last_sample, now
+        for status in ("succeeded", "failed"):
+            self.totals[status] = self.totals.get(status, 0) + events.get(status, 0)
+
+        return {
+            "jobs_todo": sum(queue["todo"] for queue in queues),
+            "jobs_doing": sum(queue["doing"] for queue in queues),
+            # when set, the counts are lower bounds
+            "depth_capped": int(sum(queue["todo"] + queue["doing"] for queue in queues) >= self.depth_cap),
+            "jobs_succeeded": self.totals.get("succeeded", 0),
+            "jobs_failed": self.totals.get("failed", 0),
+            "oldest_todo_s": round(float(oldest_todo), 1) if oldest_todo is not None else 0,
+            "deferred_interval": events.get("deferred", 0),
+            "completed_interval": events.get("succeeded", 0),
+            "failed_interval": events.get("failed", 0),
+            "retried_interval": events.get("deferred_for_retry", 0),
+            "completed_per_s": round(events.get("succeeded", 0) / elapsed, 2) if elapsed > 0 else 0,
+        }, queues
+
+
+class DbStatsSampler:
+    """
+    Writes, at every sample, the per-interval deltas of pg_stat_statements
+    (statements.csv), pg_stat_user_tables (tables.csv) and pg_stat_user_indexes
+    (indexes.csv) to `output_dir`
+    """
+
+    def __init__(self, cursor, output_dir: Path):
+        self.cursor = cursor
+        self.statements = self._statements_available()
+        self.previous = {}
+        self.files = {}
+        self.writers = {}
+        for name, fields in (("statements", STATEMENT_FIELDS), ("tables", TABLE_FIELDS), ("indexes", INDEX_FIELDS)):
+            if name == "statements" and not self.statements:
+                continue
+            self.files[name] = open(output_dir / f"{name}.csv", 'w', newline='', encoding='utf-8')
+            self.writers[name] = csv.DictWriter(self.files[name], fieldnames=fields)
+            self.writers[name].writeheader()
+        self.sample(None) # the baseline of the deltas
+
+    def _statements_available(self) -> bool:
+        # the monitor only reads: creating the extension is left to the database owner
+        self.cursor.execute(STATEMENTS_INSTALLED_QUERY)
+        if self.cursor.fetchone() is None:
+            typer.secho("pg_stat_statements is not installed in this database, statements are not sampled. "
+                        "Start postgres with `-c shared_preload_libraries=pg_stat_statements`, then run "
+                        "`CREATE EXTENSION pg_stat_statements;` in it (see README).",
+                        fg=typer.colors.YELLOW, err=True)
+            return False
+        try:
+            self.cursor.execute("SELECT 1 FROM pg_stat_statements LIMIT 1;")
+            return True
+        except psycopg2.Error as e:
+            typer.secho(f"pg_stat_statements unavailable, statements are not sampled: {e}".strip(),
+                        fg=typer.colors.YELLOW, err=True)
+            return False
+
+    def _deltas(self, name: str, query: str, key_columns: int, gauges: tuple[str, ...] = ()) -> list[dict]:
+        """Rows of `query` minus their previous values (counters reset by a stats reset restart from 0)"""
+        self.cursor.execute(query)
+        columns = [desc[0] for desc in self.cursor.description]
+        current = {row[:key_columns]: dict(zip(columns, row)) for row in self.cursor.fetchall()}
+        previous, self.previous[name] = self.previous.get(name, {}), current
+        deltas = []
+        for key, row in current.items():
+            before = previous.get(key, {})
+            delta = dict(row)
+            for column, value in row.items():
+                if column in gauges or not isinstance(value, (int, float)) or columns.index(column) < key_columns:
+                    continue
+                delta[column] = value - before[column] if before and value >= before[column] else value
+            deltas.append(delta)
+        return deltas
+
+    def sample(self, timestamp: str | None):
+        """Records the deltas since the previous sample (just the baseline when `timestamp` is None)"""
+        statements = self._deltas("statements", STATEMENTS_QUERY, 1) if self.statements else []
+        tables = self._deltas("tables", TABLES_QUERY, 1, gauges=("n_live_tup", "n_dead_tup"))
+        indexes = self._deltas("indexes", INDEXES_QUERY, 2)
+        if timestamp is None:
+            return
+        if self.statements:
+            self.writers["statements"].writerows(
+                {"timestamp": timestamp, "queryid": row["queryid"], "query": row["query"], "calls": row["calls"],
+                 "total_ms": round(row["total_ms"], 3), "mean_ms": round(row["total_ms"] / row["calls"], 3),
+                 "rows": row["rows"]}
+                for row in statements if row["calls"]
+            )
+        self.writers["tables"].writerows(
+            {"timestamp": timestamp, "table": row["relname"], "inserts": row["n_tup_ins"],
+             "updates": row["n_tup_upd"], "hot_updates": row["n_tup_hot_upd"],
+             "hot_ratio": round(row["n_tup_hot_upd"] / row["n_tup_upd"], 3) if row["n_tup_upd"] else None,
+             "deletes": row["n_tup_del"], "autovacuums": row["autovacuum_count"],
+             "autoanalyzes": row["autoanalyze_count"], "live_tuples": row["n_live_tup"],
+             "dead_tuples": row["n_dead_tup"]}
+            for row in tables
+        )
+        self.writers["indexes"].writerows(
+            {"timestamp": timestamp, "index": row["indexrelname"], "table": row["relname"], "scans": row["idx_scan"],
+             "tuples_read": row["idx_tup_read"], "tuples_fetched": row["idx_tup_fetch"]}
+            for row in indexes if row["idx_scan"]
+        )
+        for file in self.files.values():
+            file.flush()
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+
+def generate_db_stats_report(output_dir: Path, top: int = 10):
+    """Prints the top statements by total time, saves them to statements_report.csv, and plots db_stats.png"""
+    statements_path, tables_path = output_dir / "statements.csv", output_dir / "tables.csv"
+    statements = pd.read_csv(statements_path) if statements_path.exists() else pd.DataFrame()
+    tables = pd.read_csv(tables_path) if tables_path.exists() else pd.DataFrame()
+    if statements.empty and tables.empty:
+        return
+
+    panels = 2
+    top_queries = []
+    if not statements.empty:
+        report = (statements.groupby("queryid")
+                  .agg(query=("query", "first"), calls=("calls", "sum"), total_ms=("total_ms", "sum"),
+                       rows=("rows", "sum"))
+                  .sort_values("total_ms", ascending=False))
+        report["mean_ms"] = report["total_ms"] / report["calls"]
+        report["share"] = report["total_ms"] / report["total_ms"].sum()
+        report.to_csv(output_dir / "statements_report.csv")
+        typer.echo(f"\n🔎 Top {top} statements by total time (statements_report.csv has them all):")
+        with pd.option_context("display.max_colwidth", 70, "display.width", 200):
+            typer.echo(report.head(top)[["calls", "total_ms", "mean_ms", "share", "query"]].to_string(
+                float_format=lambda value: f"{value:.2f}"))
+        top_queries = list(report.head(top).index)
+        panels = 3
+
+    output_path = output_dir / "db_stats.png"
+    typer.echo(f"📊 Generating plot at {output_path}")
+    fig, axes = plt.subplots(panels, 1, figsize=(15, 5 * panels), sharex=True)
+    fig.suptitle("Database Time and Table Churn", fontsize=16)
+    axis = iter(axes)
+
+    if top_queries:
+        ax = next(axis)
+        statements["timestamp"] = pd.to_datetime(statements["timestamp"])
+        for queryid in top_queries:
+            query = statements[statements["queryid"] == queryid]
+            label = query["query"].iloc[0][:60]
+            query = downsample(query.set_index("timestamp")[["total_ms"]])
+            ax.plot(query.index, query["total_ms"], label=label)
+        ax.set_ylabel("Execution time (ms per interval)")
+        ax.set_title(f"Top {len(top_queries)} Statements (pg_stat_statements)")
+        ax.grid(True, linestyle='--', alpha=0.6)
+        ax.legend(fontsize="small")
+        ax.set_ylim(bottom=0)
+
+    if not tables.empty:
+        tables["timestamp"] = pd.to_datetime(tables["timestamp"])
+        busy = tables.groupby("table")[["inserts", "updates", "deletes"]].sum().sum(axis=1)
+        busy = list(busy[busy > 0].index)
+        ax = next(axis)
+        for table in busy:
+            rows = downsample(tables[tables["table"] == table].set_index("timestamp")[["dead_tuples"]])
+            ax.plot(rows.index, rows["dead_tuples"], label=table)
+        ax.set_ylabel("Dead tuples")
+        ax.set_title("Dead Tuples per Table (pg_stat_user_tables)")
+        ax.grid(True, linestyle='--', alpha=0.6)
+        ax.legend(fontsize="small")
+        ax.set_ylim(bottom=0)
+
+        ax = next(axis)
+        for table in busy:
+            rows = tables[tables["table"] == table]
+            if rows["updates"].sum():
+                rows = downsample(rows.set_index("timestamp")[["hot_ratio"]])
+                ax.plot(rows.index, rows["hot_ratio"], label=table)
+        ax.set_ylabel("HOT updates / updates")
+        ax.set_title("HOT Update Ratio per Table")
+        ax.grid(True, linestyle='--', alpha=0.6)
+        ax.legend(fontsize="small")
+        ax.set_ylim(0, 1.05)
+
+    axes[-1].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
+    plt.xlabel("Time")
+    plt.xticks(rotation=45)
+    plt.tight_layout(rect=[0, 0, 1, 0.97])
+    plt.savefig(output_path)
+    plt.close()
+
+
+def downsample(df: pd.DataFrame, max_points: int = MAX_PLOT_POINTS) -> pd.DataFrame:
+    """
+    `df` (indexed by time) averaged over buckets so that it has about `max_points`
+    rows; `*_max` columns keep the maximum of their bucket
+    """
+    if len(df) <= max_points:
+        return df
+    span = (df.index.max() - df.index.min()).total_seconds()
+    bucket = f"{max(1, math.ceil(span / max_points))}s"
+    numeric = df.select_dtypes("number")
+    maxima = [column for column in numeric.columns if column.endswith("_max")]
+    resampled = numeric.resample(bucket).mean()
+    if maxima:
+        resampled[maxima] = numeric[maxima].resample(bucket).max()
+    return resampled.dropna(how="all")
+
+
+def generate_plots(df: pd.DataFrame, output_dir: Path, queues_df: pd.DataFrame | None = None):
     """Generates a summary plot of all collected metrics."""
     output_path = output_dir / "monitoring_summary.png"
     typer.echo(f"📊 Generating plot at {output_path}")
 
     df['timestamp'] = pd.to_datetime(df['timestamp'])
-    df = df.set_index('timestamp')
+    df = downsample(df.set_index('timestamp'))
 
-    fig, axes = plt.subplots(4, 1, figsize=(15, 20), sharex=True)
+    fig, axes = plt.subplots(7, 1, figsize=(15, 35), sharex=True)
     fig.suptitle("PostgreSQL Performance Monitoring", fontsize=16)
 
     # Plot 1: CPU Usage
@@ -95,6 +531,8 @@ def generate_plots(df: pd.DataFrame, output_dir: Path):
     # Plot 3: DB Connections
     axes[2].plot(df.index, df["total_connections"], label="Total Connections", color="purple")
     axes[2].plot(df.index, df["active_connections"], label="Active Connections", color="orange", linestyle='--')
+    axes[2].plot(df.index, df["active_connections_max"], label="Active Connections (max over the interval)",
+                 color="orange", linestyle=':', alpha=0.6)
     axes[2].set_ylabel("Connections")
     axes[2].set_title("Database Connections")
     axes[2].grid(True, linestyle='--', alpha=0.6)
@@ -103,12 +541,56 @@ def generate_plots(df: pd.DataFrame, output_dir: Path):
 
     # Plot 4: Lock Contentions
     axes[3].plot(df.index, df["lock_waits"], label="Row Lock Waits", color="red")
+    axes[3].plot(df.index, df["lock_waits_max"], label="Row Lock Waits (max over the interval)", color="red",
+                 linestyle=':', alpha=0.6)
     axes[3].set_ylabel("Count of Waits")
     axes[3].set_title("Row-Level Lock Contention")
     axes[3].grid(True, linestyle='--', alpha=0.6)
     axes[3].legend()
     axes[3].set_ylim(bottom=0)
 
+    # Plot 5: Run times, from the workers' histograms
+    axes[4].plot(df.index, df["duration_p50_ms"], label="Run time p50 (ms)", color="teal")
+    axes[4].plot(df.index, df["duration_p99_ms"], label="Run time p99 (ms)", color="brown")
+    axes[4].plot(df.index, df["execution_p99_ms"], label="Execution p99 (ms)", color="gray", linestyle='--')
+    axes[4].set_ylabel("Milliseconds")
+    axes[4].set_title("Job Run Times (worker histograms)")
+    axes[4].grid(True, linestyle='--', alpha=0.6)
+    axes[4].legend()
+    axes[4].set_ylim(bottom=0)
+
+    # Plot 6: Queue depth, per queue when there are several
+    axes[5].plot(df.index, df["jobs_todo"], label="Todo", color="navy")
+    axes[5].plot(df.index, df["jobs_doing"], label="Doing", color="darkorange")
+    if queues_df is not None and queues_df["queue_name"].nunique() > 1:
+        queues_df = queues_df.assign(timestamp=pd.to_datetime(queues_df["timestamp"]))
+        for queue_name, queue in queues_df.groupby("queue_name"):
+            queue = downsample(queue.set_index("timestamp")[["todo"]])
+            axes[5].plot(queue.index, queue["todo"], label=f"Todo ({queue_name})", linestyle=':')
+    axes[5].set_ylabel("Jobs")
+    capped = df["depth_capped"].astype(bool)
+    if capped.any():
+        axes[5].scatter(df.index[capped], df["jobs_todo"][capped], label="Capped (at least)", color="red", marker="^", s=12)
+    axes[5].set_title("Queue Depth")
+    axes[5].grid(True, linestyle='--', alpha=0.6)
+    axes[5].legend()
+    axes[5].set_ylim(bottom=0)
+
+    # Plot 7: Drain rate
+    axes[6].plot(df.index, df["completed_per_s"], label="Completed / s", color="green")
+    axes[6].plot(df.index, df["failed_interval"], label="Failed (interval)", color="red", alpha=0.7)
+    axes[6].plot(df.index, df["retried_interval"], label="Retried (interval)", color="purple", alpha=0.7)
+    ax_age = axes[6].twinx()
+    ax_age.plot(df.index, df["oldest_todo_s"], label="Oldest todo job (s)", color="gray", linestyle='--')
+    ax_age.set_ylabel("Age (s)")
+    ax_age.set_ylim(bottom=0)
+    axes[6].set_ylabel("Jobs")
+    axes[6].set_title("Drain Rate and Backlog Age")
+    axes[6].grid(True, linestyle='--', alpha=0.6)
+    axes[6].legend(loc="upper left")
+    ax_age.legend(loc="upper right")
+    axes[6].set_ylim(bottom=0)
+
     # Formatting the x-axis
     axes[-1].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
     plt.xlabel("Time")
@@ -119,12 +601,143 @@ def generate_plots(df: pd.DataFrame, output_dir: Path):
     plt.close()
 
 
+def read_queues_csv(path: Path) -> pd.DataFrame | None:
+    """The per-queue depth samples, None if there are none"""
+    if not path.exists() or path.stat().st_size == 0:
+        return None
+    return pd.read_csv(path)
+
+
+async def sample(output_dir: Path, interval: float, duration: int, container, hf_interval: float,
+                 latency_window: float, db_stats: bool, depth_cap: int):
+    """
+    Runs the samplers concurrently until `duration` elapses or SIGTERM/SIGINT:
+    - every `hf_interval`, pg_stat_activity, into a ring buffer, written to
+      monitoring_hf.csv in batches;
+    - every `interval`, the other PostgreSQL statistics (on a connection of
+      their own), the latest docker stats and the maxima of the ring buffer,
+      written to monitoring_data.csv.
+    The blocking psycopg2 calls run in threads, so the samplers never wait on each other.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    loop.call_later(duration, stop.set)
+    start_time = time.time()
+
+    hf_conn = psycopg2.connect(**pgconfig)
+    hf_conn.autocommit = True
+    hf_cursor = hf_conn.cursor()
+    stats_conn = psycopg2.connect(**pgconfig)
+    stats_conn.autocommit = True
+    stats_cursor = stats_conn.cursor()
+    # worker_metrics lives in the result store's database (see papp/store.py)
+    results_config = results_pgconfig(pgconfig)
+    results_conn = stats_conn
+    if results_config != pgconfig:
+        results_conn = psycopg2.connect(**results_config)
+        results_conn.autocommit = True
+    results_cursor = results_conn.cursor()
+    docker_stats = DockerStatsStream(container)
+    queue_sampler = await asyncio.to_thread(QueueSampler, stats_cursor, depth_cap)
+    db_stats_sampler = await asyncio.to_thread(DbStatsSampler, stats_cursor, output_dir) if db_stats else None
+    typer.echo("✅ Connected to Docker and PostgreSQL.")
+
+    # two minutes of high-frequency samples; they are written every second
+    ring = SampleRing(int(120 / hf_interval))
+    fieldnames = [
+        "timestamp", "cpu_percent", "memory_percent", "memory_usage_mb",
+        "total_connections", "active_connections", "idle_connections",
+        "lock_waits", "waiting_connections", *HF_MAX_FIELDS, *HISTOGRAM_FIELDS, *QUEUE_FIELDS
+    ]
+    with open(output_dir / "monitoring_data.csv", 'w', newline='', encoding='utf-8') as csvfile, \
+            open(output_dir / "monitoring_hf.csv", 'w', newline='', encoding='utf-8') as hf_csvfile, \
+            open(output_dir / "queue_depth.csv", 'w', newline='', encoding='utf-8') as queues_csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        hf_writer = csv.DictWriter(hf_csvfile, fieldnames=HF_FIELDS, extrasaction="ignore")
+        hf_writer.writeheader()
+        # queues come and go: one row per queue and sample
+        queues_writer = csv.DictWriter(queues_csvfile, fieldnames=["timestamp", "queue_name", "todo", "doing"])
+        queues_writer.writeheader()
+
+        async def sample_activity():
+            async for _ in ticks(hf_interval, stop):
+                moment, pg_stats = await asyncio.to_thread(timed_query, hf_cursor, PG_STATS_QUERY)
+                ring.append({"t": moment, "timestamp": datetime.fromtimestamp(moment).isoformat(), **pg_stats})
+
+        def sample_statistics(timestamp: str) -> dict:
+            histogram_stats = get_histogram_stats(results_cursor, latency_window)
+            queue_stats, queues = queue_sampler.sample()
+            queues_writer.writerows({"timestamp": timestamp, **queue} for queue in queues)
+            queues_csvfile.flush()
+            if db_stats_sampler is not None:
+                db_stats_sampler.sample(timestamp)
+            return {**histogram_stats, **queue_stats}
+
+        async def sample_interval():
+            previous = time.time()
+            async for _ in ticks(interval, stop):
+                moment = time.time()
+                timestamp = datetime.fromtimestamp(moment).isoformat()
+                statistics = await asyncio.to_thread(sample_statistics, timestamp)
+                recent = ring.since(previous) or list(ring.samples)[-1:]
+                previous = moment
+                if not recent:
+                    continue # no pg_stat_activity sample yet
+                current_metrics = {
+                    **{field: recent[-1][field] for field in HF_FIELDS},
+                    "timestamp": timestamp,
+                    **docker_stats.latest,
+                    **{field: max(sample[field.removesuffix("_max")] for sample in recent) for field in HF_MAX_FIELDS},
+                    **statistics,
+                }
+                writer.writerow(current_metrics)
+                csvfile.flush()
+
+                progress = (time.time() - start_time) / duration * 100
+                typer.echo(
+                    f"\r[{progress:3.0f}%] CPU: {current_metrics['cpu_percent'] or 0:.1f}% | "
+                    f"Mem: {current_metrics['memory_percent'] or 0:.1f}% | "
+                    f"Active Conn: {current_metrics['active_connections']} | "
+                    f"Lock Waits: {current_metrics['lock_waits']} (max {current_metrics['lock_waits_max']}) | "
+                    f"Runs/s: {current_metrics['runs_per_s']} | "
+                    f"Todo: {'≥' if current_metrics['depth_capped'] else ''}{current_metrics['jobs_todo']} | "
+                    f"Done/s: {current_metrics['completed_per_s']}",
+                    nl=False,
+                )
+
+        async def write_ring():
+            async for _ in ticks(1.0, stop):
+                hf_writer.writerows(ring.drain())
+                hf_csvfile.flush()
+
+        try:
+            await asyncio.gather(sample_activity(), sample_interval(), write_ring())
+        finally:
+            hf_writer.writerows(ring.drain())
+            if ring.dropped:
+                typer.echo(f"\n⚠️  {ring.dropped} high-frequency samples dropped before being written.")
+            docker_stats.stopped = True
+            hf_conn.close()
+            stats_conn.close()
+            if results_conn is not stats_conn:
+                results_conn.close()
+            if db_stats_sampler is not None:
+                db_stats_sampler.close()
+
+
 @app.command()
 def run(
     output_dir: Path = typer.Option("perf", help="Directory to save results (CSV and plot)."),
     interval: float = typer.Option(1.0, "--interval", "-i", help="Polling interval in seconds."),
     duration: int = typer.Option(600, "--duration", "-d", help="Total monitoring duration in seconds."),
     container_name: str = typer.Option("pg-procrastinate", help="Name of the PostgreSQL Docker container."),
+    hf_interval: float = typer.Option(0.1, help="Interval (seconds) of the high-frequency pg_stat_activity samples."),
+    latency_window: float = typer.Option(10.0, help="Window (seconds) of the worker histograms merged at each poll."),
+    db_stats: bool = typer.Option(False, help="Also sample pg_stat_statements and the table/index statistics."),
+    depth_cap: int = typer.Option(10_000, help="Queue depth counted at most per poll; deeper queues are reported as capped."),
 ):
     """
     Monitors a PostgreSQL instance running in Docker for performance metrics.
@@ -136,115 +749,33 @@ def run(
     csv_path = output_dir / "monitoring_data.csv"
 
     typer.echo(f"🚀 Starting monitoring for {duration} seconds...")
-    typer.echo(f"   - Polling interval: {interval}s")
+    typer.echo(f"   - Polling interval: {interval}s (pg_stat_activity every {hf_interval}s)")
     typer.echo(f"   - Docker container: '{container_name}'")
     typer.echo(f"   - Saving data to: {csv_path}")
 
-    # --- Graceful Shutdown Handler ---
-    # This class will be raised when SIGTERM is caught.
-    class GracefulExit(SystemExit):
-        pass
-
-    # The handler function that raises our custom exception.
-    def signal_handler(signum, frame):
-        typer.echo("\n🛑 SIGTERM received, shutting down gracefully...")
-        raise GracefulExit()
-    
-    signal.signal(signal.SIGTERM, signal_handler)  # install the signal handler
-
-
-    start_time = time.time()
-    
-    # Define the headers for the CSV file.
-    fieldnames = [
-        "timestamp", "cpu_percent", "memory_percent", "memory_usage_mb",
-        "total_connections", "active_connections", "idle_connections",
-        "lock_waits", "waiting_connections"
-    ]
-
     try:
-        # Initialize clients
-        docker_client = docker.from_env()
-        pg_conn = psycopg2.connect(**pgconfig)
-        pg_conn.autocommit = True
-        pg_cursor = pg_conn.cursor()
-        container = docker_client.containers.get(container_name)
-        typer.echo("✅ Connected to Docker and PostgreSQL.")
-
-        # Open the CSV file and create a writer object.
-        # Data will be appended row-by-row within the loop.
-        with open(csv_path, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-
-            while time.time() - start_time < duration:
-                loop_start = time.time()
-
-                # 1. Collect metrics
-                timestamp = datetime.now().isoformat()
-                docker_stats = get_docker_stats(container)
-
-                pg_cursor.execute(PG_STATS_QUERY)
-                pg_stats = dict(zip([desc[0] for desc in pg_cursor.description], pg_cursor.fetchone()))
-
-                # 2. Combine and store metrics
-                current_metrics = {
-                    "timestamp": timestamp,
-                    **docker_stats,
-                    **pg_stats,
-                }
-                
-                # MODIFIED: Write the current metrics directly to the CSV file.
-                writer.writerow(current_metrics)
-                csvfile.flush() # Ensure the data is written to disk immediately.
-
-                # 3. Print progress
-                progress = (time.time() - start_time) / duration * 100
-                typer.echo(
-                    f"\r[{progress:3.0f}%] CPU: {current_metrics['cpu_percent']:.1f}% | "
-                    f"Mem: {current_metrics['memory_percent']:.1f}% | "
-                    f"Active Conn: {current_metrics['active_connections']} | "
-                    f"Lock Waits: {current_metrics['lock_waits']}",
-                    nl=False,
-                )
-
-                # 4. Wait for the next interval
-                elapsed = time.time() - loop_start
-                time.sleep(max(0, interval - elapsed))
-
+        container = docker.from_env().containers.get(container_name)
+        asyncio.run(sample(output_dir, interval, duration, container, hf_interval, latency_window, db_stats, depth_cap))
     except docker.errors.NotFound:
         typer.secho(f"Error: Docker container '{container_name}' not found.", fg=typer.colors.RED, err=True)
         return
     except psycopg2.OperationalError as e:
         typer.secho(f"Error connecting to PostgreSQL: {e}", fg=typer.colors.RED, err=True)
         return
-    except (KeyboardInterrupt, GracefulExit):
-        typer.echo("\n🛑 Monitoring interrupted by user or signal.")
-    finally:
-        if 'pg_conn' in locals() and pg_conn:
-            pg_conn.close()
-
-        typer.echo("\n✅ Monitoring finished.")
-
-        if not csv_path.exists() or csv_path.stat().st_size <= len(','.join(fieldnames)):
-            typer.echo("No data collected. Exiting without generating a plot.")
-        else:
-            # --- Read saved data and generate plots ---
-            typer.echo(f"💾 Raw data saved to {csv_path}")
-            df = pd.read_csv(csv_path)
-            generate_plots(df, output_dir)
 
     typer.echo("\n✅ Monitoring finished.")
+    if db_stats:
+        generate_db_stats_report(output_dir)
 
     # Check if any data was actually written before trying to create a plot.
-    if not csv_path.exists() or csv_path.stat().st_size <= len(','.join(fieldnames)):
+    if not csv_path.exists() or sum(1 for _ in open(csv_path)) < 2:
         typer.echo("No data collected. Exiting without generating a plot.")
         return
 
     # --- Read saved data and generate plots ---
     typer.echo(f"💾 Raw data saved to {csv_path}")
     df = pd.read_csv(csv_path)
-    generate_plots(df, output_dir)
+    generate_plots(df, output_dir, read_queues_csv(output_dir / "queue_depth.csv"))
 
 
 if __name__ == "__main__":
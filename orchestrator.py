@@ -1,36 +1,379 @@
+import asyncio
+import math
 import time
 import sys
-from papp.main import app
+from papp.main import app, pgconfig, shard, shard_configs
+from papp import notify
+from papp.shards import ShardRouter, job_key, open_shards, shard_connectors
 import typer
 import random
+import psycopg_pool
+from psycopg.types.json import Jsonb
 from papp.tasks import sum
 from papp.tasks import sum_with_persistence, asum_with_persistence
 
 app_cli = typer.Typer()
 
+# How many chunks a producer sends before waiting for their results.
+# Bounds client memory and the amount of work lost if the connection drops.
+PIPELINE_DEPTH = 8
+
+# Same procrastinate function `batch_defer` calls, with the composite rows
+# built server side from a JSON array of job arguments
+DEFER_CHUNK_QUERY = """
+SELECT unnest(procrastinate_defer_jobs_v1(ARRAY(
+    SELECT ROW(
+        %(queue_name)s::varchar, %(task_name)s::varchar, %(priority)s::integer,
+        %(lock)s::text, %(queueing_lock)s::text, args, %(scheduled_at)s::timestamptz
+    )::procrastinate_job_to_defer_v1
+    FROM jsonb_array_elements(%(args)s::jsonb) AS args
+))) AS id;
+"""
+
+# DEFER_CHUNK_QUERY with one job notification per chunk instead of two per job (see papp/notify.py)
+COALESCED_DEFER_CHUNK_QUERY = DEFER_CHUNK_QUERY.replace("procrastinate_defer_jobs_v1(", "papp_defer_jobs_coalesced(")
+
+
+def job_kwargs(i: int, a: int, b: int, avg_duration: float) -> dict:
+    """Arguments of the i-th benchmark job"""
+    return dict(a=a*i, b=b*i,
+                avg_sleep_time=avg_duration,
+                fail_prob=0.05 # eg 5%
+                )
+
+
+def defer_in_batches(task, max_jobs: int, batch_size: int, make_kwargs, router: ShardRouter | None = None,
+                     connectors: list | None = None, coalesce_notify: bool = False) -> int:
+    """
+    Defers `max_jobs` jobs of `task`, `batch_size` at a time.
+
+    Each chunk is sent with procrastinate's `batch_defer`, i.e. a single
+    multi-row INSERT (`procrastinate_defer_jobs_v1` over an array of jobs)
+    executed in its own transaction. With a `router`, each part of a chunk
+    goes to its shard, through `connectors`. With `coalesce_notify`, chunks go
+    through `COALESCED_DEFER_CHUNK_QUERY` instead. Returns the number of deferred jobs.
+    """
+    deferrer = task.configure() # resolve task options once, not once per chunk
+
+    def defer_chunk(jobs: list[dict]):
+        if coalesce_notify:
+            app.connector.get_sync_connector().execute_query_all(
+                COALESCED_DEFER_CHUNK_QUERY, **defer_chunk_params(deferrer, jobs)
+            )
+        else:
+            deferrer.batch_defer(*jobs)
+
+    report_every = max(1, max_jobs // 10)
+    deferred = 0
+    while deferred < max_jobs:
+        size = min(batch_size, max_jobs - deferred)
+        chunk = [make_kwargs(deferred + n + 1) for n in range(size)]
+        if router is None:
+            defer_chunk(chunk)
+        else:
+            for index, jobs in router.split(chunk).items():
+                with app.replace_connector(connectors[index]):
+                    defer_chunk(jobs)
+        # print progress roughly every 10%, as the one-by-one loop does
+        if (deferred + size) // report_every > deferred // report_every:
+            print(f"[main] Scheduled {deferred + size} jobs")
+        deferred += size
+    return deferred
+
+
+def defer_chunk_params(deferrer, chunk: list[dict]) -> dict:
+    """
+    Parameters of `DEFER_CHUNK_QUERY` for a chunk of jobs of the same task.
+    Only the arguments differ between jobs, so they travel as a single JSON array
+    instead of an array of composites (much cheaper to dump client side).
+    """
+    job = deferrer.job # task options (queue, priority, locks...), without arguments
+    return {
+        "queue_name": job.queue,
+        "task_name": job.task_name,
+        "priority": job.priority,
+        "lock": job.lock,
+        "queueing_lock": job.queueing_lock,
+        "scheduled_at": job.scheduled_at,
+        "args": Jsonb([{**job.task_kwargs, **kwargs} for kwargs in chunk]),
+    }
+
+
+async def pipelined_producer(producer_id: int, pool, deferrer, chunks, make_kwargs, counter: list[int],
+                             query: str = DEFER_CHUNK_QUERY):
+    """
+    Defers the chunks it pulls from the shared `chunks` iterator on its own
+    connection of `pool`, in pipeline mode: chunks are streamed without waiting
+    for the previous ones, each one still wrapped in its own BEGIN/COMMIT.
+    """
+    async with pool.connection() as conn:
+        # explicit BEGIN/COMMIT: psycopg's transaction() would sync the pipeline
+        await conn.set_autocommit(True)
+        try:
+            async with conn.pipeline() as pipeline:
+                in_flight = 0
+                for first, size in chunks:
+                    params = defer_chunk_params(deferrer, [make_kwargs(first + n) for n in range(size)])
+                    await conn.execute("BEGIN")
+                    await conn.execute(query, params)
+                    await conn.execute("COMMIT")
+                    in_flight += size
+                    if in_flight >= PIPELINE_DEPTH * size:
+                        await pipeline.sync()
+                        counter[0] += in_flight
+                        in_flight = 0
+            counter[0] += in_flight
+        finally:
+            if conn.info.transaction_status != 0: # not idle, e.g. a failed chunk
+                await conn.rollback()
+            await conn.set_autocommit(False)
+    print(f"[producer {producer_id}] Done")
+
+
+async def defer_with_producers(task, max_jobs: int, batch_size: int, producers: int, make_kwargs,
+                               shards: int = 1, query: str = DEFER_CHUNK_QUERY) -> int:
+    """
+    Defers `max_jobs` jobs with `producers` concurrent pipelined producers.
+    The app is opened on a dedicated pool with one connection per producer.
+    Over `shards` shards, producer n defers to shard n mod `shards`, with a pool
+    per shard: faster shards take more chunks.
+    """
+    configs = shard_configs if shards > 1 else [pgconfig]
+    pools = []
+    for index, config in enumerate(configs):
+        size = len(range(index, producers, len(configs)))
+        pools.append(psycopg_pool.AsyncConnectionPool(kwargs=config, min_size=size, max_size=size, open=False))
+    for pool in pools:
+        await pool.open(wait=True)
+    try:
+        async with app.open_async(pools[shard if shards > 1 else 0]):
+            deferrer = task.configure()
+            # shared by all producers: each chunk is taken exactly once
+            chunks = ((first, min(batch_size, max_jobs - first + 1))
+                      for first in range(1, max_jobs + 1, batch_size))
+            counter = [0]
+
+            async def report():
+                while True:
+                    await asyncio.sleep(1)
+                    print(f"[main] Scheduled {counter[0]} jobs")
+
+            reporter = asyncio.create_task(report())
+            try:
+                await asyncio.gather(*(
+                    pipelined_producer(n, pools[n % len(pools)], deferrer, chunks, make_kwargs, counter, query)
+                    for n in range(producers)
+                ))
+            finally:
+                reporter.cancel()
+            return counter[0]
+    finally:
+        for pool in pools:
+            await pool.close()
+
+
+class TokenBucket:
+    """
+    Arrival budget for the open-loop generator.
+
+    Tokens are derived from the monotonic clock rather than from the number of
+    ticks, so late wake-ups or slow deferrals never make the generator drift:
+    the missing arrivals are simply due at the next tick. `rate_at(t)` gives the
+    target arrival rate (jobs/s) `t` seconds after the start. With `poisson=True`
+    arrivals follow a Poisson process (exponential inter-arrival times) instead
+    of a fluid, evenly spaced stream. `clock` is the time source, in seconds.
+    """
+
+    def __init__(self, rate_at, poisson: bool = False, burst: float = math.inf, clock=time.monotonic):
+        self.rate_at = rate_at
+        self.poisson = poisson
+        self.burst = burst # max tokens kept when the consumer falls behind
+        self.clock = clock
+        self.start = clock()
+        self.last = 0.0
+        self.tokens = 0.0
+        self.next_arrival = self._inter_arrival(0.0)
+
+    def _inter_arrival(self, t: float) -> float:
+        rate = self.rate_at(t)
+        return t + (random.expovariate(rate) if rate > 0 else 1.0)
+
+    def take(self) -> int:
+        """Returns the number of arrivals due since the previous call."""
+        t = self.clock() - self.start
+        if self.poisson:
+            while self.next_arrival <= t:
+                self.tokens += 1
+                self.next_arrival = self._inter_arrival(self.next_arrival)
+        else:
+            # trapezoidal integral of the rate, exact for constant and linear ramps
+            self.tokens += (self.rate_at(self.last) + self.rate_at(t)) / 2 * (t - self.last)
+        self.last = t
+        self.tokens = min(self.tokens, self.burst)
+        due = int(self.tokens)
+        self.tokens -= due
+        return due
+
+
+def rate_profile(profile: str, rate: float, ramp_to: float, duration: float):
+    """Target arrival rate (jobs/s) as a function of the elapsed time"""
+    if profile == "ramp":
+        return lambda t: rate + (ramp_to - rate) * min(t / duration, 1.0)
+    return lambda t: rate # constant and poisson
+
+
+async def open_loop(task, profile: str, rate: float, ramp_to: float, duration: float,
+                    tick: float, batch_size: int, make_kwargs, query: str = DEFER_CHUNK_QUERY) -> tuple[int, float]:
+    """
+    Defers jobs at the target arrival rate for `duration` seconds, whatever the
+    workers are doing (open loop). Each tick defers the arrivals due so far with a
+    single multi-row insert; inserts run in the background, so a slow database
+    shows up as enqueue lag instead of silently lowering the arrival rate.
+    Returns the number of deferred jobs, the worst enqueue lag (s) and the
+    number of jobs whose insert failed (reported, and not counted as deferred).
+    """
+    async with app.open_async():
+        deferrer = task.configure()
+        bucket = TokenBucket(rate_profile(profile, rate, ramp_to, duration), poisson=profile == "poisson")
+        deferred = 0
+        max_lag = 0.0
+        pending: dict[asyncio.Task, int] = {} # insert -> its jobs
+        failed_chunks = failed_jobs = 0
+
+        def settled(job_task: asyncio.Task):
+            nonlocal failed_chunks, failed_jobs
+            size = pending.pop(job_task)
+            if not job_task.cancelled() and (e := job_task.exception()) is not None:
+                if not failed_chunks:
+                    print(f"[main] Insert of {size} jobs failed: {e.__cause__ or e!r}")
+                failed_chunks += 1
+                failed_jobs += size
+
+        async def defer(first: int, size: int, due_at: float):
+            nonlocal max_lag
+            params = defer_chunk_params(deferrer, [make_kwargs(first + n) for n in range(size)])
+            await app.connector.execute_query_all_async(query, **params)
+            max_lag = max(max_lag, time.monotonic() - due_at)
+
+        next_report = 1.0
+        while (elapsed := time.monotonic() - bucket.start) < duration:
+            due = bucket.take()
+            while due > 0:
+                size = min(due, batch_size)
+                job_task = asyncio.create_task(defer(deferred + 1, size, time.monotonic()))
+                pending[job_task] = size
+                job_task.add_done_callback(settled)
+                deferred += size
+                due -= size
+            if elapsed >= next_report:
+                print(f"[main] t={elapsed:6.1f}s target={bucket.rate_at(elapsed):8.1f} jobs/s "
+                      f"deferred={deferred - failed_jobs} in-flight inserts={len(pending)}"
+                      f"{f' failed={failed_jobs}' if failed_jobs else ''}")
+                next_report += 1.0
+            await asyncio.sleep(tick)
+        # failures are counted by `settled`
+        await asyncio.gather(*pending, return_exceptions=True)
+        if failed_chunks:
+            print(f"[main] {failed_chunks} inserts failed: {failed_jobs} jobs were not deferred")
+        return deferred - failed_jobs, max_lag, failed_jobs
+
 
 @app_cli.command()
 def main(
         max_jobs: int = typer.Option(10, help="Number of jobs to schedule"),
-        avg_duration: float = typer.Option(3.0, help="Average duration of each job in seconds")
+        avg_duration: float = typer.Option(3.0, help="Average duration of each job in seconds"),
+        batch_size: int = typer.Option(1000, help="Jobs inserted per round trip/transaction. Use 1 to defer jobs one by one"),
+        producers: int = typer.Option(0, help="Number of concurrent async producers, each pipelining chunks on its own connection (0: defer synchronously)"),
+        rate: float = typer.Option(0.0, help="Open-loop mode: target arrival rate in jobs/s (0: enqueue everything up front). --max-jobs is ignored"),
+        profile: str = typer.Option("constant", help="Open-loop arrival profile: constant, poisson or ramp"),
+        ramp_to: float = typer.Option(0.0, help="Open-loop ramp profile: arrival rate reached at the end of the run"),
+        duration: float = typer.Option(60.0, help="Open-loop mode: run duration in seconds"),
+        tick: float = typer.Option(0.01, help="Open-loop mode: scheduling resolution in seconds"),
+        shard_by: str = typer.Option("round-robin", help="With DB_SHARDS: route jobs to shards by round-robin or hash (consistent hashing of their arguments)"),
+        coalesce_notify: bool = typer.Option(False, help="Send one job notification per inserted chunk instead of two per job (batch, producers and open-loop modes)"),
 ):
-    with app.open():
+    router = None
+    if len(shard_configs) > 1:
+        if shard_by not in ShardRouter.MODES:
+            raise typer.BadParameter(f"Unknown routing {shard_by!r}", param_hint="--shard-by")
+        if rate > 0:
+            raise typer.BadParameter("Open-loop mode defers to a single shard: unset DB_SHARDS or pick SHARD", param_hint="--rate")
+        if producers > 0 and (shard_by != "round-robin" or producers < len(shard_configs)):
+            raise typer.BadParameter(f"Producers are pinned to shards: round-robin only, at least {len(shard_configs)} producers",
+                                     param_hint="--producers")
+        router = ShardRouter(len(shard_configs), shard_by)
+        print(f"[main] Routing jobs to {len(shard_configs)} shards ({shard_by})")
+    query = DEFER_CHUNK_QUERY
+    if coalesce_notify:
+        for config in (shard_configs if router else [pgconfig]):
+            if not notify.installed(config):
+                raise typer.BadParameter(f"not installed in {config['dbname']} on {config['host']}: "
+                                         "run python init_db.py --coalesce-notify (per shard)",
+                                         param_hint="--coalesce-notify")
+        query = COALESCED_DEFER_CHUNK_QUERY
+        print("[main] Coalescing job notifications: one per chunk")
+    if rate > 0:
+        if profile not in ("constant", "poisson", "ramp"):
+            raise typer.BadParameter(f"Unknown profile {profile!r}", param_hint="--profile")
+        if duration <= 0:
+            raise typer.BadParameter("The open loop needs a positive duration", param_hint="--duration")
+        if profile == "ramp" and ramp_to <= 0:
+            raise typer.BadParameter("The ramp profile needs the arrival rate to ramp to (jobs/s)", param_hint="--ramp-to")
+        a = random.randint(1, 100)
+        b = random.randint(1, 100)
+        print(f"[main] Open loop: {profile} arrivals at {rate} jobs/s"
+              f"{f' ramping to {ramp_to} jobs/s' if profile == 'ramp' else ''} for {duration}s")
+        start = time.perf_counter()
+        deferred, max_lag, failed = asyncio.run(open_loop(
+            asum_with_persistence, profile, rate, ramp_to, duration, tick, max(1, batch_size),
+            lambda i: job_kwargs(i, a, b, avg_duration), query
+        ))
+        elapsed = time.perf_counter() - start
+        print(f"[main] Scheduled everything: {deferred} jobs in {elapsed:.2f}s "
+              f"({deferred / elapsed:.0f} jobs/s, max enqueue lag {max_lag * 1000:.0f} ms)")
+        if failed:
+            raise typer.Exit(1)
+        return
+
+    if producers > 0:
+        a = random.randint(1, 100)
+        b = random.randint(1, 100)
+        print(f"[main] Scheduling sum({a}, {b}) with {producers} producers, chunks of {batch_size} jobs")
+        start = time.perf_counter()
+        deferred = asyncio.run(defer_with_producers(
+            asum_with_persistence, max_jobs, max(1, batch_size), producers,
+            lambda i: job_kwargs(i, a, b, avg_duration), shards=router.shards if router else 1, query=query,
+        ))
+        elapsed = time.perf_counter() - start
+        print(f"[main] Scheduled everything: {deferred} jobs in {elapsed:.2f}s ({deferred / elapsed:.0f} jobs/s)")
+        return
+
+    connectors = shard_connectors(app, shard_configs, shard) if router else None
+    with app.open(), open_shards(app, connectors or []):
         a = random.randint(1, 100)
         b = random.randint(1, 100)
         print(f"[main] Scheduling sum({a}, {b})")
-        i = 0
-        # TODO: check how to batch defer jobs
-        while i < max_jobs: # 200 should take 1m to exectute with 10 workers
-            if i % (max_jobs//10) == 0:
-                print(f"[main] Scheduled {i} jobs")
-            i += 1
-            #print(f"[main] Scheduling ({a}, {b}) #{i}")
-            asum_with_persistence.defer(a=a*i, b=b*i,
-                                        avg_sleep_time=avg_duration,
-                                        fail_prob=0.05 # eg 5%
-                                        )
-            time.sleep(0.001)
-        print("[main] Scheduled everything")
-        
+        start = time.perf_counter()
+        if batch_size > 1:
+            print(f"[main] Batch deferring in chunks of {batch_size} jobs")
+            defer_in_batches(asum_with_persistence, max_jobs, batch_size,
+                             lambda i: job_kwargs(i, a, b, avg_duration), router, connectors, coalesce_notify)
+        else:
+            i = 0
+            while i < max_jobs: # 200 should take 1m to exectute with 10 workers
+                if i % max(1, max_jobs//10) == 0:
+                    print(f"[main] Scheduled {i} jobs")
+                i += 1
+                #print(f"[main] Scheduling ({a}, {b}) #{i}")
+                kwargs = job_kwargs(i, a, b, avg_duration)
+                if router is None:
+                    asum_with_persistence.defer(**kwargs)
+                else:
+                    with app.replace_connector(connectors[router.shard_for(job_key(kwargs))]):
+                        asum_with_persistence.defer(**kwargs)
+                time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        print(f"[main] Scheduled everything: {max_jobs} jobs in {elapsed:.2f}s ({max_jobs / elapsed:.0f} jobs/s)")
+
 if __name__ == "__main__":
-    app_cli()
\ No newline at end of file
+    app_cli()
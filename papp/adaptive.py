@@ -0,0 +1,207 @@
+import asyncio
+import math
+import time
+
+from papp import prometheus
+
+# Adaptive in-worker concurrency (`run_worker.py --adaptive`). `--concurrency`
+# becomes a ceiling: the worker is created with that many slots, and
+# `AdaptiveConcurrency` gates its job manager on a `ConcurrencyGate` of its own:
+# a job takes a slot before it is fetched, and gives it back once procrastinate
+# finishes or retries it. Every `interval` seconds it compares the
+# throughput with the previous interval and checks three congestion signals:
+# the pool checkout wait, the fetch_job latency and the event loop lag.
+# AIMD: the limit grows by one (doubling at first, "slow start") while the
+# worker is using all of it and throughput improves, steps back when a raise
+# did not help, and is cut multiplicatively as soon as a signal is over its
+# threshold. Each worker settles on its own throughput-optimal concurrency.
+
+#: interval (seconds) of the event loop lag and in-flight probes
+PROBE_INTERVAL = 0.1
+
+
+class ConcurrencyGate:
+    """A semaphore whose number of slots (`limit`) can change while it is in use"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.running = 0
+        self._waiters: list[asyncio.Future] = []
+
+    async def acquire(self):
+        while self.running >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.running += 1
+
+    def release(self):
+        self.running -= 1
+        self._wake()
+
+    def set_limit(self, limit: int):
+        """Lowering the limit lets the running jobs finish: new ones wait until fewer than `limit` run"""
+        self.limit = limit
+        self._wake()
+
+    def _wake(self):
+        # the waiters check the limit again
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+
+def gate_job_manager(job_manager, gate: ConcurrencyGate, stopping=lambda: False):
+    """
+    Makes `job_manager` take a slot of `gate` before fetching a job, and give
+    it back when the job is finished or retried (or when no job is fetched).
+    No job is fetched once `stopping()`: the worker may wait on the gate while it drains.
+    """
+    fetch_job, finish_job, retry_job = job_manager.fetch_job, job_manager.finish_job, job_manager.retry_job
+
+    async def gated_fetch_job(queues, worker_id):
+        await gate.acquire()
+        job = None
+        try:
+            if not stopping():
+                job = await fetch_job(queues=queues, worker_id=worker_id)
+        finally:
+            if job is None:
+                gate.release()
+        return job
+
+    async def gated_finish_job(job, status, delete_job):
+        try:
+            return await finish_job(job=job, status=status, delete_job=delete_job)
+        finally:
+            gate.release()
+
+    async def gated_retry_job(job, retry_at=None, priority=None, queue=None, lock=None):
+        try:
+            return await retry_job(job=job, retry_at=retry_at, priority=priority, queue=queue, lock=lock)
+        finally:
+            gate.release()
+
+    job_manager.fetch_job = gated_fetch_job
+    job_manager.finish_job = gated_finish_job
+    job_manager.retry_job = gated_retry_job
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD limit on the jobs `worker` runs at once, between `min_concurrency`
+    and the worker's concurrency. Congestion: a mean pool checkout wait over
+    `max_checkout_wait_ms`, a mean fetch query time over `latency_factor` times
+    the lowest one seen, or an event loop lag over `max_loop_lag_ms`. The
+    counters come from `prometheus.stats`: install its job manager first, as
+    the limit is enforced by gating the app's job manager (see `gate_job_manager`).
+    """
+
+    def __init__(self, worker, min_concurrency: int = 1, interval: float = 2.0, decrease: float = 0.7,
+                 min_gain: float = 0.05, max_checkout_wait_ms: float = 5.0, latency_factor: float = 2.0,
+                 max_loop_lag_ms: float = 50.0, hold_intervals: int = 5):
+        self.worker = worker
+        self.max_concurrency = worker.concurrency
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.limit = self.min_concurrency
+        self.interval = interval
+        self.decrease = decrease
+        self.min_gain = min_gain
+        self.max_checkout_wait_ms = max_checkout_wait_ms
+        self.latency_factor = latency_factor
+        self.max_loop_lag_ms = max_loop_lag_ms
+        self.hold_intervals = hold_intervals
+        self.slow_start = True
+        self.gate = ConcurrencyGate(self.limit)
+        gate_job_manager(worker.app.job_manager, self.gate, stopping=lambda: worker._stop_event.is_set())
+        self._best_fetch_ms = math.inf
+        self._last_throughput = None
+        self._raised = False
+        self._hold = 0
+        prometheus.stats.effective_concurrency = self.limit
+
+    def decide(self, throughput: float, busy: bool, checkout_wait_ms: float | None, fetch_ms: float | None,
+               loop_lag_ms: float) -> str | None:
+        """Updates the limit from the signals of the last interval; returns the reason of a change"""
+        if fetch_ms is not None:
+            self._best_fetch_ms = min(self._best_fetch_ms, fetch_ms)
+        previous, self._last_throughput = self._last_throughput, throughput
+        raised, self._raised = self._raised, False
+        limit, reason = self.limit, None
+
+        if checkout_wait_ms is not None and checkout_wait_ms > self.max_checkout_wait_ms:
+            reason = f"pool checkout wait {checkout_wait_ms:.1f} ms"
+        elif fetch_ms is not None and fetch_ms > self.latency_factor * self._best_fetch_ms:
+            reason = f"fetch latency {fetch_ms:.1f} ms (best {self._best_fetch_ms:.1f} ms)"
+        elif loop_lag_ms > self.max_loop_lag_ms:
+            reason = f"event loop lag {loop_lag_ms:.0f} ms"
+        if reason is not None:
+            # multiplicative decrease
+            limit = math.floor(self.limit * self.decrease)
+            self.slow_start = False
+            self._hold = self.hold_intervals
+        elif raised and previous is not None and throughput < previous * (1 + self.min_gain):
+            # the last raise did not pay off: back to the previous limit, and stay there a while
+            limit = self.limit - 1 if not self.slow_start else math.ceil(self.limit / 2)
+            reason = f"throughput {throughput:.1f}/s did not improve ({previous:.1f}/s)"
+            self.slow_start = False
+            self._hold = self.hold_intervals
+        elif self._hold:
+            self._hold -= 1
+        elif busy:
+            # additive increase, only when the current limit is actually used
+            limit = self.limit * 2 if self.slow_start else self.limit + 1
+            reason = f"throughput {throughput:.1f}/s, all {self.limit} slots busy"
+
+        limit = max(self.min_concurrency, min(self.max_concurrency, limit))
+        if limit == self.limit:
+            return None
+        self._raised = limit > self.limit
+        self.limit = limit
+        self.gate.set_limit(limit)
+        prometheus.stats.effective_concurrency = limit
+        return reason
+
+    async def run(self):
+        """Adjusts the limit until cancelled"""
+        stats = prometheus.stats
+        print(f"[ADAPTIVE] {stats.worker_name}: starting at concurrency {self.limit} (max {self.max_concurrency})")
+
+        pool = getattr(self.worker.app.connector, "_async_pool", None)
+        finished = sum(stats.finished.values()) + stats.retried
+        # per fetch query: with PREFETCH_JOBS, most fetch_job calls are served from the buffer
+        fetch_queries, fetch_seconds = stats.fetch_queries, stats.fetch_seconds
+        pool_stats = pool.get_stats() if pool is not None else {}
+        window_start = time.perf_counter()
+        while True:
+            loop_lag, busy = 0.0, False
+            deadline = window_start + self.interval
+            while (now := time.perf_counter()) < deadline:
+                await asyncio.sleep(PROBE_INTERVAL)
+                loop_lag = max(loop_lag, time.perf_counter() - now - PROBE_INTERVAL)
+                busy = busy or self.gate.running >= self.limit
+
+            now = time.perf_counter()
+            done = sum(stats.finished.values()) + stats.retried
+            throughput = (done - finished) / (now - window_start)
+            fetch_ms = ((stats.fetch_seconds - fetch_seconds) / (stats.fetch_queries - fetch_queries) * 1000
+                        if stats.fetch_queries > fetch_queries else None)
+            checkout_wait_ms = None
+            if pool is not None:
+                current = pool.get_stats()
+                requests = current.get("requests_num", 0) - pool_stats.get("requests_num", 0)
+                if requests:
+                    wait_ms = current.get("requests_wait_ms", 0) - pool_stats.get("requests_wait_ms", 0)
+                    checkout_wait_ms = wait_ms / requests
+                pool_stats = current
+            finished, fetch_queries, fetch_seconds, window_start = done, stats.fetch_queries, stats.fetch_seconds, now
+
+            previous = self.limit
+            reason = self.decide(throughput, busy, checkout_wait_ms, fetch_ms, loop_lag * 1000)
+            if reason is not None:
+                print(f"[ADAPTIVE] {stats.worker_name}: concurrency {previous} -> {self.limit}: {reason}")
@@ -0,0 +1,162 @@
+import math
+import signal
+import subprocess
+import sys
+import time
+
+import psycopg
+import typer
+
+from papp.connections import connection_budget, connections_per_worker
+
+# Queue-depth-driven autoscaling of worker processes. `Autoscaler` decides how
+# many workers should run from the backlog (todo jobs) and the age of the
+# oldest one; `supervisor.py --autoscale` applies its decisions to forked
+# workers, and `python -m papp.autoscale` to `run_worker.py` subprocesses.
+# The number of workers never exceeds what the database connection budget
+# allows (see papp/connections.py).
+
+# both subqueries read the todo jobs only, through procrastinate's partial indexes:
+# the backlog counts at most `cap` of them (enough for the largest decision), and
+# the oldest job is the next one workers fetch (the head of the priority, id
+# index), waiting since its latest (re)queue or its scheduled time
+QUERY_BACKLOG = """
+SELECT
+    (SELECT COUNT(*) FROM (SELECT 1 FROM procrastinate_jobs WHERE status = 'todo' LIMIT %(cap)s) AS todo) AS backlog,
+    (SELECT EXTRACT(EPOCH FROM NOW() - GREATEST(jobs.scheduled_at, (
+         SELECT MAX(at) FROM procrastinate_events
+         WHERE job_id = jobs.id AND type IN ('deferred', 'deferred_for_retry', 'retried'))))
+     FROM procrastinate_jobs AS jobs
+     WHERE status = 'todo' AND (scheduled_at IS NULL OR scheduled_at <= NOW())
+     ORDER BY priority DESC, id LIMIT 1) AS oldest_age
+"""
+
+
+def sample_backlog(pgconfig: dict, cap: int) -> tuple[int, float]:
+    """The number of todo jobs (up to `cap`) and the age (seconds) of the oldest one, on a short-lived connection"""
+    with psycopg.connect(**pgconfig, autocommit=True) as conn:
+        backlog, oldest_age = conn.execute(QUERY_BACKLOG, {"cap": cap}).fetchone()
+    return backlog, float(oldest_age or 0)
+
+
+class Autoscaler:
+    """
+    Target number of workers, between `min_workers` and `max_workers` (itself
+    capped by `connection_budget // connections_per_worker`, unless workers
+    open no postgres connection of their own, behind PgBouncer).
+
+    Scaling up: when the backlog exceeds `backlog_per_slot` jobs per
+    concurrency slot, to the workers needed to get back under it (at least
+    one more), or one more worker when the oldest job waited more than
+    `max_age` seconds. At most every `up_cooldown` seconds.
+    Scaling down (hysteresis): one worker at a time, only after `down_checks`
+    consecutive decisions under `down_ratio` of that backlog with young jobs,
+    and at most every `down_cooldown` seconds.
+    """
+
+    def __init__(self, min_workers: int, max_workers: int, concurrency: int, connections_per_worker: int,
+                 connection_budget: int, backlog_per_slot: float = 10, max_age: float = 30, down_ratio: float = 0.25,
+                 up_cooldown: float = 10, down_cooldown: float = 60, down_checks: int = 3):
+        self.concurrency = concurrency
+        self.max_workers = max_workers
+        if connections_per_worker:
+            self.max_workers = min(max_workers, connection_budget // connections_per_worker)
+        if self.max_workers < max_workers:
+            print(f"[AUTOSCALE] {connection_budget} connections allow {self.max_workers} workers "
+                  f"of {connections_per_worker} connections, not {max_workers}")
+        self.min_workers = min(min_workers, self.max_workers)
+        self.backlog_per_slot = backlog_per_slot
+        self.max_age = max_age
+        self.down_ratio = down_ratio
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.down_checks = down_checks
+        self._last_change = -math.inf
+        self._calm_checks = 0
+
+    @property
+    def backlog_cap(self) -> int:
+        """The backlog beyond which decisions no longer change (all `max_workers` needed)"""
+        return math.ceil(self.max_workers * self.backlog_per_slot * self.concurrency)
+
+    def decide(self, workers: int, backlog: int, oldest_age: float, now: float | None = None) -> int:
+        """The number of workers to run, given the current `workers` and the queue"""
+        now = time.monotonic() if now is None else now
+        since_change = now - self._last_change
+        target = workers
+        slots = self.backlog_per_slot * self.concurrency
+        needed = math.ceil(backlog / slots)
+
+        if needed > workers or oldest_age > self.max_age:
+            self._calm_checks = 0
+            if since_change >= self.up_cooldown:
+                target = max(needed, workers + 1)
+        elif backlog < self.down_ratio * slots * workers and oldest_age < self.max_age / 2:
+            self._calm_checks += 1
+            if self._calm_checks >= self.down_checks and since_change >= self.down_cooldown:
+                target = workers - 1
+        else:
+            self._calm_checks = 0
+
+        target = max(self.min_workers, min(self.max_workers, target))
+        if target != workers:
+            self._last_change = now
+            self._calm_checks = 0
+            print(f"[AUTOSCALE] backlog {backlog}, oldest job {oldest_age:.0f}s: {workers} -> {target} workers")
+        return target
+
+
+app_cli = typer.Typer()
+
+
+@app_cli.command()
+def main(
+    min_workers: int = typer.Option(1, help="Workers always running"),
+    max_workers: int = typer.Option(20, help="Most workers (also capped by the connection budget)"),
+    prefix: str = typer.Option("w_", help="Worker name prefix"),
+    concurrency: int = typer.Option(1, help="Concurrency per worker"),
+    connection_budget_: int = typer.Option(0, "--connection-budget",
+                                           help="Connections the workers may use (0: from max_connections)"),
+    interval: float = typer.Option(5, help="Seconds between two scaling decisions"),
+):
+    """Standalone autoscaler: runs `run_worker.py` processes (see supervisor.py --autoscale for forked ones)"""
+    from papp.main import app, pgconfig, pool_args
+
+    # every run_worker.py process has its own LISTEN connection
+    autoscaler = Autoscaler(min_workers, max_workers, concurrency, connections_per_worker(app, pool_args, relayed=False),
+                            connection_budget_ or connection_budget(pgconfig))
+    workers: dict[str, subprocess.Popen] = {}
+    retiring: list[subprocess.Popen] = []
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in [*workers.values(), *retiring]:
+            process.send_signal(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while not stopping or any(process.poll() is None for process in [*workers.values(), *retiring]):
+        retiring = [process for process in retiring if process.poll() is None]
+        for name, process in list(workers.items()):
+            if process.poll() is not None:
+                del workers[name] # exited: a new one is started if still needed
+        if not stopping:
+            backlog, oldest_age = sample_backlog(pgconfig, autoscaler.backlog_cap)
+            target = autoscaler.decide(len(workers), backlog, oldest_age)
+            while len(workers) < target:
+                name = next(f"{prefix}{i}" for i in range(1, len(workers) + 2) if f"{prefix}{i}" not in workers)
+                workers[name] = subprocess.Popen([
+                    sys.executable, "run_worker.py", f"--name={name}", f"--concurrency={concurrency}", "--wait",
+                ], start_new_session=True) # signals are forwarded once, by stop()
+            while len(workers) > target:
+                name = max(workers, key=lambda n: int(n.removeprefix(prefix)))
+                process = workers.pop(name)
+                process.send_signal(signal.SIGTERM) # graceful: finishes its running jobs
+                retiring.append(process)
+        time.sleep(interval if not stopping else 0.5)
+
+
+if __name__ == "__main__":
+    app_cli()
@@ -0,0 +1,74 @@
+from procrastinate import manager, sql, utils
+
+from papp.results import BLOB_CTE
+from papp.rollup import rollup_cte
+
+# "completion" persistence mode: only the terminal job_results row is written.
+# The middleware leaves it here and the job manager below writes it together
+# with procrastinate's own job completion.
+
+#: terminal job_results rows waiting for procrastinate to finish (or retry) their job.
+#: Popped by whichever comes first: the job's completion, or its abort in the middleware.
+pending_results: dict[int, dict] = {}
+
+# job_results row of the job, inserted or updated (a retry's earlier RUNNING row)
+# (and the per-minute rollups, see papp/rollup.py)
+RECORD_CTES = f"""{BLOB_CTE},
+{rollup_cte("%(result_status)s")}"""
+RECORD_RESULT = """
+INSERT INTO job_results (job_id, task_name, status, result, error_message,
+                         worker_name, attempt, started_at, finished_at, duration_ms, execution_ms, updated_at)
+VALUES (%(job_id)s, %(task_name)s, %(result_status)s, %(result)s, %(error_message)s,
+        %(worker_name)s, %(attempt)s, %(started_at)s, %(finished_at)s, %(duration_ms)s, %(execution_ms)s, NOW())
+ON CONFLICT (job_id) DO UPDATE SET
+    status = EXCLUDED.status,
+    result = EXCLUDED.result,
+    error_message = EXCLUDED.error_message,
+    worker_name = EXCLUDED.worker_name,
+    attempt = EXCLUDED.attempt,
+    started_at = EXCLUDED.started_at,
+    finished_at = EXCLUDED.finished_at,
+    duration_ms = EXCLUDED.duration_ms,
+    execution_ms = EXCLUDED.execution_ms,
+    updated_at = NOW()
+"""
+
+# large results go to job_result_blobs, in the same statement (see papp/results.py)
+QUERY_RECORD = f"WITH {RECORD_CTES}\n{RECORD_RESULT}"
+
+# A data-modifying CTE runs even if unreferenced: one statement, hence one transaction
+# and one round trip, records the result and finishes (or retries) the job.
+QUERY_RECORD_AND_FINISH = f"WITH {RECORD_CTES},\nrecorded AS ({RECORD_RESULT})\n{sql.queries['finish_job']}"
+QUERY_RECORD_AND_RETRY = f"WITH {RECORD_CTES},\nrecorded AS ({RECORD_RESULT})\n{sql.queries['retry_job']}"
+
+
+class CompletionJobManager(manager.JobManager):
+    """
+    Procrastinate's JobManager, except that jobs with a pending result (see
+    `pending_results`) get it written in the same statement that marks them
+    succeeded/failed or schedules their retry.
+    """
+
+    async def finish_job(self, job, status, delete_job):
+        row = pending_results.pop(job.id, None)
+        if row is None:
+            return await super().finish_job(job=job, status=status, delete_job=delete_job)
+        await self.connector.execute_query_async(
+            QUERY_RECORD_AND_FINISH, **row, status=status.value, delete_job=delete_job
+        )
+
+    async def retry_job(self, job, retry_at=None, priority=None, queue=None, lock=None):
+        row = pending_results.pop(job.id, None)
+        if row is None:
+            return await super().retry_job(
+                job=job, retry_at=retry_at, priority=priority, queue=queue, lock=lock
+            )
+        await self.connector.execute_query_async(
+            QUERY_RECORD_AND_RETRY, **row, retry_at=retry_at or utils.utcnow(),
+            new_priority=priority, new_queue_name=queue, new_lock=lock,
+        )
+
+
+def install(app) -> None:
+    """Makes `app` write pending results along with job completion"""
+    app.job_manager = CompletionJobManager(connector=app.connector)
@@ -0,0 +1,237 @@
+import asyncio
+import contextlib
+import json
+import os
+import select
+import time
+
+import psycopg
+from procrastinate import PsycopgConnector
+from procrastinate.manager import get_channel_for_queues
+
+from papp.store import store
+
+# Connection budget of the workers, after the README's model: C_total = N_w · C_wproc.
+# A worker opens up to its pool's max_size connections, plus a standalone one
+# for LISTEN (procrastinate keeps it out of the pool), plus its result store
+# pool when it has one on the same server (see papp/store.py). `fit_pools`
+# caps the queue pool size so that N_w workers stay within the budget, and
+# fails when even one pool connection per worker does not fit.
+#
+# Behind PgBouncer in transaction pooling mode (`PgBouncerConnector`), the
+# pools talk to PgBouncer and postgres only sees PgBouncer's own server pool,
+# whatever the number of workers. Nothing may rely on session state there:
+# psycopg does not prepare statements, and LISTEN goes straight to postgres,
+# on a single connection per host when the workers are forked by
+# supervisor.py (`NotificationRelay`).
+
+QUERY_CONNECTION_LIMIT = """
+SELECT current_setting('max_connections')::int - current_setting('superuser_reserved_connections')::int
+"""
+#: connections of the budget left to producers, monitoring and the supervisor itself
+CONNECTION_HEADROOM = 10
+#: seconds between attempts to reconnect the relay's lost LISTEN connection
+RELAY_RECONNECT_SECONDS = 5
+
+
+class PgBouncerConnector(PsycopgConnector):
+    """
+    `PsycopgConnector` for PgBouncer in transaction pooling mode. `listen_kwargs`
+    are the connection arguments of postgres itself, for LISTEN. With a
+    `relay_fd` (set by supervisor.py), notifications are read from that pipe
+    instead, and the worker opens no LISTEN connection at all.
+    """
+
+    def __init__(self, *, listen_kwargs: dict, **kwargs):
+        # prepared statements live in a server session, which changes at every transaction
+        kwargs["kwargs"] = {**kwargs.get("kwargs", {}), "prepare_threshold": None}
+        super().__init__(**kwargs)
+        self.listen_kwargs = listen_kwargs
+        self.relay_fd: int | None = None
+
+    @contextlib.asynccontextmanager
+    async def _get_standalone_connection(self):
+        async with await psycopg.AsyncConnection.connect(**self.listen_kwargs, autocommit=True) as connection:
+            yield connection
+
+    async def listen_notify(self, on_notification, channels):
+        if self.relay_fd is None:
+            return await super().listen_notify(on_notification=on_notification, channels=channels)
+        channels = set(channels)
+        reader = asyncio.StreamReader()
+        transport, _ = await asyncio.get_running_loop().connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(self.relay_fd, "rb", buffering=0)
+        )
+        try:
+            while line := await reader.readline():
+                channel, tab, payload = line.decode(errors="replace").rstrip("\n").partition("\t")
+                if not tab or channel not in channels or not is_json(payload):
+                    continue # a malformed line would kill the listener: skip it
+                await on_notification(channel=channel, payload=payload)
+        finally:
+            transport.close()
+
+
+def is_json(payload: str) -> bool:
+    try:
+        json.loads(payload)
+    except ValueError:
+        return False
+    return True
+
+
+def is_pgbouncer(app) -> bool:
+    return isinstance(app.connector, PgBouncerConnector)
+
+
+def connection_budget(pgconfig: dict) -> int:
+    """The connections workers may use: max_connections, minus the reserved ones and some headroom"""
+    with psycopg.connect(**pgconfig, autocommit=True) as conn:
+        (limit,) = conn.execute(QUERY_CONNECTION_LIMIT).fetchone()
+    return limit - CONNECTION_HEADROOM
+
+
+def connections_per_worker(app, pool_args: dict, relayed: bool = True) -> int:
+    """
+    The most postgres connections a worker of `app` opens: its pool (of
+    `pool_args`, see papp/main.py), its LISTEN connection and its result
+    store pool. Behind PgBouncer, only the LISTEN one, and none when
+    `relayed` by the supervisor.
+    """
+    if is_pgbouncer(app):
+        return 0 if relayed else 1
+    return pool_args["max_size"] + 1 + results_pool_size()
+
+
+def results_pool_size() -> int:
+    """Connections of the dedicated result store pool counted in the budget (none on another server)"""
+    return store.pool_size() if store.same_server else 0
+
+
+def fit_pools(app, pool_args: dict, budget: int, workers: int, relayed: bool = True) -> int:
+    """
+    Caps the pool max_size of `app`'s connector, created with `pool_args`
+    (see papp/main.py), so that `workers` workers fit in `budget` postgres
+    connections, and returns it. Raises ValueError when they cannot fit.
+    """
+    size = pool_args["max_size"]
+    if is_pgbouncer(app):
+        listeners = 1 if relayed else workers
+        if listeners > budget:
+            raise ValueError(f"{workers} workers need {listeners} LISTEN connections, over the budget of {budget}")
+        print(f"[BUDGET] Behind PgBouncer: postgres sees PgBouncer's server pool and {listeners} LISTEN "
+              f"connection(s), for {workers} workers of {size} client connections")
+        return size
+    # besides the pool, each worker has its LISTEN connection and maybe a result store pool
+    others = 1 + results_pool_size()
+    described = "1 LISTEN" + (f" + {others - 1} results" if others > 1 else "")
+    fitting = budget // workers - others
+    if fitting < 1:
+        raise ValueError(f"{workers} workers need at least {(1 + others) * workers} connections (a pool connection "
+                         f"and {described} each), over the budget of {budget}: use fewer workers or PgBouncer (DB_PGBOUNCER=1)")
+    if fitting < size:
+        pool_args.update(max_size=fitting, min_size=min(pool_args["min_size"], fitting))
+        # the connector opens its pool with these, once forked (it keeps its own copy)
+        app.connector._pool_args.update(pool_args)
+        print(f"[BUDGET] Pool max_size lowered from {size} to {fitting}: {workers} workers x ({fitting} + {described}) "
+              f"connections within the budget of {budget}")
+        return fitting
+    print(f"[BUDGET] {workers} workers x ({size} + {described}) = {workers * (size + others)} connections, "
+          f"within the budget of {budget}")
+    return size
+
+
+class NotificationRelay:
+    """
+    The single LISTEN connection of a host (supervisor.py): forwards every
+    notification of `channels`, as a "channel<TAB>payload" line, to the pipe of
+    each worker. A worker that falls behind misses notifications, not jobs: it
+    still polls every fetch_job_polling_interval. Only whole lines are written:
+    they go in chunks of at most PIPE_BUF bytes, which a pipe takes whole or not at all.
+    A lost connection is retried every RELAY_RECONNECT_SECONDS (see `reconnect_due`):
+    `connection` is None meanwhile, and the supervisor leaves the relay out of its select.
+    """
+
+    def __init__(self, listen_kwargs: dict, queues: list[str] | None):
+        self.listen_kwargs = listen_kwargs
+        self.channels = list(get_channel_for_queues(queues))
+        self.pipes: dict[str, int] = {}
+        self.connection = None
+        self.reconnect_at: float | None = None
+        self.connect()
+
+    def connect(self):
+        connection = psycopg.connect(**self.listen_kwargs, autocommit=True)
+        for channel in self.channels:
+            connection.execute(psycopg.sql.SQL("LISTEN {}").format(psycopg.sql.Identifier(channel)))
+        self.connection = connection
+
+    def reconnect_due(self):
+        """Reconnects the lost LISTEN connection once its retry is due"""
+        if self.connection is not None or time.monotonic() < self.reconnect_at:
+            return
+        try:
+            self.connect()
+        except psycopg.OperationalError as e:
+            print(f"[RELAY] Reconnection failed ({e!r}), retrying in {RELAY_RECONNECT_SECONDS}s")
+            self.reconnect_at = time.monotonic() + RELAY_RECONNECT_SECONDS
+            return
+        self.reconnect_at = None
+        print("[RELAY] LISTEN connection restored")
+
+    def fileno(self) -> int:
+        return self.connection.fileno()
+
+    def add(self, name: str) -> int:
+        """A new pipe for the worker `name`; returns its read end"""
+        self.remove(name)
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(write_fd, False)
+        self.pipes[name] = write_fd
+        return read_fd
+
+    def remove(self, name: str):
+        write_fd = self.pipes.pop(name, None)
+        if write_fd is not None:
+            os.close(write_fd)
+
+    def close_in_child(self):
+        """In a forked worker: drops the inherited descriptors, without closing the supervisor's session"""
+        for write_fd in self.pipes.values():
+            os.close(write_fd)
+        if self.connection is not None:
+            os.close(self.connection.fileno())
+
+    def forward(self):
+        """Forwards the notifications received so far"""
+        try:
+            notifications = list(self.connection.notifies(timeout=0))
+        except psycopg.OperationalError as e:
+            print(f"[RELAY] LISTEN connection lost ({e!r}), reconnecting")
+            self.connection.close()
+            # left out of the supervisor's select until reconnected; workers keep polling meanwhile
+            self.connection, self.reconnect_at = None, time.monotonic()
+            self.reconnect_due()
+            return
+        chunks = pipe_chunks(f"{n.channel}\t{n.payload}\n".encode() for n in notifications)
+        for write_fd in self.pipes.values():
+            for chunk in chunks:
+                try:
+                    os.write(write_fd, chunk)
+                except (BlockingIOError, BrokenPipeError):
+                    break # the pipe is full: this worker misses the rest
+
+
+def pipe_chunks(lines) -> list[bytes]:
+    """`lines` joined in chunks of at most PIPE_BUF bytes; a longer line is dropped"""
+    chunks, chunk = [], b""
+    for line in lines:
+        if len(line) > select.PIPE_BUF:
+            continue
+        if len(chunk) + len(line) > select.PIPE_BUF:
+            chunks.append(chunk)
+            chunk = b""
+        chunk += line
+    if chunk:
+        chunks.append(chunk)
+    return chunks
@@ -9,6 +9,9 @@ import random
 import time
 from procrastinate import JobContext
 import json
+from papp import completion, prefetch, shards
+from papp.connections import PgBouncerConnector
+from papp.store import store
 
 #from tasks import sum_with_persistence
 
@@ -20,11 +23,45 @@ pgconfig = {"host": os.environ["DB_HOST"],
             "password": os.environ["DB_PASSWORD"],
             "dbname": os.environ["DB_NAME"]}
 
-app = App(
-    connector=PsycopgConnector( # learn more about connectors: https://procrastinate.readthedocs.io/en/stable/howto/basics/connector.html
+# with DB_SHARDS, this process works on shard SHARD only (see papp/shards.py)
+shard_configs = shards.shard_pgconfigs(pgconfig)
+shard = shards.shard_index(len(shard_configs))
+pgconfig = shard_configs[shard]
+
+# per worker process; supervisor.py lowers max_size to fit the connection budget (see papp/connections.py)
+pool_args = {"min_size": int(os.environ.get("DB_POOL_MIN_SIZE", 1)),
+             "max_size": int(os.environ.get("DB_POOL_MAX_SIZE", 2))}
+
+if os.environ.get("DB_PGBOUNCER", "0") == "1":
+    # DB_HOST/DB_PORT point to PgBouncer (transaction pooling), LISTEN goes straight to postgres
+    connector = PgBouncerConnector(
+        kwargs=pgconfig,
+        listen_kwargs={**pgconfig,
+                       "host": os.environ.get("DB_LISTEN_HOST", pgconfig["host"]),
+                       "port": os.environ.get("DB_LISTEN_PORT", "5432")},
+        **pool_args,
+    )
+else:
+    connector = PsycopgConnector( # learn more about connectors: https://procrastinate.readthedocs.io/en/stable/howto/basics/connector.html
         kwargs=pgconfig,
-        min_size=1,
-        max_size=2,
-    ),
+        **pool_args,
+    )
+
+# job_results writes: a dedicated pool with RESULTS_POOL_MAX_SIZE, the queue's otherwise (see papp/store.py)
+if int(os.environ.get("RESULTS_POOL_MAX_SIZE", 0)):
+    store.configure(
+        pgconfig,
+        min_size=int(os.environ.get("RESULTS_POOL_MIN_SIZE", 1)),
+        max_size=int(os.environ["RESULTS_POOL_MAX_SIZE"]),
+        **({"prepare_threshold": None} if isinstance(connector, PgBouncerConnector) else {}),
+    )
+
+app = App(
+    connector=connector,
     import_paths=["papp.tasks"]  # where to find tasks (can be a list
 )
+# lets "completion" persistence mode tasks write their result with the job's completion
+completion.install(app)
+# claims up to PREFETCH_JOBS jobs per fetch query, buffered up to the worker's concurrency (see papp/prefetch.py)
+if int(os.environ.get("PREFETCH_JOBS", 1)) > 1:
+    prefetch.install(app, batch_size=int(os.environ["PREFETCH_JOBS"]))
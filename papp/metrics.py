@@ -0,0 +1,214 @@
+import asyncio
+import datetime
+import json
+from array import array
+
+# In-worker latency histograms. Each worker records the duration of every run
+# in an HDR-style histogram per (task, metric): fixed memory, log-linear buckets
+# with a relative error under 1/HALF_SUB_BUCKETS. Every `flush_seconds` the
+# histograms of the interval are written, as sparse bucket counts, to
+# worker_metrics (one row per task and metric) and reset. Summing the buckets
+# of any set of rows, across workers and intervals, gives exact percentiles of
+# the union (within the bucket precision): see `merge_rows`.
+
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_SUB_BUCKETS = SUB_BUCKETS // 2
+#: values are recorded in microseconds, up to ~2^MAX_VALUE_BITS µs (about 9.5 hours); larger ones are clamped
+MAX_VALUE_BITS = 35
+BUCKETS = SUB_BUCKETS + (MAX_VALUE_BITS - SUB_BUCKET_BITS) * HALF_SUB_BUCKETS
+
+INSERT_METRICS = """
+INSERT INTO worker_metrics (worker_name, task_name, metric, period_start, period_end, count, sum_ms, max_ms, buckets)
+SELECT * FROM unnest(
+    %(worker_name)s::varchar[], %(task_name)s::varchar[], %(metric)s::varchar[],
+    %(period_start)s::timestamptz[], %(period_end)s::timestamptz[],
+    %(count)s::bigint[], %(sum_ms)s::float8[], %(max_ms)s::float8[], %(buckets)s::jsonb[]
+)
+"""
+
+
+def bucket_index(value_us: int) -> int:
+    """Index of the bucket holding `value_us` (microseconds)"""
+    if value_us < SUB_BUCKETS:
+        return max(value_us, 0)
+    shift = min(value_us.bit_length(), MAX_VALUE_BITS) - SUB_BUCKET_BITS
+    sub = min(value_us >> shift, SUB_BUCKETS - 1)
+    return SUB_BUCKETS + (shift - 1) * HALF_SUB_BUCKETS + sub - HALF_SUB_BUCKETS
+
+
+def bucket_value(index: int) -> float:
+    """Middle of the bucket `index`, in microseconds"""
+    if index < SUB_BUCKETS:
+        return float(index)
+    shift = (index - SUB_BUCKETS) // HALF_SUB_BUCKETS + 1
+    sub = (index - SUB_BUCKETS) % HALF_SUB_BUCKETS + HALF_SUB_BUCKETS
+    return (sub << shift) + (1 << shift) / 2
+
+
+class Histogram:
+    """Fixed-size latency histogram (counts per bucket), in milliseconds"""
+
+    __slots__ = ("counts", "count", "sum_ms", "max_ms")
+
+    def __init__(self):
+        self.counts = array("Q", bytes(8 * BUCKETS))
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, value_ms: float):
+        self.counts[bucket_index(int(value_ms * 1000))] += 1
+        self.count += 1
+        self.sum_ms += value_ms
+        if value_ms > self.max_ms:
+            self.max_ms = value_ms
+
+    def merge(self, other: "Histogram"):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.sum_ms += other.sum_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+
+    def to_buckets(self) -> dict[str, int]:
+        """Sparse bucket counts, as stored in worker_metrics.buckets"""
+        return {str(index): count for index, count in enumerate(self.counts) if count}
+
+    @classmethod
+    def from_row(cls, count: int, sum_ms: float, max_ms: float, buckets: dict | str) -> "Histogram":
+        """The histogram of a worker_metrics row"""
+        histogram = cls()
+        if isinstance(buckets, str):
+            buckets = json.loads(buckets)
+        for index, bucket_count in buckets.items():
+            histogram.counts[int(index)] += bucket_count
+        histogram.count, histogram.sum_ms, histogram.max_ms = count, sum_ms, max_ms
+        return histogram
+
+    def percentile(self, p: float) -> float | None:
+        """The `p`th percentile (0-100) in milliseconds, None when empty"""
+        if not self.count:
+            return None
+        rank = max(1, round(p / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bucket_value(index) / 1000, self.max_ms)
+        return self.max_ms
+
+
+def merge_rows(rows) -> dict[tuple[str, str], Histogram]:
+    """
+    Merges worker_metrics rows (dicts or tuples of task_name, metric, count,
+    sum_ms, max_ms, buckets) into one histogram per (task_name, metric)
+    """
+    merged: dict[tuple[str, str], Histogram] = {}
+    for row in rows:
+        if isinstance(row, dict):
+            row = (row["task_name"], row["metric"], row["count"], row["sum_ms"], row["max_ms"], row["buckets"])
+        task_name, metric, count, sum_ms, max_ms, buckets = row
+        histogram = Histogram.from_row(count, sum_ms, max_ms, buckets)
+        if (task_name, metric) in merged:
+            merged[task_name, metric].merge(histogram)
+        else:
+            merged[task_name, metric] = histogram
+    return merged
+
+
+class MetricsRecorder:
+    """
+    Per-worker-process histograms of run timings, by (worker, task, metric),
+    flushed to worker_metrics every `flush_seconds` (one statement per flush,
+    whatever the number of jobs). Call `close()` (or `flush_all_metrics()`)
+    before the worker's connector is closed to write the last interval.
+    """
+
+    instances: list["MetricsRecorder"] = []
+
+    def __init__(self, flush_seconds: float = 5.0):
+        self.flush_seconds = flush_seconds
+        self._connector = None
+        self._timer: asyncio.Task | None = None
+        self._flushing: asyncio.Future | None = None
+        self._histograms: dict[tuple[str, str, str], Histogram] = {}
+        self._period_start = None
+        MetricsRecorder.instances.append(self)
+
+    def record(self, connector, worker_name: str, task_name: str, **values_ms):
+        """Records the `values_ms` (e.g. duration_ms=...) of a finished run; None values are skipped"""
+        if self._timer is None:
+            # first use: bind to the worker's connector and event loop
+            self._connector = connector
+            self._period_start = _now()
+            self._timer = asyncio.create_task(self._flush_periodically(), name="metrics flush")
+        for metric, value in values_ms.items():
+            if value is None:
+                continue
+            key = (worker_name or "", task_name, metric)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.record(value)
+
+    async def flush(self):
+        """Writes the histograms of the current interval and starts a new one"""
+        if self._connector is None or not self._histograms:
+            return
+        histograms, self._histograms = self._histograms, {}
+        period_start, period_end = self._period_start, _now()
+        self._period_start = period_end
+        keys = list(histograms)
+        try:
+            await self._connector.execute_query_async(
+                INSERT_METRICS,
+                worker_name=[key[0] for key in keys],
+                task_name=[key[1] for key in keys],
+                metric=[key[2] for key in keys],
+                period_start=[period_start] * len(keys),
+                period_end=[period_end] * len(keys),
+                count=[histograms[key].count for key in keys],
+                sum_ms=[histograms[key].sum_ms for key in keys],
+                max_ms=[histograms[key].max_ms for key in keys],
+                buckets=[histograms[key].to_buckets() for key in keys],
+            )
+        except Exception as e:
+            print(f"[METRICS] Failed to write {len(keys)} histograms: {e!r}")
+            # merged into the next interval
+            for key, histogram in histograms.items():
+                self._histograms.setdefault(key, Histogram()).merge(histogram)
+            self._period_start = period_start
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            self._flushing = asyncio.ensure_future(self.flush())
+            await asyncio.shield(self._flushing)
+
+    async def close(self):
+        """Stops the periodic flush and writes the last interval"""
+        if self._timer is None:
+            return
+        timer, self._timer = self._timer, None
+        timer.cancel()
+        await asyncio.gather(timer, return_exceptions=True)
+        # the cancelled timer leaves its shielded flush running: it must end before the connector closes
+        if self._flushing is not None:
+            await asyncio.gather(self._flushing, return_exceptions=True)
+        await self.flush()
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+#: the recorder of the worker process, used by the middleware
+recorder = MetricsRecorder()
+
+
+async def flush_all_metrics():
+    """Writes the last interval of every recorder. Call it on worker shutdown."""
+    for instance in MetricsRecorder.instances:
+        await instance.close()
@@ -0,0 +1,58 @@
+import asyncio
+import random
+
+import psycopg
+
+# Coalesced job notifications (`orchestrator.py --coalesce-notify`).
+# procrastinate's insert trigger sends two NOTIFYs per job (its queue's channel
+# and the "any queue" one): a 5000-job chunk queues 10000 notifications, which
+# the committing transaction writes under postgres' global notify lock, while
+# the other producers' commits wait on it, and which every listening worker
+# then parses, waking up again and again to race on SKIP LOCKED.
+#
+# `python init_db.py --coalesce-notify` (after `procrastinate schema --apply`)
+# makes the trigger skip the jobs inserted by
+# `papp_defer_jobs_coalesced`: same jobs as procrastinate_defer_jobs_v1, but
+# one notification per queue of the chunk (on both channels). Workers only
+# read the notification type, so one per chunk wakes them all the same.
+#
+# `stagger_wakeups` (`--wakeup-jitter-ms`) spreads the workers' reactions over
+# a random delay, and folds the notifications received meanwhile into one wake-up.
+
+#: transaction-local setting muting the per-job trigger
+COALESCE_SETTING = "papp.coalesce_notify"
+
+# a fresh `procrastinate schema --apply` brings back the original trigger function
+QUERY_INSTALLED = """
+SELECT to_regproc('papp_defer_jobs_coalesced') IS NOT NULL
+   AND EXISTS (SELECT FROM pg_proc WHERE proname = 'procrastinate_notify_queue_job_inserted_v1' AND prosrc LIKE %s)
+"""
+
+
+def installed(pgconfig: dict) -> bool:
+    """Whether the database of `pgconfig` has the coalesced defer function, and the trigger it mutes"""
+    with psycopg.connect(**pgconfig, autocommit=True) as conn:
+        (found,) = conn.execute(QUERY_INSTALLED, (f"%{COALESCE_SETTING}%",)).fetchone()
+    return found
+
+
+def stagger_wakeups(worker, jitter: float):
+    """
+    Makes `worker` look for new jobs a random 0..`jitter` seconds after a
+    job notification, instead of at once. Call it before the worker runs.
+    """
+    handle_notification = worker._handle_notification
+    wake_at = 0.0
+
+    async def staggered(*, channel, notification):
+        nonlocal wake_at
+        if notification["type"] != "job_inserted":
+            return await handle_notification(channel=channel, notification=notification)
+        loop = asyncio.get_running_loop()
+        if loop.time() >= wake_at:
+            # notifications arriving before the wake-up are folded into it
+            delay = random.uniform(0, jitter)
+            wake_at = loop.time() + delay
+            loop.call_later(delay, worker._new_job_event.set)
+
+    worker._handle_notification = staggered
@@ -0,0 +1,121 @@
+import datetime
+import re
+
+# Maintenance of the partitioned job_results schema (`python init_db.py --partition jobs`):
+# job_results and job_result_blobs are range-partitioned by job_id, with one partition
+# per `size` consecutive job ids named <table>_p<first job id>. job_id stays the primary
+# key, so writers upsert with ON CONFLICT (job_id) and every write names its partition.
+# Upcoming partitions are created in advance, and retention drops whole partitions (once
+# their newest row is older than the retention) instead of DELETEing rows.
+# Rows outside every partition land in the <table>_default partition, and are moved out
+# of it when their partition is created.
+
+TABLES = ("job_results", "job_result_blobs")
+#: job ids per partition (init_db.py --partition-size)
+DEFAULT_SIZE = 1_000_000
+#: partitions created ahead of the current one
+AHEAD = 2
+
+QUERY_PARTITIONS = """
+SELECT parent.relname AS table, child.relname AS name, pg_get_expr(child.relpartbound, child.oid) AS bound
+FROM pg_inherits
+JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+WHERE parent.relname = ANY(%(tables)s)
+"""
+# the highest job id recorded so far (a backward scan of each partition's primary key)
+QUERY_MAX_JOB_ID = "SELECT max(job_id) AS job_id FROM job_results"
+# job_results.created_at is a TIMESTAMP filled by NOW(): ages follow the server's clock and time zone
+QUERY_NOW = "SELECT LOCALTIMESTAMP AS now"
+# age of a partition: the creation time of its highest job id (NULL if it is empty)
+QUERY_NEWEST = "SELECT (SELECT created_at FROM {name} ORDER BY job_id DESC LIMIT 1) AS created_at"
+
+BOUND = re.compile(r"^FOR VALUES FROM \('?(?P<lower>\d+)'?\) TO \('?(?P<upper>\d+)'?\)$")
+
+
+def partition_name(table: str, lower: int) -> str:
+    return f"{table}_p{lower:012d}"
+
+
+def parse_bound(bound: str) -> tuple[int, int] | None:
+    """(lower, upper) job ids of a partition bound, None for the default partition"""
+    match = BOUND.match(bound)
+    return (int(match["lower"]), int(match["upper"])) if match else None
+
+
+def create_statement(table: str, lower: int, upper: int) -> str:
+    """
+    DDL creating the partition of `table` for job ids [lower, upper).
+    Rows of that range which landed in the default partition are moved to
+    it first: postgres refuses to create a partition whose rows sit in the
+    default one. A DO block is a single statement, so this is one transaction.
+    """
+    name = partition_name(table, lower)
+    return f"""
+DO $$
+BEGIN
+    CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE);
+    WITH moved AS (
+        DELETE FROM {table}_default WHERE job_id >= {lower} AND job_id < {upper} RETURNING *
+    )
+    INSERT INTO {name} SELECT * FROM moved;
+    ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ({lower}) TO ({upper});
+END $$"""
+
+
+def create_statements(size: int, max_job_id: int, existing: set[str] = frozenset(),
+                      ahead: int = AHEAD) -> list[str]:
+    """DDL creating the partition of `max_job_id` and the `ahead` next ones (those not in `existing`) of every table"""
+    start = max_job_id // size * size
+    statements = []
+    for n in range(ahead + 1):
+        lower = start + n * size
+        for table in TABLES:
+            if partition_name(table, lower) not in existing:
+                statements.append(create_statement(table, lower, lower + size))
+    return statements
+
+
+def expired_partitions(newest: dict[str, datetime.datetime | None], now: datetime.datetime,
+                       retention: datetime.timedelta) -> list[str]:
+    """
+    The partitions whose rows are all older than `retention`, from the
+    creation time of their newest row (None for an empty partition).
+    Only pass partitions below the current one: an empty one is then done with.
+    """
+    return sorted(name for name, created_at in newest.items() if created_at is None or created_at <= now - retention)
+
+
+async def maintain(connector, retention: datetime.timedelta) -> tuple[int, list[str]]:
+    """
+    Creates the upcoming partitions and drops the expired ones, through a
+    procrastinate connector. No-op on the unpartitioned schema.
+    Returns the number of partitions created and the names of the dropped ones.
+    """
+    rows = await connector.execute_query_all_async(QUERY_PARTITIONS, tables=list(TABLES))
+    ranges = {row["name"]: bound for row in rows if (bound := parse_bound(row["bound"]))}
+    if not ranges:
+        return 0, []
+    # partitions all have the size init_db.py gave them
+    size = max(upper - lower for lower, upper in ranges.values())
+    max_job_id = (await connector.execute_query_one_async(QUERY_MAX_JOB_ID))["job_id"]
+    if max_job_id is None:
+        max_job_id = min(lower for lower, _ in ranges.values())
+    statements = create_statements(size, max_job_id, set(ranges))
+    for statement in statements:
+        await connector.execute_query_async(statement)
+
+    current = max_job_id // size * size
+    newest = {}
+    for name, (lower, upper) in ranges.items():
+        if name.startswith("job_results_p") and upper <= current:
+            newest[name] = (await connector.execute_query_one_async(QUERY_NEWEST.format(name=name)))["created_at"]
+    now = (await connector.execute_query_one_async(QUERY_NOW))["now"]
+    dropped = []
+    for name in expired_partitions(newest, now, retention):
+        lower, _ = ranges[name]
+        # takes a short ACCESS EXCLUSIVE lock on the parent table, unlike a DELETE of its rows
+        for table in TABLES:
+            await connector.execute_query_async(f"DROP TABLE IF EXISTS {partition_name(table, lower)}")
+        dropped.append(name)
+    return len(statements), dropped
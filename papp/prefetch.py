@@ -0,0 +1,128 @@
+import collections
+
+from procrastinate import jobs
+
+from papp.completion import CompletionJobManager
+
+# Prefetch mode (PREFETCH_JOBS=K): procrastinate claims one job per fetch_job
+# query, so a worker makes at least one round trip per job just to get it.
+# `PrefetchJobManager` claims up to K jobs in one statement, with the same
+# candidate conditions as procrastinate_fetch_job_v2 (locks, priority, queues,
+# scheduled_at, SKIP LOCKED), and serves the next fetch_job calls from a local
+# buffer. The buffer never holds more than the worker's concurrency: the jobs
+# in it wait at most for a slot to free up.
+#
+# Buffered jobs are "doing" (their "started" event is written at claim time)
+# and belong to the worker: if it dies, procrastinate's stalled job recovery
+# applies to them as to running ones. On shutdown, `release` puts the ones it
+# did not start back to "todo".
+
+# procrastinate_fetch_job_v2, for up to %(limit)s jobs; within a batch, at most one job per lock
+# (the NOT EXISTS rejects a todo job when another todo job of its lock comes first)
+QUERY_CLAIM_JOBS = """
+WITH candidate AS (
+    SELECT jobs.id
+        FROM procrastinate_jobs AS jobs
+        WHERE
+            NOT EXISTS (
+                SELECT 1
+                    FROM procrastinate_jobs AS other_jobs
+                    WHERE
+                        jobs.lock IS NOT NULL
+                        AND other_jobs.lock = jobs.lock
+                        AND (
+                            other_jobs.status = 'doing'
+                            OR (
+                                other_jobs.status = 'todo'
+                                AND (
+                                    other_jobs.priority > jobs.priority
+                                    OR (other_jobs.priority = jobs.priority AND other_jobs.id < jobs.id)
+                                )
+                            )
+                        )
+            )
+            AND jobs.status = 'todo'
+            AND (%(queues)s::varchar[] IS NULL OR jobs.queue_name = ANY(%(queues)s::varchar[]))
+            AND (jobs.scheduled_at IS NULL OR jobs.scheduled_at <= now())
+        ORDER BY jobs.priority DESC, jobs.id ASC
+        LIMIT %(limit)s
+        FOR UPDATE OF jobs SKIP LOCKED
+)
+UPDATE procrastinate_jobs
+    SET status = 'doing', worker_id = %(worker_id)s
+    FROM candidate
+    WHERE procrastinate_jobs.id = candidate.id
+    RETURNING procrastinate_jobs.id, status, task_name, priority, lock, queueing_lock, args, scheduled_at,
+              queue_name, attempts, procrastinate_jobs.worker_id
+"""
+
+# the worker may already be unregistered (worker_id is then NULL): the ids are enough.
+# A job whose abort was requested meanwhile cannot go back to todo: it is aborted.
+QUERY_RELEASE_JOBS = """
+UPDATE procrastinate_jobs
+    SET status = CASE WHEN abort_requested THEN 'aborted'::procrastinate_job_status
+                      ELSE 'todo'::procrastinate_job_status END,
+        worker_id = NULL
+    WHERE id = ANY(%(ids)s) AND status = 'doing'
+"""
+
+
+class PrefetchJobManager(CompletionJobManager):
+    """
+    `CompletionJobManager` claiming up to `batch_size` jobs per fetch query
+    and buffering the ones the worker did not ask for yet. With a
+    `batch_size` of 1, fetches go through procrastinate's own query.
+    """
+
+    def __init__(self, *args, batch_size: int = 1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_size = batch_size
+        self.buffer: collections.deque[jobs.Job] = collections.deque()
+
+    async def fetch_job(self, queues, worker_id):
+        if self.batch_size <= 1:
+            return await super().fetch_job(queues=queues, worker_id=worker_id)
+        if not self.buffer:
+            self.buffer.extend(await self.claim_jobs(queues=queues, worker_id=worker_id, limit=self.batch_size))
+        return self.buffer.popleft() if self.buffer else None
+
+    async def claim_jobs(self, queues, worker_id, limit: int) -> list[jobs.Job]:
+        """Claims up to `limit` jobs in one round trip, in procrastinate's order"""
+        rows = await self.connector.execute_query_all_async(
+            QUERY_CLAIM_JOBS, queues=queues, worker_id=worker_id, limit=limit
+        )
+        # RETURNING does not keep the candidate order
+        rows.sort(key=lambda row: (-row["priority"], row["id"]))
+        return [jobs.Job.from_row(row) for row in rows]
+
+    async def release(self) -> int:
+        """Puts the buffered jobs back to todo; returns how many"""
+        if not self.buffer:
+            return 0
+        ids = [job.id for job in self.buffer]
+        self.buffer.clear()
+        await self.connector.execute_query_async(QUERY_RELEASE_JOBS, ids=ids)
+        return len(ids)
+
+
+def install(app, batch_size: int) -> None:
+    """Makes `app`'s workers claim up to `batch_size` jobs per fetch query"""
+    app.job_manager = PrefetchJobManager(connector=app.connector, batch_size=batch_size)
+
+
+def fit_buffer(app, concurrency: int) -> None:
+    """Sizes the prefetch buffer of `app` to the worker's `concurrency`"""
+    manager = app.job_manager
+    if isinstance(manager, PrefetchJobManager) and manager.batch_size > concurrency:
+        print(f"[PREFETCH] Claiming {concurrency} jobs per fetch (PREFETCH_JOBS={manager.batch_size}, "
+              f"over the worker's concurrency)")
+        manager.batch_size = concurrency
+
+
+async def release(app) -> None:
+    """Puts the jobs `app`'s worker claimed but did not start back to todo (call it once the worker stopped)"""
+    manager = app.job_manager
+    if isinstance(manager, PrefetchJobManager):
+        released = await manager.release()
+        if released:
+            print(f"[PREFETCH] Released {released} claimed jobs")
@@ -0,0 +1,192 @@
+import asyncio
+import time
+
+from papp.prefetch import PrefetchJobManager
+from papp.store import store
+
+# Optional Prometheus endpoint of a worker process (`run_worker.py --metrics-port`).
+# `install` swaps in a job manager that counts fetches and outcomes, and `serve`
+# starts a small HTTP server on the worker's own event loop (asyncio streams,
+# no thread, no extra dependency) answering every request with the text format.
+# Rendering reads a few counters: a scrape never waits on the database.
+
+#: upper bounds (seconds) of the fetch latency histogram buckets
+FETCH_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+#: interval (seconds) of the event loop lag probe
+LAG_PROBE_INTERVAL = 0.1
+
+
+class WorkerStats:
+    """Counters of a worker process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.worker_name = ""
+        self.concurrency = 0
+        self.effective_concurrency = None
+        self.started = 0
+        self.finished: dict[str, int] = {}
+        self.retried = 0
+        self.fetch_buckets = [0] * len(FETCH_BUCKETS)
+        self.fetch_count = 0
+        self.fetch_seconds = 0.0
+        self.fetch_queries = 0
+        self.loop_lag = 0.0
+        self.loop_lag_max = 0.0
+        self.pools: dict[str, object] = {}
+
+    def observe_fetch(self, seconds: float):
+        self.fetch_count += 1
+        self.fetch_seconds += seconds
+        for i, bound in enumerate(FETCH_BUCKETS):
+            if seconds <= bound:
+                self.fetch_buckets[i] += 1
+                break
+
+    @property
+    def in_flight(self) -> int:
+        return self.started - sum(self.finished.values()) - self.retried
+
+    def render(self) -> str:
+        worker = f'worker="{self.worker_name}"'
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{{{worker}{labels}}} {value}")
+
+        metric("procrastinate_worker_jobs_started_total", "counter", "Jobs fetched by the worker", [("", self.started)])
+        metric("procrastinate_worker_jobs_finished_total", "counter", "Jobs finished by the worker, by status",
+               [(f',status="{status}"', count) for status, count in sorted(self.finished.items())])
+        metric("procrastinate_worker_jobs_retried_total", "counter", "Jobs scheduled for a retry", [("", self.retried)])
+        metric("procrastinate_worker_jobs_in_flight", "gauge", "Jobs being processed", [("", self.in_flight)])
+        metric("procrastinate_worker_concurrency", "gauge", "The worker's --concurrency", [("", self.concurrency)])
+        if self.effective_concurrency is not None:
+            metric("procrastinate_worker_effective_concurrency", "gauge",
+                   "Jobs the worker may run at once (--adaptive limit)", [("", self.effective_concurrency)])
+
+        cumulative, buckets = 0, []
+        for bound, count in zip(FETCH_BUCKETS, self.fetch_buckets):
+            cumulative += count
+            buckets.append((f',le="{bound}"', cumulative))
+        buckets.append((',le="+Inf"', self.fetch_count))
+        lines.append("# HELP procrastinate_worker_fetch_seconds Duration of the fetch_job calls, empty ones included")
+        lines.append("# TYPE procrastinate_worker_fetch_seconds histogram")
+        lines.extend(f"procrastinate_worker_fetch_seconds_bucket{{{worker}{labels}}} {value}" for labels, value in buckets)
+        lines.append(f"procrastinate_worker_fetch_seconds_sum{{{worker}}} {self.fetch_seconds}")
+        lines.append(f"procrastinate_worker_fetch_seconds_count{{{worker}}} {self.fetch_count}")
+        metric("procrastinate_worker_fetch_queries_total", "counter",
+               "Fetch queries sent to the database (fewer than fetches with PREFETCH_JOBS)", [("", self.fetch_queries)])
+
+        metric("procrastinate_worker_event_loop_lag_seconds", "gauge", "Last delay of a timer on the event loop",
+               [("", self.loop_lag)])
+        metric("procrastinate_worker_event_loop_lag_max_seconds", "gauge", "Largest delay since the last scrape",
+               [("", self.loop_lag_max)])
+        self.loop_lag_max = self.loop_lag
+
+        if self.pools:
+            # psycopg_pool statistics (keys are missing until their first event), by pool: "queue", "results"
+            pools = {f',pool="{name}"': pool.get_stats() for name, pool in self.pools.items()}
+
+            def pool_metric(name, kind, help_text, key, scale=None):
+                metric(name, kind, help_text,
+                       [(labels, s.get(key, 0) / scale if scale else s.get(key, 0)) for labels, s in pools.items()])
+
+            pool_metric("procrastinate_worker_pool_size", "gauge", "Connections in the pool", "pool_size")
+            pool_metric("procrastinate_worker_pool_available", "gauge", "Idle connections in the pool", "pool_available")
+            pool_metric("procrastinate_worker_pool_requests_waiting", "gauge", "Tasks waiting for a connection",
+                        "requests_waiting")
+            pool_metric("procrastinate_worker_pool_requests_total", "counter", "Connection checkouts", "requests_num")
+            pool_metric("procrastinate_worker_pool_requests_queued_total", "counter", "Checkouts that had to wait",
+                        "requests_queued")
+            pool_metric("procrastinate_worker_pool_checkout_wait_seconds_total", "counter",
+                        "Time spent waiting for a connection", "requests_wait_ms", scale=1000)
+        return "\n".join(lines) + "\n"
+
+
+#: the stats of the worker process
+stats = WorkerStats()
+
+
+class InstrumentedJobManager(PrefetchJobManager):
+    """`PrefetchJobManager` counting fetches, fetch queries and job outcomes in `stats`"""
+
+    async def fetch_job(self, queues, worker_id):
+        start = time.perf_counter()
+        job = await super().fetch_job(queues=queues, worker_id=worker_id)
+        stats.observe_fetch(time.perf_counter() - start)
+        if self.batch_size <= 1:
+            stats.fetch_queries += 1
+        if job is not None:
+            stats.started += 1
+        return job
+
+    async def claim_jobs(self, queues, worker_id, limit):
+        claimed = await super().claim_jobs(queues=queues, worker_id=worker_id, limit=limit)
+        stats.fetch_queries += 1
+        return claimed
+
+    async def finish_job(self, job, status, delete_job):
+        await super().finish_job(job=job, status=status, delete_job=delete_job)
+        stats.finished[status.value] = stats.finished.get(status.value, 0) + 1
+
+    async def retry_job(self, job, retry_at=None, priority=None, queue=None, lock=None):
+        await super().retry_job(job=job, retry_at=retry_at, priority=priority, queue=queue, lock=lock)
+        stats.retried += 1
+
+
+def install(app, worker_name: str, concurrency: int) -> None:
+    """Makes `app` count the jobs of this worker in `stats`"""
+    stats.worker_name = worker_name
+    stats.concurrency = concurrency
+    # keeps the prefetch batch size of papp/main.py, if any
+    app.job_manager = InstrumentedJobManager(
+        connector=app.connector, batch_size=getattr(app.job_manager, "batch_size", 1)
+    )
+
+
+async def _probe_loop_lag():
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_PROBE_INTERVAL)
+        stats.loop_lag = max(time.perf_counter() - start - LAG_PROBE_INTERVAL, 0.0)
+        stats.loop_lag_max = max(stats.loop_lag_max, stats.loop_lag)
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        # the request itself does not matter: every path serves the metrics
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        body = stats.render().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(app, port: int, host: str = "0.0.0.0") -> asyncio.Task:
+    """
+    Serves the metrics on `port` until the returned task is cancelled.
+    Call it once the app and the result store are open (the pool statistics come from their connectors).
+    """
+    for name, connector in (("queue", app.connector), ("results", store.connector)):
+        pool = getattr(connector, "_async_pool", None)
+        if pool is not None:
+            stats.pools[name] = pool
+    server = await asyncio.start_server(_handle, host, port)
+    print(f"[METRICS] Serving Prometheus metrics on http://{host}:{port}/metrics")
+
+    async def run():
+        lag_probe = asyncio.create_task(_probe_loop_lag(), name="event loop lag probe")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            lag_probe.cancel()
+
+    return asyncio.create_task(run(), name="metrics endpoint")
@@ -0,0 +1,113 @@
+import json
+import zlib
+
+from psycopg.types.json import Jsonb
+
+# Result storage: results up to INLINE_MAX_BYTES (as JSON) stay inline in
+# job_results.result. Larger ones are compressed and written once to the
+# append-only job_result_blobs table (by job_id), and job_results.result
+# keeps a small stub: the top-level fields up to SUMMARY_MAX_BYTES (so queries on
+# e.g. result->>'result' still work) plus the BLOB_MARKER key. Status updates
+# then rewrite a few dozen bytes instead of re-TOASTing the whole result
+# (a result that is not a JSON object keeps the marker only).
+# Use `decode_result` / `load_result` to read results back.
+
+INLINE_MAX_BYTES = 1024
+SUMMARY_MAX_BYTES = 64
+BLOB_MARKER = "$blob"
+
+# codec name -> (compress, decompress); zstd (Python 3.14+ or the zstandard
+# package) or lz4 when available, zlib otherwise
+CODECS = {"zlib": (lambda data: zlib.compress(data, 1), zlib.decompress)}
+try:
+    from compression import zstd
+    CODECS["zstd"] = (zstd.compress, zstd.decompress)
+except ImportError:
+    try:
+        import zstandard
+        CODECS["zstd"] = (zstandard.compress, zstandard.decompress)
+    except ImportError:
+        pass
+try:
+    import lz4.frame
+    CODECS["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+DEFAULT_CODEC = next(codec for codec in ("zstd", "lz4", "zlib") if codec in CODECS)
+
+# Data-modifying CTE writing the blob of one job, if it has one. Statements that
+# record a result put it in front of their own, so the blob and the job_results
+# row are written by the same statement (and transaction).
+BLOB_CTE = """blob AS (
+    INSERT INTO job_result_blobs (job_id, codec, raw_size, data)
+    SELECT %(job_id)s, %(blob_codec)s, %(blob_raw_size)s, %(blob_data)s::bytea
+    WHERE %(blob_data)s::bytea IS NOT NULL
+)"""
+
+# a job's result is normally recorded once; if it was recorded twice (a retried flush), the last blob wins
+QUERY_LOAD_RESULT = """
+SELECT r.result, b.codec, b.data
+FROM job_results r
+LEFT JOIN LATERAL (
+    SELECT codec, data FROM job_result_blobs
+    WHERE job_result_blobs.job_id = r.job_id ORDER BY created_at DESC LIMIT 1
+) b ON true
+WHERE r.job_id = %(job_id)s
+"""
+
+
+def _codec(codec: str):
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise ValueError(f"Result codec {codec!r} is not available here (available: {', '.join(CODECS)}): "
+                         f"install its package (zstd: zstandard, lz4: lz4)") from None
+
+
+def encode_result(result, codec: str = DEFAULT_CODEC,
+                  inline_max_bytes: int = INLINE_MAX_BYTES) -> dict:
+    """
+    Returns the parameters recording `result`: `result` (stored inline, as
+    jsonb: the connector only adapts dicts, not numbers, strings or lists) and
+    `blob_codec`, `blob_raw_size`, `blob_data` (None unless it is offloaded)
+    """
+    params = {"result": None, "blob_codec": None, "blob_raw_size": None, "blob_data": None}
+    if result is None:
+        return params
+    payload = json.dumps(result).encode()
+    if len(payload) <= inline_max_bytes:
+        params["result"] = Jsonb(result)
+        return params
+
+    compress, _ = _codec(codec)
+    stub = {}
+    if isinstance(result, dict):
+        stub = {key: value for key, value in result.items()
+                if len(json.dumps(value)) <= SUMMARY_MAX_BYTES}
+    stub[BLOB_MARKER] = codec
+    params.update(result=Jsonb(stub), blob_codec=codec, blob_raw_size=len(payload), blob_data=compress(payload))
+    return params
+
+
+def decode_result(result, codec: str | None = None, data: bytes | None = None):
+    """The full result from a job_results.result value and its blob (if any)"""
+    if not isinstance(result, dict) or BLOB_MARKER not in result:
+        return result
+    if data is None:
+        raise ValueError(f"Result offloaded with {result[BLOB_MARKER]} but its blob is missing")
+    _, decompress = _codec(codec)
+    return json.loads(decompress(bytes(data)))
+
+
+def load_result(conn, job_id: int):
+    """Reads the full result of a job with a (sync) psycopg connection"""
+    with conn.cursor() as cur:
+        cur.execute(QUERY_LOAD_RESULT, {"job_id": job_id})
+        row = cur.fetchone()
+    return decode_result(*row) if row else None
+
+
+async def load_result_async(connector, job_id: int):
+    """Reads the full result of a job through a procrastinate connector"""
+    row = await connector.execute_query_one_async(QUERY_LOAD_RESULT, job_id=job_id)
+    return decode_result(row["result"], row["codec"], row["data"]) if row else None
@@ -0,0 +1,38 @@
+# Per-minute throughput rollups (job_results_rollup), read by check_results.py
+# instead of the raw job_results rows. Every statement that records the outcome
+# of a run (COMPLETED or FAILED) also adds it to the rollup row of its
+# (minute, task_name, worker_name, status), so reports cost the same at 1M jobs
+# as at 1k. Rollups count runs: a job that failed once, then succeeded,
+# counts one FAILED and one COMPLETED run.
+
+ROLLUP_ON_CONFLICT = """
+    ON CONFLICT (minute, task_name, worker_name, status) DO UPDATE SET
+        jobs = r.jobs + EXCLUDED.jobs,
+        duration_ms_sum = r.duration_ms_sum + EXCLUDED.duration_ms_sum,
+        duration_ms_max = GREATEST(r.duration_ms_max, EXCLUDED.duration_ms_max)"""
+
+# the minute is TIMESTAMP (server time zone), like the other job_results timestamps
+ROLLUP_COLUMNS = "INSERT INTO job_results_rollup AS r (minute, task_name, worker_name, status, jobs, duration_ms_sum, duration_ms_max)"
+
+
+def rollup_cte(status: str) -> str:
+    """Data-modifying CTE adding the run of one job, whose status is the SQL expression `status`"""
+    return f"""rollup AS (
+    {ROLLUP_COLUMNS}
+    SELECT date_trunc('minute', %(finished_at)s::timestamptz)::timestamp, %(task_name)s,
+           COALESCE(%(worker_name)s, ''), {status}, 1, COALESCE(%(duration_ms)s, 0), COALESCE(%(duration_ms)s, 0)
+    WHERE %(finished_at)s::timestamptz IS NOT NULL{ROLLUP_ON_CONFLICT}
+)"""
+
+
+# Data-modifying CTE adding the finished runs buffered by the sink (see papp/sink.py).
+# They travel apart from the `batch` rows, which keep one (the last) transition per job.
+ROLLUP_BATCH_CTE = f"""rollup AS (
+    {ROLLUP_COLUMNS}
+    SELECT date_trunc('minute', finished_at)::timestamp, task_name, COALESCE(worker_name, ''), status,
+           count(*), COALESCE(sum(duration_ms), 0), COALESCE(max(duration_ms), 0)
+    FROM unnest(%(run_finished_at)s::timestamptz[], %(run_task_name)s::varchar[], %(run_worker_name)s::varchar[],
+                %(run_status)s::varchar[], %(run_duration_ms)s::float8[])
+        AS run(finished_at, task_name, worker_name, status, duration_ms)
+    GROUP BY 1, 2, 3, 4{ROLLUP_ON_CONFLICT}
+)"""
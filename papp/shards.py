@@ -0,0 +1,235 @@
+import asyncio
+import bisect
+import contextlib
+import hashlib
+import itertools
+import json
+import os
+import random
+
+import psycopg
+from procrastinate import PsycopgConnector
+from psycopg.types.json import Jsonb
+
+# Sharded queues: with DB_SHARDS="host:port/dbname,host:port/dbname,...", jobs
+# are spread over several postgres instances (or databases), each with its own
+# procrastinate schema and result tables, so that throughput is no longer
+# bound by a single server. Every process works on one shard, SHARD (0 by
+# default): papp/main.py, init_db.py and the workers connect to it only.
+#
+# - orchestrator.py routes each job (`ShardRouter`): round robin, or
+#   consistent hashing of a key, so that adding a shard moves ~1/N of the keys;
+# - run_workers.sh pins worker i to shard (i-1) mod N, and supervisor.py runs
+#   the workers of its own SHARD: one supervisor per shard;
+# - with --steal, an idle worker moves todo jobs from the other shards to its
+#   own (`WorkStealer`);
+# - check_results.py aggregates the results of every shard.
+#
+# Locks and queueing locks only hold within a shard: route jobs sharing one by
+# that lock (`job_key`), and they are never stolen.
+
+#: virtual nodes of each shard on the consistent hashing ring
+RING_REPLICAS = 64
+
+# own eligible todo jobs, through procrastinate's partial index on todo jobs
+QUERY_BACKLOG = """
+SELECT COUNT(*) AS backlog FROM procrastinate_jobs
+WHERE status = 'todo'
+    AND (%(queues)s::varchar[] IS NULL OR queue_name = ANY(%(queues)s::varchar[]))
+    AND (scheduled_at IS NULL OR scheduled_at <= now())
+"""
+
+# On the donor shard, in a transaction committed once the jobs are deferred on the thief's.
+# The donor keeps its first %(keep)s jobs: the thief takes from the tail of its queue (lowest
+# priority, newest), away from the donor's own workers. Jobs with a lock, a past attempt or a
+# periodic defer stay where they are.
+QUERY_TAKE_JOBS = """
+DELETE FROM procrastinate_jobs
+WHERE id IN (
+    SELECT id FROM procrastinate_jobs AS jobs
+    WHERE status = 'todo'
+        AND lock IS NULL AND queueing_lock IS NULL AND attempts = 0
+        AND (%(queues)s::varchar[] IS NULL OR queue_name = ANY(%(queues)s::varchar[]))
+        AND (scheduled_at IS NULL OR scheduled_at <= now())
+        AND NOT EXISTS (SELECT FROM procrastinate_periodic_defers AS defers WHERE defers.job_id = jobs.id)
+    ORDER BY priority ASC, id DESC
+    LIMIT %(limit)s
+    FOR UPDATE SKIP LOCKED
+)
+AND (
+    SELECT COUNT(*) FROM (
+        SELECT FROM procrastinate_jobs
+        WHERE status = 'todo' AND (%(queues)s::varchar[] IS NULL OR queue_name = ANY(%(queues)s::varchar[]))
+        LIMIT %(keep)s + %(limit)s
+    ) AS backlog
+) >= %(keep)s + %(limit)s
+RETURNING jsonb_build_object('queue_name', queue_name, 'task_name', task_name, 'priority', priority,
+                             'args', args, 'scheduled_at', scheduled_at)
+"""
+
+# the taken jobs, as new jobs of the thief's shard (same procrastinate function as batch_defer)
+QUERY_PUT_JOBS = """
+SELECT unnest(procrastinate_defer_jobs_v1(ARRAY(
+    SELECT ROW(
+        jobs.queue_name, jobs.task_name, jobs.priority, NULL::text, NULL::text, jobs.args, jobs.scheduled_at
+    )::procrastinate_job_to_defer_v1
+    FROM jsonb_to_recordset(%(jobs)s::jsonb)
+        AS jobs(queue_name varchar, task_name varchar, priority integer, args jsonb, scheduled_at timestamptz)
+))) AS id
+"""
+
+
+def shard_pgconfigs(pgconfig: dict) -> list[dict]:
+    """
+    The connection arguments of every shard: the DB_SHARDS entries
+    ("host:port/dbname", port and dbname optional) over `pgconfig`, or
+    `pgconfig` alone without DB_SHARDS.
+    """
+    configs = []
+    for entry in filter(None, (entry.strip() for entry in os.environ.get("DB_SHARDS", "").split(","))):
+        address, _, dbname = entry.partition("/")
+        host, _, port = address.partition(":")
+        configs.append({**pgconfig, "host": host or pgconfig["host"], "port": port or pgconfig["port"],
+                        "dbname": dbname or pgconfig["dbname"]})
+    return configs or [pgconfig]
+
+
+def shard_index(shards: int) -> int:
+    """The shard of this process: SHARD, 0 by default"""
+    index = int(os.environ.get("SHARD", 0))
+    if not 0 <= index < shards:
+        raise ValueError(f"SHARD={index}, but DB_SHARDS lists {shards} shard(s)")
+    return index
+
+
+def job_key(kwargs: dict, lock: str | None = None) -> str:
+    """The consistent hashing key of a job: its lock if any (locks hold within a shard), its arguments otherwise"""
+    return lock if lock is not None else json.dumps(kwargs, sort_keys=True)
+
+
+def _ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class ShardRouter:
+    """
+    Routes jobs to one of `shards` shards. "round-robin" cycles through the
+    shards, a chunk of jobs at a time. "hash" places every shard
+    `RING_REPLICAS` times on a hash ring, and sends a job to the first shard
+    after the hash of its key.
+    """
+
+    MODES = ("round-robin", "hash")
+
+    def __init__(self, shards: int, mode: str = "round-robin"):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown routing mode {mode!r}, expected one of {', '.join(self.MODES)}")
+        self.shards = shards
+        self.mode = mode
+        self._next = itertools.cycle(range(shards))
+        ring = sorted((_ring_hash(f"shard-{shard}-{replica}"), shard)
+                      for shard in range(shards) for replica in range(RING_REPLICAS))
+        self._points = [point for point, _ in ring]
+        self._owners = [shard for _, shard in ring]
+
+    def shard_for(self, key: str) -> int:
+        if self.mode == "round-robin":
+            return next(self._next)
+        return self._owners[bisect.bisect(self._points, _ring_hash(key)) % len(self._points)]
+
+    def split(self, chunk: list[dict]) -> dict[int, list[dict]]:
+        """The jobs (kwargs) of `chunk` by shard; round robin keeps the chunk whole, a single insert"""
+        if self.mode == "round-robin":
+            return {next(self._next): chunk}
+        routed: dict[int, list[dict]] = {}
+        for kwargs in chunk:
+            routed.setdefault(self.shard_for(job_key(kwargs)), []).append(kwargs)
+        return routed
+
+
+def shard_connectors(app, configs: list[dict], shard: int) -> list:
+    """A connector per shard: `app`'s own for `shard`, a single-connection one (to open) for the others"""
+    return [app.connector if index == shard else PsycopgConnector(kwargs=config, min_size=1, max_size=1)
+            for index, config in enumerate(configs)]
+
+
+@contextlib.contextmanager
+def open_shards(app, connectors: list):
+    """Opens the `connectors` other than `app`'s (opened with the app) for synchronous use, then closes them"""
+    others = [connector.get_sync_connector() for connector in connectors if connector is not app.connector]
+    for connector in others:
+        connector.open()
+    try:
+        yield
+    finally:
+        for connector in others:
+            connector.close()
+
+
+class WorkStealer:
+    """
+    Moves `batch` todo jobs from another shard (`donors`: index -> connection
+    arguments) to `app`'s own when its backlog is under `low_water` jobs
+    (`batch` by default), checked every `interval` seconds. A donor always
+    keeps `low_water` jobs for its own workers. Donors are tried in random
+    order, so idle workers don't all drain the same one. The jobs are deleted
+    on the donor in a transaction committed after they are deferred on the
+    thief's shard: a failure in between can run a job twice (procrastinate's
+    at-least-once), never lose it.
+    """
+
+    def __init__(self, app, donors: dict[int, dict], queues: list[str] | None, batch: int,
+                 low_water: int | None = None, interval: float = 1.0):
+        self.app = app
+        self.donors = donors
+        self.queues = queues
+        self.batch = batch
+        self.low_water = batch if low_water is None else low_water
+        self.interval = interval
+        self.stolen = 0
+
+    async def backlog(self) -> int:
+        row = await self.app.connector.execute_query_one_async(QUERY_BACKLOG, queues=self.queues)
+        return row["backlog"]
+
+    async def steal(self) -> int:
+        """Steals a batch from the first donor that can spare one; returns the jobs moved"""
+        for index in random.sample(list(self.donors), len(self.donors)):
+            moved = await self._steal_from(index)
+            if moved:
+                self.stolen += moved
+                print(f"[STEAL] Moved {moved} jobs from shard {index} ({self.stolen} so far)")
+                return moved
+        return 0
+
+    async def _steal_from(self, index: int) -> int:
+        # a short-lived connection: donors are only contacted by idle workers
+        try:
+            async with await psycopg.AsyncConnection.connect(**self.donors[index], connect_timeout=5) as conn:
+                async with conn.transaction():
+                    cursor = await conn.execute(
+                        QUERY_TAKE_JOBS, {"queues": self.queues, "limit": self.batch, "keep": self.low_water}
+                    )
+                    jobs = [job for (job,) in await cursor.fetchall()]
+                    if jobs:
+                        await self.app.connector.execute_query_all_async(QUERY_PUT_JOBS, jobs=Jsonb(jobs))
+            return len(jobs)
+        except psycopg.OperationalError as e:
+            print(f"[STEAL] Shard {index} unavailable: {e!r}")
+            return 0
+
+    async def run(self):
+        """Steals whenever the backlog is low, until cancelled"""
+        while True:
+            if await self.backlog() < self.low_water:
+                await self.steal()
+            await asyncio.sleep(self.interval)
+
+    async def drain(self, stop):
+        """Like `run`, but calls `stop()` once the own shard is empty and no donor can spare jobs"""
+        while True:
+            backlog = await self.backlog()
+            if backlog < self.low_water and not await self.steal() and not backlog:
+                stop()
+                return
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,265 @@
+import asyncio
+import datetime
+import weakref
+
+import psycopg
+
+from papp.rollup import ROLLUP_BATCH_CTE
+
+# One statement for a whole batch of status transitions: the columns travel as
+# arrays and are zipped back into rows by unnest. Offloaded results (see
+# papp/results.py) get their blob written, and finished runs are added to the
+# per-minute rollups (see papp/rollup.py), by the same statement.
+UPSERT_RESULTS = f"""
+WITH batch AS (
+    SELECT * FROM unnest(
+        %(job_id)s::bigint[], %(task_name)s::varchar[], %(status)s::varchar[],
+        %(result)s::jsonb[], %(error_message)s::text[], %(worker_name)s::varchar[], %(attempt)s::integer[],
+        %(started_at)s::timestamptz[], %(finished_at)s::timestamptz[], %(duration_ms)s::float8[], %(execution_ms)s::float8[],
+        %(created_at)s::timestamptz[], %(updated_at)s::timestamptz[],
+        %(blob_codec)s::varchar[], %(blob_raw_size)s::integer[], %(blob_data)s::bytea[]
+    ) AS batch(job_id, task_name, status, result, error_message, worker_name, attempt,
+               started_at, finished_at, duration_ms, execution_ms, created_at, updated_at,
+               blob_codec, blob_raw_size, blob_data)
+), blobs AS (
+    INSERT INTO job_result_blobs (job_id, codec, raw_size, data)
+    SELECT job_id, blob_codec, blob_raw_size, blob_data FROM batch WHERE blob_data IS NOT NULL
+), {ROLLUP_BATCH_CTE}
+INSERT INTO job_results (job_id, task_name, status, result, error_message, worker_name, attempt,
+                         started_at, finished_at, duration_ms, execution_ms, created_at, updated_at)
+SELECT job_id, task_name, status, result, error_message, worker_name, attempt,
+       started_at, finished_at, duration_ms, execution_ms, created_at, updated_at
+FROM batch
+ON CONFLICT (job_id) DO UPDATE SET
+    status = EXCLUDED.status,
+    result = EXCLUDED.result,
+    error_message = EXCLUDED.error_message,
+    worker_name = EXCLUDED.worker_name,
+    attempt = EXCLUDED.attempt,
+    started_at = EXCLUDED.started_at,
+    finished_at = EXCLUDED.finished_at,
+    duration_ms = EXCLUDED.duration_ms,
+    execution_ms = EXCLUDED.execution_ms,
+    updated_at = EXCLUDED.updated_at
+-- a retry can run on another worker, whose sink may flush first: keep the newest transition
+WHERE job_results.updated_at <= EXCLUDED.updated_at
+"""
+
+#: columns a transition sets (besides job_id, task_name, status and the row timestamps)
+TRANSITION_COLUMNS = ("result", "error_message", "worker_name", "attempt", "started_at", "finished_at",
+                      "duration_ms", "execution_ms", "blob_codec", "blob_raw_size", "blob_data")
+COLUMNS = ("job_id", "task_name", "status", "created_at", "updated_at") + TRANSITION_COLUMNS
+#: columns of a finished run, for the rollups (bound as run_<column>)
+RUN_COLUMNS = ("finished_at", "task_name", "worker_name", "status", "duration_ms")
+#: batch writes failing on connection errors before the rows are written one by one
+MAX_FLUSH_ATTEMPTS = 3
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether a write failed on the connection (procrastinate wraps psycopg's errors)"""
+    return isinstance(error, psycopg.OperationalError) or isinstance(error.__cause__, psycopg.OperationalError)
+
+
+class ResultSink:
+    """
+    Per-worker buffer of job_results status transitions.
+
+    Transitions are kept in memory, keyed by job id (a job that starts and
+    completes between two flushes is written once, with its last status), and
+    written as one multi-row upsert every `max_rows` jobs or `max_delay_ms`
+    milliseconds, whichever comes first. Call `close()` (or `flush_all_sinks()`)
+    before the worker's connector is closed to write what is left. Finished
+    runs are buffered apart for the rollups: a job that fails and is retried
+    between two flushes keeps its FAILED run there, though not in job_results.
+
+    Durability is explicit: with `wait_for_flush=False` (default) `put` returns
+    as soon as the transition is buffered, so a crash can lose up to one
+    buffer of result rows even though procrastinate acknowledged the jobs.
+    With `wait_for_flush=True`, `put` returns only once the row is committed:
+    the middleware then awaits it before returning, which holds the job
+    acknowledgement back until its result is durable, and a failed flush fails
+    the job (and triggers its retries).
+
+    A batch that fails on anything but a connection error, or on connection
+    errors `MAX_FLUSH_ATTEMPTS` times in a row, is written again row by row:
+    the rows that still fail are dropped (and reported), so one unwritable
+    result doesn't hold back the others.
+    """
+
+    instances: "weakref.WeakSet[ResultSink]" = weakref.WeakSet()
+
+    def __init__(self, max_rows: int = 500, max_delay_ms: float = 200, wait_for_flush: bool = False):
+        self.max_rows = max_rows
+        self.max_delay_ms = max_delay_ms
+        self.wait_for_flush = wait_for_flush
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.flushes = 0
+        self._failed_flushes = 0
+        self._connector = None
+        self._rows: dict[int, dict] = {}
+        self._runs: list[dict] = []
+        self._waiters: dict[int, list[asyncio.Future]] = {}
+        self._flush_lock: asyncio.Lock | None = None
+        self._timer: asyncio.Task | None = None
+        ResultSink.instances.add(self)
+
+    def __len__(self):
+        return len(self._rows)
+
+    async def put(self, connector, job_id: int, task_name: str, status: str, **columns):
+        """
+        Buffers a status transition of a job (see class docstring for durability).
+        `columns` are the job_results values of the transition (see
+        `TRANSITION_COLUMNS`, missing ones are NULL); `result` and `blob_*` come
+        from `papp.results.encode_result`.
+        """
+        if self._timer is None:
+            # first use: bind to the worker's connector and event loop
+            self._connector = connector
+            self._flush_lock = asyncio.Lock()
+            self._timer = asyncio.create_task(self._flush_periodically(), name="result sink flush")
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        row = self._rows.get(job_id)
+        if row is None:
+            row = self._rows[job_id] = {"job_id": job_id, "task_name": task_name, "created_at": now}
+        row.update({column: columns.get(column) for column in TRANSITION_COLUMNS}, status=status, updated_at=now)
+        if row["finished_at"] is not None:
+            self._runs.append({"job_id": job_id, **{column: row[column] for column in RUN_COLUMNS}})
+
+        waiter = None
+        if self.wait_for_flush:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(job_id, []).append(waiter)
+        if len(self._rows) >= self.max_rows:
+            try:
+                await self.flush()
+            except Exception:
+                pass # failed rows stay buffered; waiters got the error
+        if waiter is not None:
+            await waiter
+
+    async def flush(self):
+        """
+        Writes all buffered transitions with a single upsert. Shielded: a
+        cancelled caller (e.g. shutdown cancelling a job or the periodic flush)
+        doesn't interrupt the write of the rows already taken from the buffer.
+        """
+        if self._flush_lock is None:
+            return
+        await asyncio.shield(self._flush())
+
+    async def _flush(self):
+        # flushes are serialized, so an older status never overwrites a newer one
+        async with self._flush_lock:
+            if not self._rows:
+                return
+            rows, self._rows = self._rows, {}
+            runs, self._runs = self._runs, []
+            waiters, self._waiters = self._waiters, {}
+            try:
+                await self._write(rows.values(), runs)
+            except Exception as e:
+                self._failed_flushes += 1
+                print(f"[SINK] Failed to write {len(rows)} job results: {e.__cause__ or e!r}")
+                if is_transient(e) and self._failed_flushes < MAX_FLUSH_ATTEMPTS:
+                    self._restore(rows, runs, waiters, error=e)
+                    raise
+                await self._write_one_by_one(rows, runs, waiters)
+                return
+            except BaseException: # cancelled: the next flush settles the waiters
+                self._restore(rows, runs, waiters)
+                raise
+            self._failed_flushes = 0
+            self.rows_written += len(rows)
+            self.flushes += 1
+            settle(waiters.values())
+
+    async def _write(self, rows, runs: list[dict]):
+        rows = list(rows)
+        await self._connector.execute_query_async(
+            UPSERT_RESULTS,
+            **{column: [row[column] for row in rows] for column in COLUMNS},
+            **{f"run_{column}": [run[column] for run in runs] for column in RUN_COLUMNS},
+        )
+
+    async def _write_one_by_one(self, rows: dict[int, dict], runs: list[dict], waiters: dict[int, list]):
+        """Writes `rows` one upsert each; drops those that fail on anything but a connection error"""
+        runs_of: dict[int, list[dict]] = {}
+        for run in runs:
+            runs_of.setdefault(run["job_id"], []).append(run)
+        pending = dict(rows)
+
+        def keep(error=None):
+            self._restore(pending, [run for kept in pending for run in runs_of.get(kept, [])],
+                          {kept: waiters[kept] for kept in pending if kept in waiters}, error=error)
+
+        for job_id, row in rows.items():
+            try:
+                await self._write([row], runs_of.get(job_id, []))
+            except Exception as e:
+                if is_transient(e):
+                    # the database is gone again: the rest waits for the next flush
+                    keep(error=e)
+                    raise
+                print(f"[SINK] Dropped the {row['status']} result of job {job_id}: {e.__cause__ or e!r}")
+                self.rows_dropped += 1
+                settle([waiters.get(job_id, [])], error=e)
+            except BaseException:
+                keep()
+                raise
+            else:
+                self.rows_written += 1
+                settle([waiters.get(job_id, [])])
+            del pending[job_id]
+        self._failed_flushes = 0
+        self.flushes += 1
+
+    def _restore(self, rows: dict[int, dict], runs: list[dict], waiters: dict[int, list], error=None):
+        """Puts rows back in the buffer, unless a newer transition arrived meanwhile; fails the waiters on `error`"""
+        for job_id, row in rows.items():
+            self._rows.setdefault(job_id, row)
+        self._runs[:0] = runs
+        if error is not None:
+            settle(waiters.values(), error=error)
+            return
+        for job_id, job_waiters in waiters.items():
+            self._waiters.setdefault(job_id, [])[:0] = job_waiters
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.max_delay_ms / 1000)
+            try:
+                await self.flush()
+            except Exception:
+                pass # already reported, rows are retried at the next tick
+
+    async def close(self):
+        """Stops the periodic flush and writes the remaining transitions"""
+        if self._timer is None:
+            return
+        timer, self._timer = self._timer, None
+        timer.cancel()
+        await asyncio.gather(timer, return_exceptions=True)
+        await self.flush()
+        print(f"[SINK] Wrote {self.rows_written} job results in {self.flushes} flushes"
+              + (f", dropped {self.rows_dropped}" if self.rows_dropped else ""))
+
+
+def settle(waiters, error: Exception | None = None):
+    """Resolves the futures of `waiters` (lists of them), with `error` if given"""
+    for job_waiters in waiters:
+        for waiter in job_waiters:
+            if waiter.done():
+                continue
+            if error is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(error)
+
+
+async def flush_all_sinks():
+    """Closes every result sink of the process. Call it on worker shutdown."""
+    for sink in list(ResultSink.instances):
+        await sink.close()
@@ -0,0 +1,58 @@
+import os
+
+from procrastinate import PsycopgConnector
+
+# Result store: the connector that job_results, job_result_blobs,
+# job_results_rollup and worker_metrics are written through. By default, the
+# app's own connector: result writes then wait for a connection behind job
+# fetches and completions, and the reverse. With RESULTS_POOL_MAX_SIZE set,
+# each worker gets a dedicated pool of that size, to the database of the
+# RESULTS_DB_* variables (each defaults to its DB_* counterpart), so result
+# persistence is sized, and may live, apart from the queue.
+#
+# Another database means results can no longer be written in the statement
+# that completes the job: "completion" persistence mode then writes them just
+# before the completion instead (see papp/utils.py).
+
+#: pgconfig key -> environment variable suffix
+ENV_KEYS = {"host": "HOST", "port": "PORT", "user": "USER", "password": "PASSWORD", "dbname": "NAME"}
+
+
+def results_pgconfig(pgconfig: dict) -> dict:
+    """The connection arguments of the result store: `pgconfig`, overridden by the RESULTS_DB_* variables"""
+    return {key: os.environ.get(f"RESULTS_DB_{suffix}", pgconfig[key]) for key, suffix in ENV_KEYS.items()}
+
+
+class ResultStore:
+    """The dedicated result store connector of the worker process, if any (see `configure`)"""
+
+    def __init__(self):
+        self.connector: PsycopgConnector | None = None
+        self.max_size = 0
+        self.same_server = True
+
+    def configure(self, pgconfig: dict, min_size: int, max_size: int, **kwargs):
+        """Uses a dedicated pool of `min_size`..`max_size` connections to `results_pgconfig(pgconfig)`"""
+        config = results_pgconfig(pgconfig)
+        self.same_server = (config["host"], str(config["port"])) == (pgconfig["host"], str(pgconfig["port"]))
+        self.connector = PsycopgConnector(kwargs={**config, **kwargs}, min_size=min_size, max_size=max_size)
+        self.max_size = max_size
+
+    def connector_for(self, app):
+        """The connector to write results with: the dedicated one, or `app`'s"""
+        return self.connector or app.connector
+
+    def pool_size(self) -> int:
+        return self.max_size
+
+    async def open_async(self):
+        if self.connector is not None:
+            await self.connector.open_async()
+
+    async def close_async(self):
+        if self.connector is not None:
+            await self.connector.close_async()
+
+
+#: the result store of the worker process
+store = ResultStore()
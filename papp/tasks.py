@@ -1,7 +1,12 @@
 from papp.main import app
+import os
 import time
 import random
-from papp.utils import task_with_persistence_shared_conn, task_with_persistence_shared_conn_a
+from papp.utils import task_with_persistence
+from papp.sink import ResultSink
+from papp import partitions
+from papp.store import store
+import datetime
 from procrastinate import JobContext
 import asyncio
 
@@ -23,7 +28,9 @@ async def asum(a, b):
     return {"result": a + b}
 
 
-@task_with_persistence_shared_conn(name="sum_with_persistence", pass_context=True, retry=3) # pass context, retry
+# sync: runs in the task's thread pool, so a worker runs up to --concurrency of them at once
+@task_with_persistence(name="sum_with_persistence", pass_context=True, retry=3, # pass context, retry
+                       max_workers=32)
 def sum_with_persistence(context: JobContext, a, b, avg_sleep_time:float=3):
     #if random.random() > 0.5:
     #    raise Exception("Who could have seen this coming?")
@@ -36,7 +43,16 @@ def sum_with_persistence(context: JobContext, a, b, avg_sleep_time:float=3):
             "job_id": context.job.id,
             "long_string": "x"*random.randint(100, 2500)}
 
-@task_with_persistence_shared_conn_a(name="asum_with_persistence", pass_context=True, retry=3) # pass context, retry
+# How asum_with_persistence records its results, set from the environment for benchmarks:
+# PERSIST_MODE: "running" (RUNNING row at start, then the outcome) or "completion"
+#   (outcome only, written with procrastinate's job completion when there is no sink)
+# RESULT_SINK: "1" buffers job_results writes, one upsert every 200 jobs or 250ms (see papp/sink.py).
+#   Off by default: jobs are then acknowledged before their result is written (wait_for_flush=False).
+PERSIST_MODE = os.environ.get("PERSIST_MODE", "running")
+results_sink = ResultSink(max_rows=200, max_delay_ms=250, wait_for_flush=False) if os.environ.get("RESULT_SINK", "0") == "1" else None
+
+@task_with_persistence(name="asum_with_persistence", pass_context=True, retry=3, # pass context, retry
+                       result_sink=results_sink, persist_mode=PERSIST_MODE)
 async def asum_with_persistence(context: JobContext, a, b, avg_sleep_time:float=3, fail_prob: float=0):
     random_float = random.random()
     if fail_prob > 0:
@@ -51,3 +67,24 @@ async def asum_with_persistence(context: JobContext, a, b, avg_sleep_time:float=
             "job_id": context.job.id,
             "long_string": "x"*random.randint(100, 2500),
             "meta": {"fail_prob": fail_prob, "random_float": random_float}}
+
+
+# CPU-bound: runs in a process pool (no context, picklable arguments and result)
+@task_with_persistence(name="fib_with_persistence", retry=3, executor="process", max_workers=4)
+def fib_with_persistence(n: int):
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return {"result": a % 1_000_000_007, "n": n}
+
+
+# Partitioned job_results (`python init_db.py --partition jobs`): creates the
+# upcoming partitions and drops the ones older than RESULTS_RETENTION_DAYS. No-op otherwise.
+RESULTS_RETENTION_DAYS = float(os.environ.get("RESULTS_RETENTION_DAYS", 7))
+
+@app.periodic(cron="*/15 * * * *")
+@app.task(name="maintain_job_results_partitions", queueing_lock="maintain_job_results_partitions")
+async def maintain_job_results_partitions(timestamp: int):
+    created, dropped = await partitions.maintain(store.connector_for(app), datetime.timedelta(days=RESULTS_RETENTION_DAYS))
+    if created or dropped:
+        print(f"[PARTITIONS] {created} partitions created, dropped: {dropped or 'none'}")
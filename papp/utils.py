@@ -1,106 +1,185 @@
 from papp import main
+from papp.completion import CompletionJobManager, QUERY_RECORD, pending_results
+from papp.metrics import recorder
+from papp.results import BLOB_CTE, encode_result
+from papp.rollup import rollup_cte
+from papp.store import store
 from procrastinate import JobContext
-import json
+import asyncio
+import concurrent.futures
+import datetime
+import importlib
+import multiprocessing
+import time
+from typing import Callable
 # job persistence
 import functools
-from sqlalchemy import text
-from sqlalchemy.dialects import postgresql
 import inspect
-def render_query(query_template, **params):
-    """
-    Renders a SQLAlchemy parameterized query into a raw SQL string
-    with literal values, without needing a database connection.
-    """
-    query = text(query_template).bindparams(**params)  # 👈 bind params here
-    compiled_query = query.compile(
-        dialect=postgresql.dialect(),
-        compile_kwargs={"literal_binds": True}
-    )
-    return str(compiled_query)
-
-def task_with_persistence_shared_conn(original_func=None, **task_kwargs):
+
+# job_results statements. Values are bound server side (no literal SQL per job) and
+# the text never changes, so it is built once per process and psycopg prepares it
+# on each pooled connection after a few executions (see `prepare_threshold`; not
+# behind PgBouncer, see papp/connections.py).
+# job_id is the primary key in both schemas (the partitioned one is split by job_id
+# ranges, see papp/partitions.py): a job retry updates its row atomically, and every
+# statement names the partition it writes to.
+QUERY_START = (
+    "INSERT INTO job_results (job_id, task_name, status, worker_name, attempt, started_at, updated_at) "
+    "VALUES (%(job_id)s, %(task_name)s, 'RUNNING', %(worker_name)s, %(attempt)s, %(started_at)s, NOW()) "
+    "ON CONFLICT (job_id) DO UPDATE SET status = 'RUNNING', worker_name = EXCLUDED.worker_name, "
+    "attempt = EXCLUDED.attempt, started_at = EXCLUDED.started_at, finished_at = NULL, "
+    "duration_ms = NULL, execution_ms = NULL, updated_at = NOW()"
+)
+# outcomes also update the per-minute rollups (see papp/rollup.py)
+ROLLUP_COMPLETED = rollup_cte("'COMPLETED'")
+ROLLUP_FAILED = rollup_cte("'FAILED'")
+QUERY_SUCCESS = (
+    f"WITH {BLOB_CTE},\n{ROLLUP_COMPLETED}\n" # large results go to job_result_blobs (see papp/results.py)
+    "UPDATE job_results SET status = 'COMPLETED', result = %(result)s, error_message = NULL, "
+    "worker_name = %(worker_name)s, attempt = %(attempt)s, started_at = %(started_at)s, "
+    "finished_at = %(finished_at)s, duration_ms = %(duration_ms)s, execution_ms = %(execution_ms)s, "
+    "updated_at = NOW() WHERE job_id = %(job_id)s"
+)
+QUERY_FAIL = (
+    f"WITH {ROLLUP_FAILED}\n"
+    "UPDATE job_results SET status = 'FAILED', error_message = %(error_message)s, "
+    "worker_name = %(worker_name)s, attempt = %(attempt)s, started_at = %(started_at)s, "
+    "finished_at = %(finished_at)s, duration_ms = %(duration_ms)s, execution_ms = %(execution_ms)s, "
+    "updated_at = NOW() WHERE job_id = %(job_id)s"
+)
+
+# Persistence modes: "running" writes a RUNNING row when the job starts, then its
+# outcome; "completion" writes the outcome only (with the start time kept in
+# memory) and relies on procrastinate_jobs.status = 'doing' for RUNNING visibility.
+PERSIST_MODES = ("running", "completion")
+
+async def write_status(context: JobContext, result_sink, persist_mode: str, status: str, query: str, **params):
     """
-    Alternative approach: Use Procrastinate's own connection pool
-    This avoids creating a separate connection pool
+    Records a status transition of the current job in job_results: through the
+    task's result sink (buffered, see `papp.sink.ResultSink`) when it has one,
+    with `query` and its bound `params` otherwise.
+
+    In "completion" mode the RUNNING transition is skipped, and the outcome is
+    handed over to `CompletionJobManager`, which writes it in the same statement
+    (and transaction) as procrastinate's job completion. With a dedicated result
+    store (see `papp.store`), everything goes through its pool instead, and the
+    outcome is written just before the completion.
+
+    Results are stored through `papp.results.encode_result`: large ones are
+    compressed into job_result_blobs by the same statement. Every transition
+    also records the worker, the attempt (1 for the first run) and the timing
+    of the run, as measured by the worker: `duration_ms` from the fetch of the
+    job to its outcome, `execution_ms` (a param of the outcome) for the task alone.
+    Both also go to the worker's latency histograms (see `papp.metrics`).
     """
-    def wrap(func):
-        from papp import main as app_instance # lazy import to avoid circular imports
-
-        @functools.wraps(func)
-        async def new_func(context: JobContext, *job_args, **job_kwargs):
-            job_id = context.job.id
-            task_name = context.task.name
-            worker_name = context.worker_name
-            
-            print(f"[MIDDLEWARE] Worker {worker_name}: Starting job {job_id} ({task_name})")
-            # Use ON CONFLICT to handle job retries gracefully. This marks the job as RUNNING.
-            query_start_template = (
-                "INSERT INTO job_results (job_id, task_name, status, updated_at) "
-                "VALUES (:job_id, :task_name, 'RUNNING', NOW()) "
-                "ON CONFLICT (job_id) DO UPDATE SET status = 'RUNNING', updated_at = NOW()"
+    if persist_mode == "completion" and status == "RUNNING":
+        return
+    started_at = datetime.datetime.fromtimestamp(context.start_timestamp, datetime.timezone.utc)
+    finished_at = None if status == "RUNNING" else datetime.datetime.now(datetime.timezone.utc)
+    stored = encode_result(params.pop("result", None))
+    stored.update(worker_name=context.worker_name, attempt=context.job.attempts + 1,
+                  started_at=started_at, finished_at=finished_at, execution_ms=params.pop("execution_ms", None),
+                  duration_ms=(finished_at - started_at).total_seconds() * 1000 if finished_at else None)
+    connector = store.connector_for(context.app)
+    if finished_at is not None:
+        recorder.record(connector, context.worker_name, context.task.name,
+                        duration_ms=stored["duration_ms"], execution_ms=stored["execution_ms"])
+    if result_sink is not None:
+        await result_sink.put(connector, job_id=context.job.id, task_name=context.task.name,
+                              status=status, error_message=params.get("error_message"),
+                              **stored)
+        return
+    if persist_mode == "completion":
+        row = {"job_id": context.job.id, "task_name": context.task.name, "result_status": status,
+               "error_message": params.get("error_message"), **stored}
+        if isinstance(context.app.job_manager, CompletionJobManager) and connector is context.app.connector:
+            pending_results[context.job.id] = row
+        else:
+            await connector.execute_query_async(QUERY_RECORD, **row)
+        return
+    # the result is bound as jsonb (see encode_result)
+    await connector.execute_query_async(query, job_id=context.job.id, task_name=context.task.name,
+                                        **params, **stored)
+
+# Sync tasks run in an executor, so they never block the worker's event loop:
+# "thread" (default) for I/O-bound or GIL-releasing code, "process" for CPU-bound code.
+EXECUTORS = ("thread", "process")
+DEFAULT_THREADS = 32 # enough for a worker with --concurrency up to 32 (per task)
+
+#: (module, function name) -> original function, for the process pool's children
+_process_funcs: dict[tuple[str, str], Callable] = {}
+#: executor of each sync task, created on first use
+_task_pools: dict[str, concurrent.futures.Executor] = {}
+
+def _run_registered(module: str, name: str, job_args: tuple, job_kwargs: dict):
+    """Runs a process-executor task in a pool process (importing its module registers it)"""
+    importlib.import_module(module)
+    return _process_funcs[(module, name)](*job_args, **job_kwargs)
+
+def _task_pool(task_name: str, executor: str, max_workers: int | None) -> concurrent.futures.Executor:
+    pool = _task_pools.get(task_name)
+    if pool is None:
+        if executor == "process":
+            # spawn, not fork: the worker process has a running loop and pool threads
+            pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
             )
-            query_start = render_query(
-                query_start_template, job_id=job_id, task_name=task_name
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers or DEFAULT_THREADS, thread_name_prefix=task_name
             )
-            print(query_start)
-            await context.app.connector.execute_query_async(query_start)
-            
-            try:
-                result = func(context, *job_args, **job_kwargs)
-                # result is a json b field
-                #await context.app.connector.execute_query_async(... )
-
-                # hack
-                result["worker_name"] = worker_name
-                
-                # On success, update the job status to COMPLETED and store the result
-                query_success_template = (
-                    "UPDATE job_results SET status = 'COMPLETED', result = :result, "
-                    "error_message = NULL, updated_at = NOW() WHERE job_id = :job_id"
-                )
-                query_success = render_query(
-                    query_success_template, result=json.dumps(result), job_id=job_id
-                )
-                await context.app.connector.execute_query_async(query_success)
-
-                
-                print(f"[MIDDLEWARE] Worker {worker_name}: Job {job_id} completed successfully")
-                return result
-                
-            except Exception as e:
-                print(f"[MIDDLEWARE] Worker {worker_name}: Job {job_id} failed: {e}")
-                error_message = str(e)
-
-                # On failure, update the status to FAILED and record the error message
-                query_fail_template = (
-                    "UPDATE job_results SET status = 'FAILED', error_message = :error_message, "
-                    "updated_at = NOW() WHERE job_id = :job_id"
-                )
-                query_fail = render_query(
-                    query_fail_template, error_message=error_message, job_id=job_id
-                )
-                await context.app.connector.execute_query_async(query_fail)
-                raise
-
-        # Always pass context and apply the procrastinate task decorator
-        task_kwargs['pass_context'] = True
-
-        return app_instance.app.task(**task_kwargs)(new_func)
-
-    if not original_func:
-        return wrap
-    return wrap(original_func)
-
+        _task_pools[task_name] = pool
+    return pool
 
+def shutdown_task_pools():
+    """Stops the executors of sync tasks. Call it on worker shutdown."""
+    while _task_pools:
+        _, pool = _task_pools.popitem()
+        pool.shutdown(wait=True, cancel_futures=True)
 
-
-def task_with_persistence_shared_conn_a(original_func=None, **task_kwargs):
+def task_with_persistence(original_func=None, result_sink=None, persist_mode="running",
+                          executor="thread", max_workers=None, **task_kwargs):
     """
-    Test: use this to wrap async functions
+    Procrastinate task decorator that records each job's status and result in
+    job_results, through Procrastinate's own connection pool.
+
+    Works with sync and async functions. Async ones run on the worker's event
+    loop. Sync ones run in a bounded pool dedicated to the task, so a worker
+    with --concurrency N runs up to N of them at once:
+    - `executor="thread"` (default): a thread pool of `max_workers` threads
+      (default `DEFAULT_THREADS`). The function receives the job context.
+    - `executor="process"`: a process pool of `max_workers` processes (default:
+      one per CPU) for CPU-bound code. The context cannot cross the process
+      boundary, so the function is called with the job's arguments only, and
+      these and its result must be picklable.
+
+    Pass a `papp.sink.ResultSink` as `result_sink` to buffer the status writes
+    and flush them in batches instead of two queries per job.
+    `persist_mode` is one of `PERSIST_MODES` (see `write_status`).
     """
+    if persist_mode not in PERSIST_MODES:
+        raise ValueError(f"persist_mode must be one of {PERSIST_MODES}, got {persist_mode!r}")
+    if executor not in EXECUTORS:
+        raise ValueError(f"executor must be one of {EXECUTORS}, got {executor!r}")
+
     def wrap(func):
         from papp import main as app_instance # lazy import to avoid circular imports
 
+        is_async = inspect.iscoroutinefunction(func)
+        if not is_async and executor == "process":
+            _process_funcs[(func.__module__, func.__qualname__)] = func
+
+        async def call(context: JobContext, job_args, job_kwargs):
+            if is_async:
+                return await func(context, *job_args, **job_kwargs)
+            pool = _task_pool(context.task.name, executor, max_workers)
+            loop = asyncio.get_running_loop()
+            if executor == "process":
+                return await loop.run_in_executor(
+                    pool, _run_registered, func.__module__, func.__qualname__, job_args, job_kwargs
+                )
+            return await loop.run_in_executor(pool, functools.partial(func, context, *job_args, **job_kwargs))
+
         @functools.wraps(func)
         async def new_func(context: JobContext, *job_args, **job_kwargs):
             job_id = context.job.id
@@ -109,52 +188,35 @@ def task_with_persistence_shared_conn_a(original_func=None, **task_kwargs):
             
             print(f"[MIDDLEWARE] Worker {worker_name}: Starting job {job_id} ({task_name})")
             # Use ON CONFLICT to handle job retries gracefully. This marks the job as RUNNING.
-            query_start_template = (
-                "INSERT INTO job_results (job_id, task_name, status, updated_at) "
-                "VALUES (:job_id, :task_name, 'RUNNING', NOW()) "
-                "ON CONFLICT (job_id) DO UPDATE SET status = 'RUNNING', updated_at = NOW()"
-            )
-            query_start = render_query(
-                query_start_template, job_id=job_id, task_name=task_name
-            )
-            print(query_start)
-            await context.app.connector.execute_query_async(query_start)
+            await write_status(context, result_sink, persist_mode, "RUNNING", QUERY_START)
             
+            execution_start = time.perf_counter()
             try:
-                result = await func(context, *job_args, **job_kwargs)
-                # result is a json b field
-                #await context.app.connector.execute_query_async(... )
-
-                # hack
-                result["worker_name"] = worker_name
+                result = await call(context, job_args, job_kwargs)
+                execution_ms = (time.perf_counter() - execution_start) * 1000
+                # result is a json b field; the worker name and timings have their own columns
                 
                 # On success, update the job status to COMPLETED and store the result
-                query_success_template = (
-                    "UPDATE job_results SET status = 'COMPLETED', result = :result, "
-                    "error_message = NULL, updated_at = NOW() WHERE job_id = :job_id"
-                )
-                query_success = render_query(
-                    query_success_template, result=json.dumps(result), job_id=job_id
-                )
-                await context.app.connector.execute_query_async(query_success)
+                await write_status(context, result_sink, persist_mode, "COMPLETED", QUERY_SUCCESS, result=result,
+                                   execution_ms=execution_ms)
 
                 
                 print(f"[MIDDLEWARE] Worker {worker_name}: Job {job_id} completed successfully")
                 return result
                 
             except Exception as e:
+                execution_ms = (time.perf_counter() - execution_start) * 1000
                 print(f"[MIDDLEWARE] Worker {worker_name}: Job {job_id} failed: {e}")
                 error_message = str(e)
 
                 # On failure, update the status to FAILED and record the error message
-                query_fail_template = (
-                    "UPDATE job_results SET status = 'FAILED', error_message = :error_message, "
-                    "updated_at = NOW() WHERE job_id = :job_id"
-                )
-                query_fail = render_query(
-                    query_fail_template, error_message=error_message, job_id=job_id
-                )
-                await context.app.connector.execute_query_async(query_fail)
+                await write_status(context, result_sink, persist_mode, "FAILED", QUERY_FAIL, error_message=error_message,
+                                   execution_ms=execution_ms)
+                raise
+            except BaseException:
+                # aborted or cancelled (e.g. at shutdown): procrastinate finishes the job as aborted,
+                # without the outcome a "completion" mode run may have left for it
+                pending_results.pop(job_id, None)
                 raise
 
         # Always pass context and apply the procrastinate task decorator
@@ -167,3 +229,6 @@ def task_with_persistence_shared_conn_a(original_func=None, **task_kwargs):
     return wrap(original_func)
 
 
+# previous names, from when sync and async functions had their own decorator
+task_with_persistence_shared_conn = task_with_persistence
+task_with_persistence_shared_conn_a = task_with_persistence
@@ -1,9 +1,20 @@
-from papp.main import app
+import asyncio
+from papp.main import app, shard, shard_configs
+from papp.metrics import flush_all_metrics
+from papp import notify, prefetch, prometheus
+from papp.adaptive import AdaptiveConcurrency
+from papp.shards import WorkStealer
+from papp.sink import flush_all_sinks
+from papp.store import store
+from papp.utils import shutdown_task_pools
 import typer
 import logging
 
 app_cli = typer.Typer()
 
+#: jobs a --steal worker moves at once, per concurrency slot (a few seconds of work)
+STEAL_BATCH_PER_SLOT = 20
+
 
 # Setup logging
 logging.basicConfig(
@@ -11,6 +22,72 @@ logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s",
 )
 
+def run_worker(name: str, concurrency: int, queues: list[str] | None, delete_jobs: str, wait: bool,
+               metrics_port: int | None = None, on_ready=None, adaptive: bool = False, min_concurrency: int = 1,
+               steal: bool = False, wakeup_jitter_ms: float = 0):
+    """
+    Runs a worker until it stops; `on_ready()` is called once its connection pool is open.
+    With `adaptive`, `concurrency` is the most jobs the worker runs at once (see papp/adaptive.py).
+    With `steal`, the worker takes jobs from the other shards when its own runs low (see papp/shards.py).
+    With `wakeup_jitter_ms`, it reacts to job notifications after a random delay up to that (see papp/notify.py).
+    """
+    if metrics_port or adaptive:
+        prometheus.install(app, name, concurrency)
+    prefetch.fit_buffer(app, concurrency)
+    stealer = None
+    if steal:
+        donors = {index: config for index, config in enumerate(shard_configs) if index != shard}
+        if donors:
+            stealer = WorkStealer(app, donors, queues, batch=STEAL_BATCH_PER_SLOT * concurrency)
+        else:
+            logging.warning("--steal ignored: DB_SHARDS lists no other shard")
+
+    async def work():
+        app.perform_import_paths()
+        # without --wait, a stealing worker stops once neither its shard nor the others have jobs for it
+        worker = app._worker(
+            queues=queues, name=name, concurrency=concurrency, delete_jobs=delete_jobs,
+            wait=wait or stealer is not None,
+        )
+        if wakeup_jitter_ms > 0:
+            notify.stagger_wakeups(worker, wakeup_jitter_ms / 1000)
+        side_tasks = []
+        if adaptive:
+            side_tasks.append(asyncio.create_task(
+                AdaptiveConcurrency(worker, min_concurrency=min_concurrency).run(), name="adaptive concurrency",
+            ))
+        if stealer is not None:
+            side_tasks.append(asyncio.create_task(
+                stealer.run() if wait else stealer.drain(worker.stop), name="work stealer",
+            ))
+        try:
+            await worker.run()
+        finally:
+            for task in side_tasks:
+                task.cancel()
+
+    async def run():
+        async with app.open_async():
+            await store.open_async()
+            endpoint = await prometheus.serve(app, metrics_port) if metrics_port else None
+            if on_ready is not None:
+                on_ready()
+            try:
+                await work()
+            finally:
+                # jobs claimed but not started go back to the queue
+                await prefetch.release(app)
+                # buffered job results must be written before the pool closes
+                await flush_all_sinks()
+                await flush_all_metrics()
+                await store.close_async()
+                shutdown_task_pools()
+                if endpoint is not None:
+                    endpoint.cancel()
+
+    asyncio.run(run())
+
+
 @app_cli.command()
 def run_workers(
     concurrency: int = typer.Option(1, help="Concurrency per worker"),
@@ -18,19 +95,20 @@ def run_workers(
     name: str = typer.Option("worker", help="worker name"),
     delete_jobs: str = typer.Option("never", help="Delete jobs policy"),
     wait: bool = typer.Option(False, help="Shutdown when no jobs to do"),
+    metrics_port: int = typer.Option(None, help="Serve Prometheus metrics on this port (disabled by default)"),
+    adaptive: bool = typer.Option(False, help="Adapt the concurrency (up to --concurrency) to the DB latency and loop lag"),
+    min_concurrency: int = typer.Option(1, help="With --adaptive: the lowest concurrency"),
+    steal: bool = typer.Option(False, help="With DB_SHARDS: take jobs from the other shards when this one runs low"),
+    wakeup_jitter_ms: float = typer.Option(0, help="Look for new jobs a random 0..N ms after a job notification (0: at once)"),
 ):
     # example
     qlist = queues.split(",") if queues else None
     logging.info(f"Starting worker with concurrency {concurrency}, queues={qlist}, delete_jobs={delete_jobs}, wait={wait}")
 
-    logging.info(f"Spawning worker: {name}")
-    app.run_worker(
-        queues=qlist,
-        name=name,
-        concurrency=concurrency,
-        delete_jobs=delete_jobs,
-        wait=wait
-    )
+    logging.info(f"Spawning worker: {name} (shard {shard})")
+
+    run_worker(name, concurrency, qlist, delete_jobs, wait, metrics_port,
+               adaptive=adaptive, min_concurrency=min_concurrency, steal=steal, wakeup_jitter_ms=wakeup_jitter_ms)
     logging.info("Started.")
 
 if __name__ == "__main__":
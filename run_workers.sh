@@ -9,18 +9,33 @@
 #   $1: The number of workers to start (defaults to 10).
 #   $2: The prefix for each worker's name (defaults to 'w_').
 #   $3: The concurrency per worker (defaults to 1).
+#   $4...: Extra options passed to every run_worker.py (e.g. --wait).
+#
+# With METRICS_PORT set, worker i serves Prometheus metrics on port METRICS_PORT+i.
+# With DB_SHARDS exported (and SHARD unset), worker i is pinned to shard (i-1) mod N (see papp/shards.py).
 
 
 NUM_WORKERS=${1:-10}
 WORKER_PREFIX=${2:-worker_}
 CONCURRENCY=${3:-1}
+EXTRA_ARGS=("${@:4}")
+IFS=, read -ra SHARD_LIST <<< "${DB_SHARDS}"
+NUM_SHARDS=${#SHARD_LIST[@]}
 
 
 echo "🚀 Starting ${NUM_WORKERS} workers with prefix '${WORKER_PREFIX}'..."
 
 for i in $(seq 1 ${NUM_WORKERS}); do
   # Pass concurrency to each worker
-  python run_worker.py --name=${WORKER_PREFIX}$i --concurrency=${CONCURRENCY} &
+  METRICS_ARGS=()
+  if [ -n "${METRICS_PORT}" ]; then
+    METRICS_ARGS=(--metrics-port=$((METRICS_PORT + i)))
+  fi
+  WORKER_SHARD=${SHARD:-0}
+  if [ -z "${SHARD}" ] && [ "${NUM_SHARDS}" -gt 1 ]; then
+    WORKER_SHARD=$(( (i - 1) % NUM_SHARDS ))
+  fi
+  SHARD=${WORKER_SHARD} python run_worker.py --name=${WORKER_PREFIX}$i --concurrency=${CONCURRENCY} "${METRICS_ARGS[@]}" "${EXTRA_ARGS[@]}" &
 done
 
 # The 'wait' command will pause the script here until all background jobs are finished.
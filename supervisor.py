@@ -0,0 +1,361 @@
+import time
+IMPORT_START = time.perf_counter()
+
+import gc
+import logging
+import os
+import select
+import signal
+import sys
+
+import typer
+
+# everything a worker needs is imported here, once, before forking
+from papp import autoscale, connections
+from papp.main import app, pgconfig, pool_args, shard, shard_configs
+from run_worker import run_worker
+
+app.perform_import_paths() # the task modules
+IMPORT_MS = (time.perf_counter() - IMPORT_START) * 1000
+
+app_cli = typer.Typer()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+)
+
+# A child that crashes within this many seconds of its start counts towards --max-restarts
+CRASH_LOOP_SECONDS = 10
+RESTART_DELAY_SECONDS = 1.0
+
+
+def memory_mb(pid: int) -> tuple[float | None, float | None]:
+    """RSS and PSS (the RSS with shared pages divided among the processes sharing them) of `pid`, Linux only"""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            values = {line.split(":")[0]: int(line.split()[1]) for line in f if line.split(":")[0] in ("Rss", "Pss")}
+        return values["Rss"] / 1024, values["Pss"] / 1024
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class Child:
+    """A forked worker process"""
+
+    def __init__(self, name: str, metrics_port: int | None = None):
+        self.name = name
+        self.metrics_port = metrics_port
+        self.pid = None
+        self.ready_pipe = None
+        self.forked_at = 0.0
+        self.startup_ms = None
+        self.restarts = 0
+        self.crashes = 0
+        #: when a crashed child is due to be forked again (monotonic clock)
+        self.restart_at = None
+
+
+class Supervisor:
+    """
+    Forks the workers from a process that already imported procrastinate, the
+    app and its tasks, so children start without re-importing anything and
+    share those pages copy-on-write. Crashed children are restarted; SIGTERM
+    or SIGINT is forwarded once to every child for a graceful drain (a second
+    one is forwarded too, and makes procrastinate abort the running jobs).
+
+    With an `autoscaler` (see papp/autoscale.py), the number of children
+    follows its decisions every `scale_interval` seconds: extra workers are
+    forked, surplus ones get a SIGTERM and drain. Without --wait, workers exit
+    when the queue is empty, and the supervisor once none is left and the
+    backlog is empty.
+
+    With a `relay` (behind PgBouncer), the supervisor holds the only LISTEN
+    connection and forwards the notifications to the children through pipes.
+    """
+
+    def __init__(self, prefix: str, workers: int, worker_kwargs: dict, max_restarts: int,
+                 metrics_port: int | None = None, autoscaler: autoscale.Autoscaler | None = None,
+                 scale_interval: float = 5, relay: connections.NotificationRelay | None = None):
+        self.prefix = prefix
+        self.metrics_port = metrics_port
+        self.children: dict[str, Child] = {}
+        for _ in range(workers):
+            self.add_child()
+        self.retiring: list[Child] = []
+        self.worker_kwargs = worker_kwargs
+        self.max_restarts = max_restarts
+        self.autoscaler = autoscaler
+        self.scale_interval = scale_interval
+        self.relay = relay
+        self.backlog = 0
+        self.stopping = False
+        self.reported = False
+
+    def add_child(self) -> Child:
+        """A new child, named after the lowest free index (not forked yet)"""
+        index = next(i for i in range(1, len(self.children) + 2) if f"{self.prefix}{i}" not in self.children)
+        child = Child(f"{self.prefix}{index}", self.metrics_port + index if self.metrics_port else None)
+        self.children[child.name] = child
+        return child
+
+    def fork(self, child: Child):
+        read_fd, write_fd = os.pipe()
+        relay_fd = self.relay.add(child.name) if self.relay is not None else None
+        child.forked_at = time.perf_counter()
+        child.startup_ms = None
+        pid = os.fork()
+        if pid == 0: # in the child
+            os.close(read_fd)
+            code = 1
+            try:
+                if self.relay is not None:
+                    self.relay.close_in_child()
+                    app.connector.relay_fd = relay_fd
+                # out of the terminal's process group: Ctrl-C reaches the supervisor only, which forwards it once
+                os.setpgid(0, 0)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+                def on_ready():
+                    os.write(write_fd, b"ready\n")
+                    os.close(write_fd)
+
+                run_worker(name=child.name, metrics_port=child.metrics_port, on_ready=on_ready, **self.worker_kwargs)
+                code = 0
+            except BaseException:
+                logging.exception(f"Worker {child.name} crashed")
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        os.close(write_fd)
+        if relay_fd is not None:
+            os.close(relay_fd)
+        child.pid = pid
+        child.ready_pipe = read_fd
+
+    def forward(self, signum, frame):
+        first = not self.stopping
+        self.stopping = True
+        for child in self.children.values():
+            child.restart_at = None # not restarted while draining
+        logging.info(f"[SUPERVISOR] {signal.Signals(signum).name} received, "
+                     f"{'draining' if first else 'aborting'} {self.alive()} workers")
+        for child in [*self.children.values(), *self.retiring]:
+            if child.pid is not None:
+                try:
+                    os.kill(child.pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def alive(self) -> int:
+        """Children running, or crashed and waiting for their restart"""
+        return sum(1 for child in [*self.children.values(), *self.retiring]
+                   if child.pid is not None or child.restart_at is not None)
+
+    def given_up(self, child: Child) -> bool:
+        return child.crashes > self.max_restarts
+
+    def scale(self):
+        """Applies the autoscaler's decision"""
+        try:
+            self.backlog, oldest_age = autoscale.sample_backlog(pgconfig, self.autoscaler.backlog_cap)
+        except Exception as e:
+            logging.warning(f"[SUPERVISOR] Could not sample the backlog: {e!r}")
+            return
+        target = self.autoscaler.decide(len(self.children), self.backlog, oldest_age)
+        while len(self.children) < target:
+            self.fork(self.add_child())
+        while len(self.children) > target:
+            # the most recent ones go first, so names stay <prefix>1..<prefix>N
+            name = max(self.children, key=lambda n: int(n.removeprefix(self.prefix)))
+            child = self.children.pop(name)
+            if child.pid is not None:
+                os.kill(child.pid, signal.SIGTERM)
+                self.retiring.append(child)
+
+    def read_ready(self, timeout: float):
+        """Records the startup time of the children that reported ready, and relays notifications"""
+        pipes = {child.ready_pipe: child for child in self.children.values() if child.ready_pipe is not None}
+        relay = []
+        if self.relay is not None:
+            self.relay.reconnect_due()
+            if self.relay.connection is not None:
+                relay = [self.relay]
+        if not pipes and not relay:
+            time.sleep(timeout)
+            return
+        try:
+            readable, _, _ = select.select([*pipes, *relay], [], [], timeout)
+        except InterruptedError:
+            return
+        if relay and self.relay in readable:
+            readable.remove(self.relay)
+            self.relay.forward()
+        for fd in readable:
+            child = pipes[fd]
+            if os.read(fd, 64).startswith(b"ready") and child.startup_ms is None:
+                child.startup_ms = (time.perf_counter() - child.forked_at) * 1000
+                if child.restarts:
+                    logging.info(f"[SUPERVISOR] {child.name} restarted, ready in {child.startup_ms:.0f} ms")
+            os.close(fd)
+            child.ready_pipe = None
+        self.report_when_started()
+
+    def report_when_started(self):
+        """Reports once every child is ready, or given up on"""
+        children = self.children.values()
+        if self.reported or not any(child.startup_ms is not None for child in children):
+            return
+        if all(child.startup_ms is not None or self.given_up(child) for child in children):
+            self.reported = True
+            self.report()
+
+    def report(self):
+        """Prints the startup time and memory of every child that started"""
+        started = [child for child in self.children.values() if child.startup_ms is not None]
+        given_up = len(self.children) - len(started)
+        lines = [f"[SUPERVISOR] {len(started)} workers ready (imports done once, in {IMPORT_MS:.0f} ms)"
+                 f"{f', {given_up} given up on' if given_up else ''}:"]
+        for child in started:
+            rss, pss = memory_mb(child.pid) if child.pid else (None, None)
+            memory = f", RSS {rss:.0f} MB, PSS {pss:.0f} MB" if rss is not None else ""
+            lines.append(f"    {child.name}: ready in {child.startup_ms:.0f} ms{memory}")
+        startups = sorted(child.startup_ms for child in started)
+        lines.append(f"    startup median {startups[len(startups) // 2]:.0f} ms, max {startups[-1]:.0f} ms")
+        logging.info("\n".join(lines))
+
+    def reap(self):
+        """Handles the children that exited: schedules the restart of the crashed ones"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            child = next((c for c in [*self.children.values(), *self.retiring] if c.pid == pid), None)
+            if child is None:
+                continue
+            child.pid = None
+            if child.ready_pipe is not None:
+                os.close(child.ready_pipe)
+                child.ready_pipe = None
+            code = os.waitstatus_to_exitcode(status)
+            if self.relay is not None:
+                self.relay.remove(child.name)
+            if child in self.retiring:
+                self.retiring.remove(child)
+                logging.info(f"[SUPERVISOR] {child.name} scaled down ({code})")
+                continue
+            if code == 0 or self.stopping:
+                logging.info(f"[SUPERVISOR] {child.name} exited ({code})")
+                if self.autoscaler is not None:
+                    del self.children[child.name] # idle (without --wait): forked again when needed
+                continue
+            if time.perf_counter() - child.forked_at < CRASH_LOOP_SECONDS:
+                child.crashes += 1
+            if self.given_up(child):
+                logging.error(f"[SUPERVISOR] {child.name} exited ({code}) {child.crashes} times right after "
+                              f"starting, giving up on it")
+                self.report_when_started()
+                continue
+            logging.warning(f"[SUPERVISOR] {child.name} exited ({code}), restarting it in {RESTART_DELAY_SECONDS:.0f} s")
+            # not slept here: the loop keeps relaying notifications and forwarding signals meanwhile
+            child.restart_at = time.monotonic() + RESTART_DELAY_SECONDS
+
+    def restart_due(self):
+        """Forks again the crashed children whose restart delay is over"""
+        now = time.monotonic()
+        for child in list(self.children.values()):
+            if child.restart_at is not None and child.restart_at <= now:
+                child.restart_at = None
+                child.restarts += 1
+                self.fork(child)
+
+    def run(self) -> int:
+        # objects imported so far are never freed: keep the GC from touching (and copying) their pages
+        gc.freeze()
+        signal.signal(signal.SIGTERM, self.forward)
+        signal.signal(signal.SIGINT, self.forward)
+        for child in self.children.values():
+            self.fork(child)
+        next_scale = time.monotonic() + self.scale_interval
+        while self.alive() or (self.autoscaler is not None and not self.stopping
+                               and (self.worker_kwargs["wait"] or self.backlog)):
+            self.read_ready(timeout=0.5)
+            self.reap()
+            self.restart_due()
+            if self.autoscaler is not None and not self.stopping and time.monotonic() >= next_scale:
+                self.scale()
+                next_scale = time.monotonic() + self.scale_interval
+        failed = [child.name for child in self.children.values() if self.given_up(child)]
+        return 1 if failed else 0
+
+
+@app_cli.command()
+def main(
+    workers: int = typer.Option(10, help="Number of workers to fork"),
+    prefix: str = typer.Option("w_", help="Worker name prefix: workers are named <prefix>1..<prefix>N"),
+    concurrency: int = typer.Option(1, help="Concurrency per worker"),
+    queues: str = typer.Option(None, help="Comma-separated list of queues (leave empty for all)"),
+    delete_jobs: str = typer.Option("never", help="Delete jobs policy"),
+    wait: bool = typer.Option(False, help="Keep waiting for jobs instead of exiting when the queue is empty"),
+    metrics_port: int = typer.Option(None, help="Worker i serves Prometheus metrics on port METRICS_PORT+i"),
+    max_restarts: int = typer.Option(3, help="Give up on a worker crashing this many times right after starting"),
+    autoscale_: bool = typer.Option(False, "--autoscale", help="Scale the workers on the backlog (--workers is the initial count)"),
+    min_workers: int = typer.Option(1, help="With --autoscale: workers always running"),
+    max_workers: int = typer.Option(20, help="With --autoscale: most workers (also capped by the connection budget)"),
+    connection_budget: int = typer.Option(0, help="Postgres connections the workers may use (0: from max_connections)"),
+    scale_interval: float = typer.Option(5, help="With --autoscale: seconds between two scaling decisions"),
+    adaptive: bool = typer.Option(False, help="Each worker adapts its concurrency, up to --concurrency"),
+    min_concurrency: int = typer.Option(1, help="With --adaptive: the lowest concurrency"),
+    steal: bool = typer.Option(False, help="With DB_SHARDS: workers take jobs from the other shards when theirs runs low"),
+    wakeup_jitter_ms: float = typer.Option(0, help="Workers look for new jobs a random 0..N ms after a job notification, not all at once"),
+):
+    """Forks and supervises the workers, like run_workers.sh but with a single import of the app"""
+    logging.info(f"🚀 Forking {workers} workers with prefix '{prefix}' (imports took {IMPORT_MS:.0f} ms)...")
+    if len(shard_configs) > 1:
+        # one supervisor per shard (see papp/shards.py)
+        logging.info(f"Workers pinned to shard {shard} of {len(shard_configs)} ({pgconfig['host']}:{pgconfig['port']})")
+    budget = connection_budget or connections.connection_budget(pgconfig)
+    autoscaler = None
+    if autoscale_:
+        autoscaler = autoscale.Autoscaler(
+            min_workers, max_workers, concurrency, connections.connections_per_worker(app, pool_args), budget,
+        )
+        workers = max(autoscaler.min_workers, min(autoscaler.max_workers, workers))
+    try:
+        connections.fit_pools(app, pool_args, budget, autoscaler.max_workers if autoscaler is not None else workers)
+    except ValueError as e:
+        logging.error(f"❌ {e}")
+        raise typer.Exit(1)
+    relay = None
+    if connections.is_pgbouncer(app):
+        relay = connections.NotificationRelay(app.connector.listen_kwargs, queues.split(",") if queues else None)
+    supervisor = Supervisor(
+        prefix, workers,
+        worker_kwargs={
+            "concurrency": concurrency,
+            "queues": queues.split(",") if queues else None,
+            "delete_jobs": delete_jobs,
+            "wait": wait,
+            "adaptive": adaptive,
+            "min_concurrency": min_concurrency,
+            "steal": steal,
+            "wakeup_jitter_ms": wakeup_jitter_ms,
+        },
+        max_restarts=max_restarts,
+        metrics_port=metrics_port,
+        autoscaler=autoscaler,
+        scale_interval=scale_interval,
+        relay=relay,
+    )
+    code = supervisor.run()
+    logging.info("✅ All workers have completed their tasks.")
+    raise typer.Exit(code)
+
+
+if __name__ == "__main__":
+    app_cli()
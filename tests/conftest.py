@@ -0,0 +1,6 @@
+import os
+
+# papp.main reads its connection settings at import time: the unit tests never connect
+for key, value in {"DB_HOST": "localhost", "DB_PORT": "5432", "DB_USER": "postgres",
+                   "DB_PASSWORD": "password", "DB_NAME": "postgres"}.items():
+    os.environ.setdefault(key, value)
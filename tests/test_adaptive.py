@@ -0,0 +1,37 @@
+import asyncio
+
+import procrastinate
+from procrastinate import testing
+
+from papp.adaptive import AdaptiveConcurrency
+
+
+def test_at_most_limit_jobs_run_at_once():
+    app = procrastinate.App(connector=testing.InMemoryConnector())
+    running, peaks = 0, []
+    controller = None
+
+    @app.task(queue="jobs")
+    async def job():
+        nonlocal running
+        running += 1
+        peaks.append(running)
+        if len(peaks) == 30:
+            controller.gate.set_limit(6) # a raised limit lets more jobs through
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def main():
+        nonlocal controller
+        async with app.open_async():
+            for _ in range(60):
+                await job.defer_async()
+            worker = app._worker(concurrency=8, wait=False, queues=["jobs"])
+            controller = AdaptiveConcurrency(worker, min_concurrency=3)
+            await worker.run()
+        assert len(peaks) == 60
+        assert max(peaks[:30]) == 3
+        assert max(peaks[30:]) == 6
+        assert controller.gate.running == 0
+
+    asyncio.run(main())
@@ -0,0 +1,61 @@
+from papp.autoscale import Autoscaler
+
+
+def autoscaler(**kwargs) -> Autoscaler:
+    options = dict(min_workers=1, max_workers=10, concurrency=2, connections_per_worker=4, connection_budget=1000,
+                   backlog_per_slot=10, max_age=30, down_ratio=0.25, up_cooldown=10, down_cooldown=60, down_checks=3)
+    return Autoscaler(**{**options, **kwargs})
+
+
+def test_scales_up_to_the_workers_the_backlog_needs():
+    scaler = autoscaler()
+    # 20 jobs per worker (10 per slot x 2 slots): 130 jobs need 7
+    assert scaler.decide(2, backlog=130, oldest_age=0, now=100) == 7
+
+
+def test_scales_up_by_one_on_old_jobs():
+    scaler = autoscaler()
+    assert scaler.decide(3, backlog=10, oldest_age=45, now=100) == 4
+
+
+def test_up_cooldown():
+    scaler = autoscaler()
+    assert scaler.decide(2, backlog=130, oldest_age=0, now=100) == 7
+    assert scaler.decide(7, backlog=500, oldest_age=0, now=105) == 7 # within 10 s of the last change
+    assert scaler.decide(7, backlog=500, oldest_age=0, now=110) == 10 # capped by max_workers
+
+
+def test_scales_down_one_at_a_time_after_calm_checks():
+    scaler = autoscaler()
+    assert scaler.decide(5, backlog=0, oldest_age=0, now=100) == 5
+    assert scaler.decide(5, backlog=0, oldest_age=0, now=105) == 5
+    assert scaler.decide(5, backlog=0, oldest_age=0, now=110) == 4 # third calm check, no change for 60 s yet
+    # the calm checks start over, and the down cooldown runs from the last change
+    for now in (115, 120, 125):
+        assert scaler.decide(4, backlog=0, oldest_age=0, now=now) == 4
+    assert scaler.decide(4, backlog=0, oldest_age=0, now=170) == 3
+
+
+def test_busy_sample_resets_the_calm_checks():
+    scaler = autoscaler()
+    scaler.decide(5, backlog=0, oldest_age=0, now=100)
+    scaler.decide(5, backlog=0, oldest_age=0, now=105)
+    # 30 jobs for 5 workers: over 25% of their slots, not enough for more workers
+    assert scaler.decide(5, backlog=30, oldest_age=0, now=110) == 5
+    assert scaler.decide(5, backlog=0, oldest_age=0, now=115) == 5
+    assert scaler.decide(5, backlog=0, oldest_age=0, now=120) == 5
+    assert scaler.decide(5, backlog=0, oldest_age=0, now=125) == 4
+
+
+def test_bounds():
+    scaler = autoscaler(min_workers=2)
+    assert scaler.decide(1, backlog=0, oldest_age=0, now=100) == 2
+    # 20 connections allow 5 workers of 4
+    assert autoscaler(connection_budget=20).max_workers == 5
+    assert autoscaler(connections_per_worker=0, connection_budget=1).max_workers == 10 # behind PgBouncer
+
+
+def test_backlog_cap():
+    scaler = autoscaler()
+    assert scaler.backlog_cap == 200
+    assert scaler.decide(1, backlog=scaler.backlog_cap, oldest_age=0, now=100) == scaler.max_workers
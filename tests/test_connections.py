@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+import select
+import time
+import types
+
+import psycopg
+
+import supervisor
+from papp import connections
+from papp.connections import NotificationRelay, PgBouncerConnector, pipe_chunks
+
+
+def relay_with(notifications: list) -> NotificationRelay:
+    relay = NotificationRelay.__new__(NotificationRelay)
+    relay.pipes = {}
+    relay.connection = types.SimpleNamespace(notifies=lambda timeout: iter(notifications))
+    return relay
+
+
+def read_all(read_fd: int) -> bytes:
+    os.set_blocking(read_fd, False)
+    data = b""
+    while True:
+        try:
+            chunk = os.read(read_fd, 65536)
+        except BlockingIOError:
+            return data
+        if not chunk:
+            return data
+        data += chunk
+
+
+def test_burst_over_the_pipe_capacity_writes_whole_lines():
+    payload = json.dumps({"type": "job_inserted", "job_id": 0, "padding": "x" * 100})
+    notifications = [types.SimpleNamespace(channel="procrastinate_any_queue_v1", payload=payload)] * 2000 # ~250 KiB
+    relay = relay_with(notifications)
+    read_fd = relay.add("w_1")
+    relay.forward()
+    data = read_all(read_fd)
+    assert 0 < len(data) < 2000 * len(payload) # the rest did not fit in the pipe
+    assert data.endswith(b"\n")
+    for line in data.splitlines():
+        channel, _, received = line.decode().partition("\t")
+        assert channel == "procrastinate_any_queue_v1" and received == payload
+    relay.remove("w_1")
+    os.close(read_fd)
+
+
+def test_pipe_chunks():
+    lines = [b"a" * 1000 + b"\n"] * 10 + [b"b" * (select.PIPE_BUF + 1)]
+    chunks = pipe_chunks(lines)
+    assert all(len(chunk) <= select.PIPE_BUF for chunk in chunks)
+    assert b"".join(chunks) == b"".join(lines[:10]) # the over-long line is dropped
+
+
+def test_listen_notify_skips_malformed_lines():
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'channel\t{"type": "job_in\nchannel\t{"type": "job_inserted"}\nno tab\nother\t{}\n')
+    os.close(write_fd)
+    connector = PgBouncerConnector(listen_kwargs={})
+    connector.relay_fd = read_fd
+    received = []
+
+    async def on_notification(channel, payload):
+        received.append((channel, payload))
+
+    asyncio.run(connector.listen_notify(on_notification, ["channel"]))
+    assert received == [("channel", '{"type": "job_inserted"}')]
+
+
+def test_lost_connection_is_retried_on_a_timer():
+    def lost(timeout):
+        raise psycopg.OperationalError("the connection is lost")
+
+    attempts = []
+    idle_fd, idle_write_fd = os.pipe() # selectable, never readable
+
+    def connect():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise psycopg.OperationalError("connection refused")
+        relay.connection = types.SimpleNamespace(notifies=lambda timeout: iter([]), fileno=lambda: idle_fd)
+
+    relay = relay_with([])
+    relay.connection = types.SimpleNamespace(notifies=lost, close=lambda: None)
+    relay.connect = connect
+    relay.forward()
+    assert relay.connection is None and len(attempts) == 1
+    assert relay.reconnect_at >= attempts[0] + connections.RELAY_RECONNECT_SECONDS
+
+    # the supervisor keeps running without it, and retries once due
+    sup = supervisor.Supervisor("w_", 1, worker_kwargs={}, max_restarts=3, relay=relay)
+    sup.read_ready(timeout=0.01)
+    assert len(attempts) == 1
+    relay.reconnect_at = time.monotonic()
+    sup.read_ready(timeout=0.01)
+    assert len(attempts) == 2 and relay.connection is not None and relay.reconnect_at is None
+    sup.read_ready(timeout=0.01) # selected again
+    os.close(idle_fd)
+    os.close(idle_write_fd)
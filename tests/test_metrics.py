@@ -0,0 +1,107 @@
+import asyncio
+import json
+import math
+import random
+
+import pytest
+
+from papp.metrics import BUCKETS, HALF_SUB_BUCKETS, Histogram, MetricsRecorder, bucket_index, bucket_value, merge_rows
+
+
+def exponential_sample(mean_ms: float, n: int, seed: int = 13) -> list[float]:
+    rng = random.Random(seed)
+    return [rng.expovariate(1 / mean_ms) for _ in range(n)]
+
+
+def test_bucket_relative_error():
+    for value_us in [0, 1, 127, 128, 129, 1000, 12_345, 250_000, 9_999_999, 2**34]:
+        index = bucket_index(value_us)
+        assert 0 <= index < BUCKETS
+        assert abs(bucket_value(index) - value_us) <= max(value_us / HALF_SUB_BUCKETS, 0.5)
+
+
+def test_bucket_index_is_monotonic():
+    indexes = [bucket_index(value_us) for value_us in range(0, 200_000, 7)]
+    assert indexes == sorted(indexes)
+
+
+def test_huge_values_are_clamped_to_the_last_bucket():
+    assert bucket_index(2**50) == BUCKETS - 1
+
+
+def test_exponential_percentiles():
+    # exp(250 ms): p50 = 250 ln 2 ≈ 173 ms, p99 = 250 ln 100 ≈ 1151 ms
+    histogram = Histogram()
+    sample = exponential_sample(250, 100_000)
+    for value in sample:
+        histogram.record(value)
+    assert histogram.count == len(sample)
+    assert histogram.sum_ms == pytest.approx(sum(sample))
+    assert histogram.max_ms == max(sample)
+    assert histogram.percentile(50) == pytest.approx(250 * math.log(2), rel=0.03)
+    assert histogram.percentile(99) == pytest.approx(250 * math.log(100), rel=0.03)
+    # within the bucket precision of the exact order statistics
+    ordered = sorted(sample)
+    for p in (50, 90, 99, 99.9):
+        exact = ordered[round(p / 100 * len(ordered)) - 1]
+        assert histogram.percentile(p) == pytest.approx(exact, rel=1 / HALF_SUB_BUCKETS)
+
+
+def test_empty_histogram():
+    assert Histogram().percentile(50) is None
+
+
+def test_merge_rows_equals_one_histogram():
+    sample = exponential_sample(250, 20_000)
+    whole = Histogram()
+    rows = []
+    # 4 workers x 5 flush intervals, as read back from worker_metrics
+    for chunk in range(20):
+        part = Histogram()
+        for value in sample[chunk::20]:
+            part.record(value)
+            whole.record(value)
+        row = ("task", "duration_ms", part.count, part.sum_ms, part.max_ms, json.dumps(part.to_buckets()))
+        rows.append(row if chunk % 2 else dict(zip(("task_name", "metric", "count", "sum_ms", "max_ms", "buckets"), row)))
+    rows.append(("other", "duration_ms", 1, 5.0, 5.0, {str(bucket_index(5000)): 1}))
+
+    merged = merge_rows(rows)
+    assert set(merged) == {("task", "duration_ms"), ("other", "duration_ms")}
+    histogram = merged["task", "duration_ms"]
+    assert histogram.counts == whole.counts
+    assert histogram.count == whole.count
+    assert histogram.sum_ms == pytest.approx(whole.sum_ms)
+    assert histogram.max_ms == whole.max_ms
+    for p in (50, 99):
+        assert histogram.percentile(p) == whole.percentile(p)
+    assert merged["other", "duration_ms"].percentile(50) == 5.0
+
+
+class SlowConnector:
+    """Records the histogram counts of every insert; the nth one takes `delays[n]` seconds"""
+
+    def __init__(self, *delays: float):
+        self.delays = list(delays)
+        self.closed = False
+        self.written: list[list[int]] = []
+
+    async def execute_query_async(self, query, **params):
+        await asyncio.sleep(self.delays.pop(0))
+        assert not self.closed, "written after the connector closed"
+        self.written.append(params["count"])
+
+
+def test_close_waits_for_the_periodic_flush():
+    async def scenario():
+        connector = SlowConnector(0.1, 0.01)
+        recorder = MetricsRecorder(flush_seconds=0.01)
+        recorder.record(connector, "w", "task", duration_ms=5.0)
+        await asyncio.sleep(0.03) # the periodic flush is writing
+        recorder.record(connector, "w", "task", duration_ms=6.0)
+        await recorder.close()
+        connector.closed = True
+        await asyncio.sleep(0.15)
+        MetricsRecorder.instances.remove(recorder)
+        return connector
+
+    assert asyncio.run(scenario()).written == [[1], [1]]
@@ -0,0 +1,32 @@
+import asyncio
+import contextlib
+import types
+
+import orchestrator
+from papp.tasks import asum_with_persistence
+
+
+class FlakyConnector:
+    """Fails every other insert"""
+
+    def __init__(self):
+        self.calls = 0
+        self.inserted = 0
+
+    async def execute_query_all_async(self, query, **params):
+        self.calls += 1
+        if self.calls % 2 == 0:
+            raise RuntimeError("insert failed")
+        self.inserted += len(params["args"].obj)
+        return []
+
+
+def test_failed_inserts_are_not_counted(monkeypatch):
+    connector = FlakyConnector()
+    app = types.SimpleNamespace(connector=connector, open_async=contextlib.nullcontext)
+    monkeypatch.setattr(orchestrator, "app", app)
+    deferred, _, failed = asyncio.run(orchestrator.open_loop(
+        asum_with_persistence, "constant", 1000, 0, 0.5, 0.05, 10, lambda i: {"a": i, "b": i},
+    ))
+    assert failed > 0
+    assert deferred == connector.inserted
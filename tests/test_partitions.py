@@ -0,0 +1,38 @@
+import datetime
+
+from papp import partitions
+
+
+def test_create_statements_cover_current_and_upcoming_ranges():
+    statements = partitions.create_statements(1000, 2500, ahead=1)
+    assert len(statements) == 4 # 2 ranges x 2 tables
+    assert "CREATE TABLE job_results_p000000002000 " in statements[0]
+    assert "FOR VALUES FROM (2000) TO (3000)" in statements[0]
+    assert "DELETE FROM job_results_default WHERE job_id >= 2000 AND job_id < 3000" in statements[0]
+    assert "CREATE TABLE job_result_blobs_p000000003000 " in statements[3]
+
+
+def test_create_statements_skip_existing_partitions():
+    existing = {"job_results_p000000002000", "job_result_blobs_p000000002000"}
+    statements = partitions.create_statements(1000, 2500, existing, ahead=1)
+    assert len(statements) == 2
+    assert all("_p000000003000 " in statement for statement in statements)
+
+
+def test_parse_bound():
+    assert partitions.parse_bound("FOR VALUES FROM ('2000') TO ('3000')") == (2000, 3000)
+    assert partitions.parse_bound("FOR VALUES FROM (2000) TO (3000)") == (2000, 3000)
+    assert partitions.parse_bound("DEFAULT") is None
+
+
+def test_expired_partitions():
+    now = datetime.datetime(2026, 1, 10, 12)
+    newest = {
+        "job_results_p000000000000": datetime.datetime(2026, 1, 1),
+        "job_results_p000000001000": datetime.datetime(2026, 1, 3, 12), # exactly the retention
+        "job_results_p000000002000": datetime.datetime(2026, 1, 9),
+        "job_results_p000000003000": None, # empty
+    }
+    assert partitions.expired_partitions(newest, now, datetime.timedelta(days=7)) == [
+        "job_results_p000000000000", "job_results_p000000001000", "job_results_p000000003000",
+    ]
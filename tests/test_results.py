@@ -0,0 +1,92 @@
+import pytest
+
+from papp.results import BLOB_MARKER, CODECS, INLINE_MAX_BYTES, decode_result, encode_result
+
+LARGE = {"result": 42, "job_id": 7, "long_string": "x" * (4 * INLINE_MAX_BYTES)}
+
+
+def stored(params: dict):
+    """What load_result reads back: the result column, and the blob's codec and data"""
+    result = params["result"].obj if params["result"] is not None else None
+    return result, params["blob_codec"], params["blob_data"]
+
+
+@pytest.mark.parametrize("result", [None, 3, "a $blob in a string", [1, 2], {"result": 1}])
+def test_small_results_stay_inline(result):
+    params = encode_result(result)
+    assert stored(params)[0] == result
+    assert params["blob_data"] is None
+    assert decode_result(*stored(params)) == result
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_large_results_are_offloaded(codec):
+    params = encode_result(LARGE, codec=codec)
+    assert params["blob_codec"] == codec
+    assert params["blob_raw_size"] > INLINE_MAX_BYTES
+    # the stub keeps the small top-level fields, for queries on result->>'result'
+    assert stored(params)[0] == {"result": 42, "job_id": 7, BLOB_MARKER: codec}
+    assert decode_result(*stored(params)) == LARGE
+
+
+def test_large_non_dict_result():
+    result = list(range(2000))
+    params = encode_result(result)
+    assert stored(params)[0] == {BLOB_MARKER: params["blob_codec"]}
+    assert decode_result(*stored(params)) == result
+
+
+def test_unknown_codec_is_named():
+    params = encode_result(LARGE, codec="zlib")
+    with pytest.raises(ValueError, match="'brotli'"):
+        decode_result(params["result"].obj, "brotli", params["blob_data"])
+    with pytest.raises(ValueError, match="'brotli'"):
+        encode_result(LARGE, codec="brotli")
+
+
+def test_missing_blob():
+    params = encode_result(LARGE, codec="zlib")
+    with pytest.raises(ValueError, match="blob is missing"):
+        decode_result(params["result"].obj)
+
+
+@pytest.mark.parametrize("result", [None, 3, "abc", [1, 2], True, {"result": 1}, LARGE, list(range(2000))])
+def test_results_are_written_on_every_path(result):
+    """Through the direct statements and the sink's upsert, on temporary result tables (skipped without a database)"""
+    import asyncio
+    import datetime
+
+    import psycopg
+    from procrastinate import PsycopgConnector
+
+    import init_db
+    from papp.main import pgconfig
+    from papp.results import load_result_async
+    from papp.sink import ResultSink
+    from papp.utils import QUERY_START, QUERY_SUCCESS
+
+    try:
+        psycopg.connect(**pgconfig, connect_timeout=2).close()
+    except psycopg.OperationalError:
+        pytest.skip("no database")
+
+    async def scenario():
+        # one connection, which the temporary tables live in
+        connector = PsycopgConnector(kwargs=pgconfig, min_size=1, max_size=1)
+        await connector.open_async()
+        try:
+            ddl = init_db.CREATE_RESULTS_TABLE.format(partition_by="").replace("CREATE TABLE", "CREATE TEMP TABLE")
+            await connector.execute_query_async(ddl.replace("%", "%%"))
+            now = datetime.datetime.now(datetime.timezone.utc)
+            run = {"task_name": "task", "worker_name": "w", "attempt": 1, "started_at": now}
+            await connector.execute_query_async(QUERY_START, job_id=1, **run)
+            await connector.execute_query_async(QUERY_SUCCESS, job_id=1, **run, **encode_result(result),
+                                                finished_at=now, duration_ms=1.0, execution_ms=1.0)
+            sink = ResultSink()
+            await sink.put(connector, 2, "task", "COMPLETED", worker_name="w", finished_at=now, **encode_result(result))
+            await sink.close()
+            return [await load_result_async(connector, job_id) for job_id in (1, 2)]
+        finally:
+            await connector.close_async()
+
+    assert asyncio.run(scenario()) == [result, result]
@@ -0,0 +1,147 @@
+import asyncio
+import datetime
+
+import psycopg
+import pytest
+
+from papp import sink as sink_module
+from papp.sink import ResultSink
+
+
+class FakeConnector:
+    """
+    Records the job ids of every upsert; each one takes `delay` seconds, or
+    fails on the connection `failures` times first. Upserts of a `bad` job always fail.
+    """
+
+    def __init__(self, delay: float = 0.0, failures: int = 0, bad: int | None = None):
+        self.delay = delay
+        self.failures = failures
+        self.bad = bad
+        self.written: list[list[int]] = []
+        self.runs: list[list[str]] = []
+
+    async def execute_query_async(self, query, **params):
+        await asyncio.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise psycopg.OperationalError("connection lost")
+        if self.bad in params["job_id"]:
+            raise psycopg.DataError("invalid input syntax for type json")
+        self.written.append(params["job_id"])
+        self.runs.append(params["run_status"])
+
+
+def test_batches_and_keeps_the_last_transition():
+    async def scenario():
+        connector = FakeConnector()
+        sink = ResultSink(max_rows=3, max_delay_ms=10_000)
+        await sink.put(connector, 1, "task", "RUNNING")
+        await sink.put(connector, 1, "task", "COMPLETED")
+        await sink.put(connector, 2, "task", "COMPLETED")
+        assert connector.written == []
+        await sink.put(connector, 3, "task", "COMPLETED")
+        assert connector.written == [[1, 2, 3]]
+        await sink.close()
+        return sink
+
+    sink = asyncio.run(scenario())
+    assert (sink.rows_written, sink.flushes) == (3, 1)
+
+
+def test_cancelled_flush_loses_no_rows():
+    async def scenario():
+        connector = FakeConnector(delay=0.05)
+        sink = ResultSink(max_rows=100, max_delay_ms=10_000)
+        await sink.put(connector, 1, "task", "COMPLETED")
+        flush = asyncio.create_task(sink.flush())
+        await asyncio.sleep(0.01) # rows taken out of the buffer, upsert in flight
+        flush.cancel()
+        await asyncio.gather(flush, return_exceptions=True)
+        await sink.put(connector, 2, "task", "COMPLETED")
+        await sink.close()
+        return connector
+
+    assert asyncio.run(scenario()).written == [[1], [2]]
+
+
+def test_close_during_periodic_flush():
+    async def scenario():
+        connector = FakeConnector(delay=0.05)
+        sink = ResultSink(max_rows=100, max_delay_ms=10)
+        await sink.put(connector, 1, "task", "COMPLETED")
+        await asyncio.sleep(0.03) # the periodic flush is writing
+        await sink.close()
+        return connector
+
+    assert asyncio.run(scenario()).written == [[1]]
+
+
+def test_failed_flush_keeps_rows_and_fails_waiters():
+    async def scenario():
+        connector = FakeConnector(failures=1)
+        sink = ResultSink(max_rows=1, max_delay_ms=10_000, wait_for_flush=True)
+        try:
+            await sink.put(connector, 1, "task", "COMPLETED")
+        except psycopg.OperationalError:
+            pass
+        else:
+            raise AssertionError("the waiter should get the flush error")
+        assert len(sink) == 1
+        await sink.close()
+        return connector
+
+    assert asyncio.run(scenario()).written == [[1]]
+
+
+def test_failed_run_retried_within_a_flush_stays_in_the_rollups():
+    async def scenario():
+        connector = FakeConnector()
+        sink = ResultSink(max_rows=100, max_delay_ms=10_000)
+        finished_at = datetime.datetime.now(datetime.timezone.utc)
+        await sink.put(connector, 1, "task", "RUNNING")
+        await sink.put(connector, 1, "task", "FAILED", finished_at=finished_at, duration_ms=5.0)
+        await sink.put(connector, 1, "task", "RUNNING") # the retry
+        await sink.put(connector, 1, "task", "COMPLETED", finished_at=finished_at, duration_ms=3.0)
+        await sink.put(connector, 2, "task", "RUNNING")
+        await sink.close()
+        return connector
+
+    connector = asyncio.run(scenario())
+    assert connector.written == [[1, 2]] # one row per job, with its last status
+    assert connector.runs == [["FAILED", "COMPLETED"]]
+
+
+def test_unwritable_row_is_dropped_and_the_others_written():
+    async def scenario():
+        connector = FakeConnector(bad=2)
+        sink = ResultSink(max_rows=3, max_delay_ms=10_000, wait_for_flush=True)
+        puts = [asyncio.create_task(sink.put(connector, job_id, "task", "COMPLETED")) for job_id in (1, 2, 3)]
+        outcomes = await asyncio.gather(*puts, return_exceptions=True)
+        assert outcomes[0] is None and outcomes[2] is None
+        assert isinstance(outcomes[1], psycopg.DataError) # only its own job fails
+        assert len(sink) == 0
+        await sink.close()
+        return sink, connector
+
+    sink, connector = asyncio.run(scenario())
+    assert connector.written == [[1], [3]]
+    assert (sink.rows_written, sink.rows_dropped) == (2, 1)
+
+
+def test_rows_written_one_by_one_after_repeated_connection_errors():
+    async def scenario():
+        connector = FakeConnector(failures=sink_module.MAX_FLUSH_ATTEMPTS)
+        sink = ResultSink(max_rows=100, max_delay_ms=10_000)
+        await sink.put(connector, 1, "task", "COMPLETED")
+        await sink.put(connector, 2, "task", "COMPLETED")
+        for _ in range(sink_module.MAX_FLUSH_ATTEMPTS - 1):
+            with pytest.raises(psycopg.OperationalError):
+                await sink.flush()
+            assert len(sink) == 2 # kept for the next flush
+        # the last attempt fails too: the rows are then written one by one
+        await sink.flush()
+        await sink.close()
+        return connector
+
+    assert asyncio.run(scenario()).written == [[1], [2]]
@@ -0,0 +1,66 @@
+import os
+import signal
+import time
+
+import supervisor
+from supervisor import Supervisor
+
+
+def crashed_child(sup: Supervisor, name: str):
+    """Makes `name` a child that just exited with code 1"""
+    pid = os.fork()
+    if pid == 0:
+        os._exit(1)
+    child = sup.children[name]
+    child.pid = pid
+    child.forked_at = time.perf_counter()
+    os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT) # exited, left for reap()
+    return child
+
+
+def supervisor_with(workers: int, max_restarts: int = 3) -> tuple[Supervisor, list[str]]:
+    sup = Supervisor("w_", workers, worker_kwargs={}, max_restarts=max_restarts)
+    forked = []
+    sup.fork = lambda child: forked.append(child.name)
+    return sup, forked
+
+
+def test_reap_schedules_the_restart_without_sleeping():
+    sup, forked = supervisor_with(1)
+    child = crashed_child(sup, "w_1")
+    start = time.monotonic()
+    sup.reap()
+    assert time.monotonic() - start < supervisor.RESTART_DELAY_SECONDS / 2
+    assert forked == []
+    assert child.restart_at is not None
+    assert sup.alive() == 1 # the loop keeps running until the restart
+
+    sup.restart_due()
+    assert forked == [] # not due yet
+    child.restart_at = time.monotonic()
+    sup.restart_due()
+    assert forked == ["w_1"]
+    assert child.restart_at is None and child.restarts == 1
+
+
+def test_no_restart_once_stopping():
+    sup, forked = supervisor_with(1)
+    child = crashed_child(sup, "w_1")
+    sup.reap()
+    sup.forward(signal.SIGTERM, None)
+    assert child.restart_at is None
+    sup.restart_due()
+    assert forked == []
+    assert sup.alive() == 0
+
+
+def test_report_covers_the_children_that_started():
+    sup, _ = supervisor_with(2, max_restarts=0)
+    reports = []
+    sup.report = lambda: reports.append([child.name for child in sup.children.values() if child.startup_ms is not None])
+    sup.children["w_2"].startup_ms = 120.0
+    crashed_child(sup, "w_1")
+    sup.reap() # w_1 crashed before being ready: given up on
+    assert reports == [["w_2"]]
+    sup.report_when_started()
+    assert reports == [["w_2"]] # once
@@ -0,0 +1,70 @@
+import random
+
+import pytest
+
+from orchestrator import TokenBucket, rate_profile
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def run(bucket: TokenBucket, clock: FakeClock, steps: int, step: float) -> list[int]:
+    taken = []
+    for _ in range(steps):
+        clock.now += step
+        taken.append(bucket.take())
+    return taken
+
+
+def test_constant_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate_profile("constant", 10, 0, 60), clock=clock)
+    assert run(bucket, clock, 4, 0.5) == [5, 5, 5, 5]
+
+
+def test_fractions_carry_over():
+    clock = FakeClock()
+    bucket = TokenBucket(rate_profile("constant", 3, 0, 60), clock=clock)
+    assert run(bucket, clock, 4, 0.5) == [1, 2, 1, 2]
+
+
+def test_late_tick_catches_up():
+    clock = FakeClock()
+    bucket = TokenBucket(rate_profile("constant", 10, 0, 60), clock=clock)
+    assert run(bucket, clock, 1, 0.5) == [5]
+    assert run(bucket, clock, 1, 2.0) == [20] # a slow tick gets all the arrivals it missed
+
+
+def test_ramp_integrates_the_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate_profile("ramp", 0, 10, 10), clock=clock)
+    taken = run(bucket, clock, 80, 0.125)
+    assert sum(taken) == 50 # area of the 0 -> 10 jobs/s ramp over 10s
+    assert sum(taken[:40]) < sum(taken[40:])
+
+
+def test_ramp_holds_the_final_rate():
+    profile = rate_profile("ramp", 100, 200, 10)
+    assert profile(0) == 100
+    assert profile(5) == 150
+    assert profile(30) == 200
+
+
+def test_burst_caps_the_backlog():
+    clock = FakeClock()
+    bucket = TokenBucket(rate_profile("constant", 100, 0, 60), burst=5, clock=clock)
+    assert run(bucket, clock, 1, 10.0) == [5]
+
+
+def test_poisson_mean_rate():
+    random.seed(1)
+    clock = FakeClock()
+    bucket = TokenBucket(rate_profile("poisson", 50, 0, 60), poisson=True, clock=clock)
+    taken = run(bucket, clock, 800, 0.125)
+    assert sum(taken) == pytest.approx(5000, rel=0.05)
+    assert len(set(taken)) > 1 # not an evenly spaced stream